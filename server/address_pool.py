@@ -0,0 +1,58 @@
+'''
+Refill wallets' pools of imported addresses in the background
+
+Handing out an address is then a dict pop and an index bump; the importmulti
+happens here, off the request path, once a branch's pool is half used.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from junction import ADDRESS_POOL_DEPTH
+from registry import registry
+
+logger = logging.getLogger(__name__)
+
+# Wallets being refilled at once
+ADDRESS_POOL_WORKERS = 2
+
+class AddressPoolFiller:
+
+    def __init__(self, depth=ADDRESS_POOL_DEPTH, workers=ADDRESS_POOL_WORKERS):
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='address-pool')
+        # names of wallets with a refill queued or running
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def request(self, wallet_name):
+        '''Queue a refill of wallet_name's pool, unless one is already queued'''
+        with self.lock:
+            if wallet_name in self.pending:
+                return None
+            self.pending.add(wallet_name)
+        return self.executor.submit(self.fill, wallet_name)
+
+    def fill(self, wallet_name):
+        try:
+            wallet = registry.get(wallet_name)
+            ranges = wallet.address_pool_shortfall(self.depth)
+            if not ranges:
+                return
+            imports_key = wallet.imports_key()
+            # The import is the slow part, and safe to repeat, so it runs without the wallet lock
+            wallet.import_ranges(ranges)
+            with registry.editing(wallet_name) as wallet:
+                # e.g. set_node() moved the wallet while we imported into the old Bitcoin Core wallet
+                if wallet.imports_key() != imports_key:
+                    logger.info(f'Dropped "{wallet_name}" address pool refill, its imports were reset')
+                    return
+                wallet.mark_imported(ranges)
+            logger.info(f'Refilled "{wallet_name}" address pool: {ranges}')
+        except Exception as e:
+            logger.info(f'Could not refill "{wallet_name}" address pool: {e}')
+        finally:
+            with self.lock:
+                self.pending.discard(wallet_name)
+
+address_pool_filler = AddressPoolFiller()
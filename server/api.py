@@ -1,15 +1,26 @@
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import jsonify, request, redirect, url_for, Blueprint, current_app
+from flask import Response, jsonify, request, redirect, url_for, Blueprint, current_app
 from flask_json_schema import JsonSchema, JsonValidationError
-from hwilib import commands, serializations
+from hwilib import commands
 from hwilib.devices import trezor, ledger, coldcard
 
-from junction import Wallet, JunctionError, Node
-from disk import get_wallets, ensure_datadir
-from utils import RPC, get_client_and_device, ClientGroup, get_device, get_nodes, hwi_lock
+from junction import Wallet, JunctionError, Node, GAP_LIMIT, DiscoveryMethods
+from disk import ensure_datadir
+from utils import BadRequest, RPC, get_client_and_device, ClientGroup, get_device, get_nodes, device_cache, device_locks
 from constants import ScriptTypes
+import schemas
+from snapshots import snapshots
+from refresh import refresher
+from psbts import LazyPSBT
+from registry import registry
+from address_pool import address_pool_filler
+from rescan import rescans
+from history import history_indexes, HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE
+from utxos import utxo_indexes
+from events import wallet_events
 
 import custom_coldcard
 import custom_trezor
@@ -19,6 +30,10 @@ schema = JsonSchema()
 logger = logging.getLogger(__name__)
 client_group = ClientGroup()
 
+# Devices signing at once for /sign-batch
+SIGNING_WORKERS = 8
+signing_executor = ThreadPoolExecutor(max_workers=SIGNING_WORKERS, thread_name_prefix='signing')
+
 @api.errorhandler(Exception)
 def handle_unexpected_error(error):
     status_code = 500
@@ -28,6 +43,12 @@ def handle_unexpected_error(error):
     logger.exception(error)
     return jsonify(response), status_code
 
+@api.errorhandler(BadRequest)
+def handle_bad_request(error):
+    return jsonify({
+        'error': str(error),
+    }), 400
+
 @api.errorhandler(JsonValidationError)
 def handle_validation_error(e):
     return jsonify({
@@ -39,21 +60,34 @@ def handle_validation_error(e):
 def before_request():
     ensure_datadir()
 
+### Query parameters
+
+def required_arg(args, name):
+    '''A query parameter the request can't do without'''
+    value = args.get(name)
+    if value is None:
+        raise BadRequest(f'Missing "{name}" query parameter')
+    return value
+
+def int_arg(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f'"{name}" query parameter must be an integer, not "{value}"')
+
 @api.route('/devices', methods=['GET'])
 def list_devices():
-    with hwi_lock:
-        return jsonify(commands.enumerate())
+    return jsonify(device_cache.enumerate())
 
 @api.route('/prompt', methods=['POST'])
-@schema.validate({
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-    },
-})
+@schema.validate(schemas.PROMPT_DEVICE)
 def prompt_device():
     client_group.close()
     wallet_name = request.json['wallet_name']
-    wallet = Wallet.open(wallet_name)
+    wallet = registry.get(wallet_name)
     client_group.prompt_pin(wallet.network)
     return jsonify({})  # FIXME: what to do here when there's nothing to return
 
@@ -64,12 +98,7 @@ def destroy_client():
     return jsonify({}), 200
 
 @api.route('/unlock', methods=['POST'])
-@schema.validate({
-    'properties': {
-        'pin': { 'type': 'string' },  # trezor
-        'password': { 'type': 'string' },  # bitbox
-    },
-})
+@schema.validate(schemas.UNLOCK_DEVICE)
 def unlock_device():
     '''Prompt every device that's plugged in'''
     # more validation
@@ -95,30 +124,20 @@ def unlock_device():
 @api.route('/wallets', methods=['GET'])
 def list_wallets():
     # TODO: does this include addresses?
-    wallets = get_wallets()
+    wallets = registry.all()
     # FIXME: probably shouldn't include xpubs in this response?
-    wallet_dicts = [wallet.to_dict(True) for wallet in wallets]
+    wallet_dicts = refresher.refresh(wallets)
     return jsonify(wallet_dicts)
 
+@api.route('/wallets/events', methods=['GET'])
+def stream_wallet_events():
+    '''Server-sent events with each wallet's changes, replacing GET /wallets polling'''
+    return Response(wallet_events.stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+    })
+
 @api.route('/wallets', methods=['POST'])
-@schema.validate({
-    'required': ['name', 'm', 'n', 'network', 'node'],
-    'properties': {
-        'name': { 'type': 'string' },
-        'm': { 'type': 'integer' },
-        'n': { 'type': 'integer' },
-        'network': { 'type': 'string' },
-        'node': {
-            'required': ['user', 'password', 'host', 'port'],
-            'properties': {
-                'user': { 'type': 'string' },
-                'password': { 'type': 'string' },
-                'host': { 'type': 'string' },
-                'port': { 'type': 'string' },
-            }
-        }
-    },
-})
+@schema.validate(schemas.CREATE_WALLET)
 def create_wallet():
     node_args = request.json.pop('node')
     node = Node(**node_args, wallet_name=request.json['name'], 
@@ -126,22 +145,24 @@ def create_wallet():
     # check that node is reachable
     node.default_rpc.test()
     wallet = Wallet.create(**request.json, node=node)
+    registry.add(wallet)
     return jsonify(wallet.to_dict(True))
 
 @api.route('/signers', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name', 'signer_name', 'device_id'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-        'signer_name': { 'type': 'string' },
-        'device_id': { 'type': 'string' },
-    },
-})
+@schema.validate(schemas.ADD_SIGNER)
 def add_signer():
     wallet_name = request.json['wallet_name']
     signer_name = request.json['signer_name']
     device_id = request.json['device_id']
-    wallet = Wallet.open(wallet_name)
+    with registry.editing(wallet_name) as wallet:
+        add_device_signer(wallet, signer_name, device_id)
+        wallet_dict = wallet.to_dict()
+    # start importing addresses as soon as the wallet is ready
+    address_pool_filler.request(wallet_name)
+    return jsonify(wallet_dict)
+
+def add_device_signer(wallet, signer_name, device_id):
+    '''Register the device's account xpub as a signer of wallet'''
     with get_client_and_device(device_id, wallet.network) as (client, device):
         derivation_path = wallet.account_derivation_path()
         # Get XPUB and validate against wallet.network 
@@ -152,96 +173,128 @@ def add_signer():
             raise JunctionError('Invalid xpub. Make sure your device is set to the correct chain.')
         client.close()
         wallet.add_signer(name=signer_name, fingerprint=device['fingerprint'], type=device['type'], xpub=xpub, derivation_path=derivation_path)
-    return jsonify(wallet.to_dict())
 
 @api.route('/address', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-    },
-})
+@schema.validate(schemas.ADDRESS)
 def address():
-    # TODO: it would be better to generate addresses ahead of time and store them on the wallet
-    # just not sure how to implement that
     wallet_name = request.json['wallet_name']
-    wallet = Wallet.open(wallet_name)
-    address = wallet.derive_receiving_address()
+    # addresses come from the pool of imported addresses when it has enough
+    with registry.editing(wallet_name) as wallet:
+        addresses = wallet.derive_receiving_addresses(request.json.get('count', 1))
+    address_pool_filler.request(wallet_name)
     return jsonify({
-        'address': address,
+        'address': addresses[0],
+        'addresses': addresses,
     })
 
 @api.route('/psbt', methods=['POST'])
-@schema.validate({
-    'required': ['outputs'],
-    'properties': {
-        'wallet_name': {'type': 'string'},
-        # todo: inputs, feerate, rbf, etc
-        'outputs': {
-            'type': 'array',
-            'items': {
-                'required': ['address', 'btc', 'subtract_fees'],
-                'properties': {
-                    'address': {'type': 'string'},   # FIXME: regex
-                    'btc': {'type': 'number'},      # FIXME: regex
-                    # 'satoshis': {'type': 'integer'},      # FIXME: regex
-                    'subtract_fees': { 'type': 'boolean' }
-                },
-            },
-        },
-    },
-})
+@schema.validate(schemas.CREATE_PSBT)
 def create_psbt():
     wallet_name = request.json['wallet_name']
-    wallet = Wallet.open(wallet_name)
-    api_outputs = request.json['outputs']
+    outputs, subtract_fees = parse_outputs(request.json['outputs'])
+    with registry.editing(wallet_name) as wallet:
+        txid = wallet.create_psbt(outputs, subtract_fees=subtract_fees)
+        psbt = wallet.psbt_store.get(txid)
+    address_pool_filler.request(wallet_name)
+    wallet_events.publish_later(wallet_name)
+    return jsonify({
+        'psbt': psbt.serialize(),
+        'txid': txid,
+    })
+
+def parse_outputs(api_outputs):
+    '''(outputs, subtract_fees) for Wallet.create_psbt from API outputs'''
     outputs = []
     for output in api_outputs:
         output_dict = {output['address']: output['btc']}
         outputs.append(output_dict)
     subtract_fees = [index for index, output in enumerate(api_outputs) 
                      if output['subtract_fees']]
-    wallet.create_psbt(outputs, subtract_fees=subtract_fees)
-    return jsonify({
-        'psbt': wallet.psbts[-1].serialize(),
-    })
+    return outputs, subtract_fees
 
 @api.route('/psbt', methods=['DELETE'])
-@schema.validate({
-    'required': ['wallet_name', 'index'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-        'index': { 'type': 'number' },
-    },
-})
+@schema.validate(schemas.ABANDON_PSBT)
 def abandon_psbt():
-    pass
+    '''Delete a PSBT and unlock the coins it reserved'''
+    wallet_name = request.json['wallet_name']
+    with registry.editing(wallet_name) as wallet:
+        wallet.remove_psbt(wallet.psbt_txid(request.json.get('txid'), request.json.get('index')))
+    wallet_events.publish_later(wallet_name)
+    return jsonify({})
+
+@api.route('/psbts', methods=['GET'])
+def list_psbts():
+    '''A wallet's decoded PSBTs, optionally only those with ?status= (unsigned, partially_signed, ready)'''
+    wallet = registry.get(required_arg(request.args, 'wallet_name'))
+    return jsonify(psbts_dict(wallet, request.args.get('status')))
+
+def psbts_dict(wallet, status=None):
+    return {
+        'psbts': [wallet.decode_psbt(wallet.psbt_store.get(txid)) for txid in wallet.psbt_store.txids(status)],
+    }
 
 @api.route('/sign', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name', 'device_id', 'index'],
-    'properties': {
-        # TODO: how to identify a specific psbt? index in wallet.psbts? Do they always have txids?
-        'wallet_name': { 'type': 'string' },
-        'device_id': { 'type': 'string' },  # FIXME: regex
-        'index': { 'type': 'number' },
-    },
-})
+@schema.validate(schemas.SIGN_PSBT)
 def sign_psbt():
     wallet_name = request.json['wallet_name']
-    wallet = Wallet.open(wallet_name)
     fingerprint = request.json['device_id']
-    index = request.json['index']
-    old_psbt = wallet.psbts[index]
-    with get_client_and_device(fingerprint, wallet.network) as (client, device):
-        raw_signed_psbt = client.sign_tx(old_psbt)['psbt']
-    new_psbt = serializations.PSBT()
-    new_psbt.deserialize(raw_signed_psbt)
-    wallet.update_psbt(new_psbt, index)
+    txid = registry.get(wallet_name).psbt_txid(request.json.get('txid'), request.json.get('index'))
+    new_psbt = sign_with_device(wallet_name, fingerprint, txid)
+    wallet_events.publish_later(wallet_name)
     return jsonify({
         'psbt': new_psbt.serialize(),
     })
 
+def sign_with_device(wallet_name, device_id, txid):
+    '''Sign one of a wallet's PSBTs with a device and save the result'''
+    wallet = registry.get(wallet_name)
+    raw_signed_psbt = sign_on_device(wallet.network, device_id, wallet.psbt_store.get(txid).serialize())
+    # the wallet stays free for other requests while the device waits on a button press
+    with registry.editing(wallet_name) as wallet:
+        return wallet.update_psbt(LazyPSBT(raw_signed_psbt), txid)
+
+@api.route('/sign-batch', methods=['POST'])
+@schema.validate(schemas.SIGN_PSBT_BATCH)
+def sign_psbt_batch():
+    wallet_name = request.json['wallet_name']
+    txid = registry.get(wallet_name).psbt_txid(request.json.get('txid'), request.json.get('index'))
+    new_psbt, errors = sign_with_devices(wallet_name, request.json['device_ids'], txid)
+    wallet_events.publish_later(wallet_name)
+    return jsonify({
+        'psbt': new_psbt.serialize(),
+        'errors': errors,
+    })
+
+def sign_with_devices(wallet_name, device_ids, txid):
+    '''Sign a PSBT on several devices at once, then merge their signatures and save once
+
+    Returns the merged PSBT and {device_id: error} for devices that didn't sign.
+    '''
+    wallet = registry.get(wallet_name)
+    raw_psbt = wallet.psbt_store.get(txid).serialize()
+    jobs = {device_id: signing_executor.submit(sign_on_device, wallet.network, device_id, raw_psbt)
+            for device_id in dict.fromkeys(device_ids)}
+
+    signed, errors = [], {}
+    for device_id, job in jobs.items():
+        try:
+            signed.append(job.result())
+        except Exception as e:
+            logger.info(f'{device_id} did not sign: {e}')
+            errors[device_id] = str(e)
+    if not signed:
+        raise JunctionError(f'No device signed: {errors}')
+
+    # Devices were waiting on button presses without the wallet lock, so merge into whatever is saved now
+    with registry.editing(wallet_name) as wallet:
+        return wallet.combine_psbt(signed, txid), errors
+
+def sign_on_device(network, device_id, raw_psbt):
+    '''raw_psbt (base64) signed by a device'''
+    with get_client_and_device(device_id, network) as (client, device):
+        # sign_tx changes the PSBT it's given, so every device gets its own
+        return client.sign_tx(LazyPSBT(raw_psbt).parse())['psbt']
+
 @api.route('/nodes')
 def list_nodes():
     nodes = get_nodes()
@@ -252,82 +305,119 @@ def list_nodes():
 
 
 @api.route('/nodes', methods=['PUT'])
-@schema.validate({
-    'required': ['wallet_name', 'user', 'password', 'host', 'port'],
-    'properties': {
-        'wallet_name': {'type': 'string'},
-        'user': {'type': 'string'},
-        'password': {'type': 'string'},
-        'host': {'type': 'string'},
-        'port': {'type': 'string'},
-    },
-})
+@schema.validate(schemas.UPDATE_NODE)
 def update_node():
     wallet_name = request.json.pop('wallet_name')
-    wallet = Wallet.open(wallet_name)
     node_params = request.json
-
-    node = Node(**node_params, wallet_name=wallet.name, network=wallet.network)
-    node.default_rpc.test()
-    wallet.node = node
-    wallet.save()
+    with registry.editing(wallet_name) as wallet:
+        node = Node(**node_params, wallet_name=wallet.name, network=wallet.network)
+        node.default_rpc.test()
+        wallet.set_node(node)
     return jsonify({})
 
 @api.route('/sync', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name'],
-    'properties': {
-        'wallet_name': {'type': 'string'},
-    },
-})
+@schema.validate(schemas.SYNC)
 def sync():
     wallet_name = request.json['wallet_name']
-    wallet = Wallet.open(wallet_name)
-    wallet.sync()
+    ranged = request.json.get('ranged', True)
+    wallet = registry.get(wallet_name)
+    wallet.sync(ranged=ranged)
+    # imports don't touch the wallet file, but change what "synced" reports
+    snapshots.invalidate(wallet.name)
     return jsonify({})
 
+@api.route('/discover', methods=['POST'])
+@schema.validate(schemas.DISCOVER)
+def discover():
+    '''Find addresses used beyond the wallet's indices, e.g. after a restore'''
+    wallet_name = request.json['wallet_name']
+    gap_limit = request.json.get('gap_limit', GAP_LIMIT)
+    method = request.json.get('method', DiscoveryMethods.SCANTXOUTSET)
+    with registry.editing(wallet_name) as wallet:
+        indices = wallet.discover(gap_limit=gap_limit, method=method)
+    return jsonify(indices)
+
+@api.route('/rescan', methods=['POST'])
+@schema.validate(schemas.RESCAN)
+def start_rescan():
+    '''Rescan blocks in the background, by default those since the wallet was created'''
+    wallet_name = request.json['wallet_name']
+    status = rescans.start(wallet_name, request.json.get('start'), request.json.get('stop'))
+    return jsonify(status)
+
+@api.route('/rescan', methods=['GET'])
+def rescan_status():
+    wallet_name = required_arg(request.args, 'wallet_name')
+    return jsonify(rescans.status(wallet_name))
+
 @api.route('/utxos', methods=['GET'])
 def list_utxos():
-    # FIXME: display utxos across all wallets, or per-wallet?
-    raise NotImplementedError()
+    '''A wallet's unspent coins and balances, from its UTXO index'''
+    wallet = registry.get(required_arg(request.args, 'wallet_name'))
+    return jsonify(utxos_dict(wallet))
+
+def utxos_dict(wallet):
+    index = utxo_indexes.get(wallet)
+    unconfirmed, confirmed = index.balances()
+    return {
+        'utxos': index.coins(),
+        'balances': {
+            'confirmed': confirmed,
+            'unconfirmed': unconfirmed,
+        },
+        'cursor': index.lastblock,
+    }
 
 @api.route('/transactions', methods=['GET'])
 def list_transactions():
-    # FIXME: display transactions across all wallets, or per-wallet?
-    raise NotImplementedError()
+    '''A page of a wallet's history, newest first, or what changed since a "cursor" block hash'''
+    wallet = registry.get(required_arg(request.args, 'wallet_name'))
+    return jsonify(transactions_page(wallet, request.args))
+
+def transactions_page(wallet, args):
+    '''/transactions response for query args: skip and count, or since'''
+    index = history_indexes.get(wallet)
+    since = args.get('since')
+    if since:
+        transactions, removed, cursor = index.changes(wallet.node.wallet_rpc, since)
+        return {
+            'transactions': transactions,
+            'removed': removed,
+            'cursor': cursor,
+        }
+    skip = max(int_arg(args, 'skip', 0), 0)
+    count = min(max(int_arg(args, 'count', HISTORY_PAGE_SIZE), 0), HISTORY_MAX_PAGE_SIZE)
+    return {
+        'transactions': index.page(skip, count),
+        'total': index.total(),
+        'cursor': index.lastblock,
+    }
 
 @api.route('/broadcast', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name', 'index'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-        'index': { 'type': 'number' },
-    },
-})
+@schema.validate(schemas.BROADCAST)
 def broadcast():
     wallet_name = request.json['wallet_name']
-    index = request.json['index']
-    wallet = Wallet.open(wallet_name)
-    txid = wallet.broadcast(index)
+    with registry.editing(wallet_name) as wallet:
+        txid = wallet.broadcast(wallet.psbt_txid(request.json.get('txid'), request.json.get('index')))
+    wallet_events.publish_later(wallet_name)
     return jsonify({
         'txid': txid,
     })
 
 @api.route('/display-address', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name', 'address', 'device_id'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-        'address': { 'type': 'string' },
-        'device_id': { 'type': 'string' },
-    },
-})
+@schema.validate(schemas.DISPLAY_ADDRESS)
 def display_address():
     wallet_name = request.json['wallet_name']
     address = request.json['address']
     device_id = request.json['device_id']
-    wallet = Wallet.open(wallet_name)
+    wallet = registry.get(wallet_name)
+    display_address_on_device(wallet, address, device_id)
+    return jsonify({
+        'ok': True
+    })
 
+def display_address_on_device(wallet, address, device_id):
+    '''Show one of wallet's addresses on a device's screen'''
     device = get_device(device_id)
 
     address_info = wallet.node.wallet_rpc.getaddressinfo(address)
@@ -360,11 +450,11 @@ def display_address():
                 else:
                     derivation_path = path
            
-            with hwi_lock:
+            with device_locks.holding(device):
                 custom_trezor.display_multisig_address(redeem_script, derivation_path, wallet.network != 'mainnet', device, wallet.script_type)
         # Handle ColdCards
         elif device['type'] == 'coldcard':
-            with hwi_lock:
+            with device_locks.holding_coldcards(device):
                 custom_coldcard.display_multisig_address(redeem_script, derivation_paths, wallet.script_type == 'native')
         # Reject everything else
         else:
@@ -372,38 +462,29 @@ def display_address():
     # HWI covers single-sig
     else:
         with get_client_and_device(device_id, wallet.network) as (client, device):
-            with hwi_lock:
-                commands.displayaddress(client, desc=descriptor)
-    
-    return jsonify({
-        'ok': True
-    })
+            commands.displayaddress(client, desc=descriptor)
 
 @api.route('/register-device', methods=['POST'])
-@schema.validate({
-    'required': ['wallet_name', 'device_id'],
-    'properties': {
-        'wallet_name': { 'type': 'string' },
-        'device_id': { 'type': 'string' },
-    },
-})
+@schema.validate(schemas.REGISTER_DEVICE)
 def register_device():
     wallet_name = request.json['wallet_name']
     device_id = request.json['device_id']
-    wallet = Wallet.open(wallet_name)
+    wallet = registry.get(wallet_name)
+    register_multisig_on_device(wallet, device_id)
+    return jsonify({'ok': True})
 
+def register_multisig_on_device(wallet, device_id):
+    '''Enroll wallet's multisig policy on a ColdCard'''
     device = get_device(device_id)
 
     fingerprints = [signer.fingerprint for signer in wallet.signers]
     if device['fingerprint'] not in fingerprints:
-        raise JunctionError(f'No device with fingerprint {device["fingerprint"]} present in wallet {wallet_name}')
+        raise JunctionError(f'No device with fingerprint {device["fingerprint"]} present in wallet {wallet.name}')
 
     if device['type'] != 'coldcard':
         raise JunctionError(f'Devices of type {device["type"]} do not support multisig wallet registration')
 
-    with hwi_lock:
+    with device_locks.holding_coldcards(device):
         custom_coldcard.enroll(wallet)
 
     # TODO: How to keep track of whether or not this multisig wallet is registered on the coldcard?
-
-    return jsonify({'ok': True})
@@ -0,0 +1,180 @@
+'''
+Non-blocking JSON-RPC client for bitcoind, for the asyncio server
+
+Mirrors utils.RPC: rpc.getblockcount() style calls (awaited) and batches,
+over keep-alive HTTP/1.1 connections made with asyncio streams.
+'''
+import asyncio
+import base64
+import json
+import urllib.parse
+from decimal import Decimal
+
+from utils import JSONRPCException, EncodeDecimal, JunctionError, rpc_ids
+
+# Idle keep-alive connections kept per AsyncRPC
+ASYNC_RPC_POOL_SIZE = 8
+
+class AsyncRPC:
+
+    def __init__(self, uri, timeout=30):
+        self.uri = uri
+        self.timeout = timeout
+        url = urllib.parse.urlparse(uri)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path
+        authpair = f'{url.username}:{url.password}'.encode('utf8')
+        self.auth = 'Basic ' + base64.b64encode(authpair).decode()
+        # idle (reader, writer) pairs
+        self.idle = []
+
+    def __getattr__(self, name):
+        '''await rpc.getblockchaininfo() style calls'''
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        async def call(*params):
+            return await self.call(name, *params)
+        return call
+
+    async def call(self, method, *params):
+        request = {'version': '1.1', 'id': next(rpc_ids), 'method': method, 'params': list(params)}
+        response = await self.post(request)
+        if response.get('error') is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+        return response['result']
+
+    async def batch(self, calls):
+        '''Results of (method, params) pairs sent as one JSON-RPC array, raising the first error'''
+        requests = [{'jsonrpc': '2.0', 'id': next(rpc_ids), 'method': method, 'params': list(params)}
+                    for method, params in calls]
+        responses = await self.post(requests)
+        if not isinstance(responses, list):
+            raise JSONRPCException(responses.get('error') or {'code': -342, 'message': 'invalid batch response'})
+        by_id = {response.get('id'): response for response in responses}
+        results = []
+        for request in requests:
+            response = by_id.get(request['id'], {'error': {'code': -343, 'message': 'missing JSON-RPC response'}})
+            if response.get('error') is not None:
+                raise JSONRPCException(response['error'])
+            results.append(response.get('result'))
+        return results
+
+    async def post(self, payload):
+        '''POST a JSON payload, retrying once if bitcoind closed a kept-alive connection'''
+        body = json.dumps(payload, default=EncodeDecimal).encode('utf8')
+        reader, writer, reused = await self.acquire()
+        try:
+            status, reason, headers, data = await asyncio.wait_for(
+                self.exchange(reader, writer, body), self.timeout)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if not reused:
+                raise
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            try:
+                status, reason, headers, data = await asyncio.wait_for(
+                    self.exchange(reader, writer, body), self.timeout)
+            except:
+                writer.close()
+                raise
+        except:
+            writer.close()
+            raise
+
+        if headers.get('connection', '').lower() == 'close' or len(self.idle) >= ASYNC_RPC_POOL_SIZE:
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+
+        if status == 401:
+            raise JSONRPCException({'code': -342, 'message': 'Unauthorized'})
+        if headers.get('content-type') != 'application/json':
+            raise JSONRPCException({'code': -342, 'message': f'non-JSON HTTP response with \'{status} {reason}\' from server'})
+        return json.loads(data.decode('utf8'), parse_float=Decimal)
+
+    async def acquire(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        return reader, writer, False
+
+    async def exchange(self, reader, writer, body):
+        '''Write one HTTP/1.1 request and read its response'''
+        head = (f'POST {self.path} HTTP/1.1\r\n'
+                f'Host: {self.host}\r\n'
+                f'Authorization: {self.auth}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('bitcoind closed the connection')
+        _, status, reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await reader.readexactly(int(headers.get('content-length', 0)))
+        return int(status), reason, headers, data
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+    async def test(self):
+        '''Same checks as utils.RPC.test, without blocking the event loop'''
+        rpc = AsyncRPC(self.uri, timeout=0.5)
+        try:
+            await self.check(rpc)
+        finally:
+            await rpc.close()
+
+    async def check(self, rpc):
+        # Test RPC connection works
+        try:
+            await rpc.getblockchaininfo()
+        except (OSError, asyncio.TimeoutError):
+            raise JunctionError("ConnectionRefusedError: check https://bitcoin.stackexchange.com/questions/74337/testnet-bitcoin-connection-refused-111")
+        except JSONRPCException as e:
+            if "Unauthorized" in str(e):
+                raise JunctionError("Please double-check your credentials!")
+
+        # Check node version requirements are met
+        version = (await rpc.getnetworkinfo())['version']
+        if int(version) < 180000:
+            raise JunctionError("Update your Bitcoin node to at least version 0.18")
+
+        # Check wallet enabled
+        try:
+            await rpc.getwalletinfo()
+        except JSONRPCException as e:
+            if "Method not found" in str(e):
+                raise JunctionError("Junction requires 'disablewallet=0' in your bitcoin.conf")
+
+    async def error(self):
+        try:
+            return await self.test()
+        except JunctionError as e:
+            return str(e)
@@ -6,3 +6,8 @@ class Networks:
 class ScriptTypes:
     WRAPPED = 'wrapped'
     NATIVE = 'native'
+
+class PSBTStatuses:
+    UNSIGNED = 'unsigned'
+    PARTIALLY_SIGNED = 'partially_signed'
+    READY = 'ready'
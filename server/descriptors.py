@@ -0,0 +1,207 @@
+'''
+Output descriptor checksums and address encoding, computed without Bitcoin Core
+
+Checksum algorithm from BIP380, bech32 from BIP173 (both adapted from the reference code).
+'''
+from hashlib import sha256
+from btclib import base58
+from btclib.utils import h160
+
+from constants import Networks, ScriptTypes
+
+### Descriptor checksums
+
+INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
+CHECKSUM_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+CHECKSUM_GENERATOR = [0xf5dee51989, 0xa9fdca3312, 0x1bab10e32d, 0x3706b1677a, 0x644d626ffd]
+
+def descriptor_polymod(symbols):
+    chk = 1
+    for value in symbols:
+        top = chk >> 35
+        chk = (chk & 0x7ffffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= CHECKSUM_GENERATOR[i] if ((top >> i) & 1) else 0
+    return chk
+
+def descriptor_expand(descriptor):
+    groups = []
+    symbols = []
+    for c in descriptor:
+        v = INPUT_CHARSET.find(c)
+        if v == -1:
+            raise ValueError(f'Invalid character "{c}" in descriptor')
+        symbols.append(v & 31)
+        groups.append(v >> 5)
+        if len(groups) == 3:
+            symbols.append(groups[0] * 9 + groups[1] * 3 + groups[2])
+            groups = []
+    if len(groups) == 1:
+        symbols.append(groups[0])
+    elif len(groups) == 2:
+        symbols.append(groups[0] * 3 + groups[1])
+    return symbols
+
+def descriptor_checksum(descriptor):
+    '''8 character checksum Bitcoin Core expects after "#"'''
+    symbols = descriptor_expand(descriptor) + [0] * 8
+    checksum = descriptor_polymod(symbols) ^ 1
+    return ''.join(CHECKSUM_CHARSET[(checksum >> (5 * (7 - i))) & 31] for i in range(8))
+
+def add_checksum(descriptor):
+    '''Equivalent of getdescriptorinfo(descriptor)['descriptor'] for our descriptors'''
+    descriptor = descriptor.split('#')[0]
+    return f'{descriptor}#{descriptor_checksum(descriptor)}'
+
+### Address encoding
+
+ADDRESS_PARAMS = {
+    Networks.MAINNET: {'hrp': 'bc', 'p2sh': b'\x05', 'p2pkh': b'\x00'},
+    Networks.TESTNET: {'hrp': 'tb', 'p2sh': b'\xc4', 'p2pkh': b'\x6f'},
+    Networks.REGTEST: {'hrp': 'bcrt', 'p2sh': b'\xc4', 'p2pkh': b'\x6f'},
+}
+
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32_GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+
+def bech32_polymod(values):
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= BECH32_GENERATOR[i] if ((top >> i) & 1) else 0
+    return chk
+
+def bech32_hrp_expand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+def convert_bits(data, frombits, tobits):
+    '''Regroup bits, padding the final group (only used for encoding)'''
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if bits:
+        ret.append((acc << (tobits - bits)) & maxv)
+    return ret
+
+def segwit_address(witness_program, network):
+    '''bech32 address of a version 0 witness program'''
+    hrp = ADDRESS_PARAMS[network]['hrp']
+    data = [0] + convert_bits(witness_program, 8, 5)
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0] * 6) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+def p2sh_address(redeem_script, network):
+    return base58_address(ADDRESS_PARAMS[network]['p2sh'], h160(redeem_script))
+
+def base58_address(version, script_hash):
+    address = base58.encode_check(version + script_hash)
+    return address.decode() if isinstance(address, bytes) else address
+
+def script_address(script, network):
+    '''(type, address) of an output script, named as Bitcoin Core does. address is None if it has none.'''
+    if len(script) in (22, 34) and script[0] == OP_0 and script[1] == len(script) - 2:
+        script_type = 'witness_v0_keyhash' if len(script) == 22 else 'witness_v0_scripthash'
+        return script_type, segwit_address(script[2:], network)
+    if len(script) == 23 and script[:2] == bytes([OP_HASH160, 20]) and script[-1] == OP_EQUAL:
+        return 'scripthash', base58_address(ADDRESS_PARAMS[network]['p2sh'], script[2:22])
+    if len(script) == 25 and script[:3] == bytes([OP_DUP, OP_HASH160, 20]) and script[-2:] == bytes([OP_EQUALVERIFY, OP_CHECKSIG]):
+        return 'pubkeyhash', base58_address(ADDRESS_PARAMS[network]['p2pkh'], script[3:23])
+    return 'nonstandard', None
+
+### Scripts
+
+OP_0 = 0x00
+OP_DUP = 0x76
+OP_HASH160 = 0xa9
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+def push_int(n):
+    '''Minimal encoding of a small number, like CScript() << n'''
+    if 1 <= n <= 16:
+        return bytes([0x50 + n])
+    return bytes([1, n])
+
+def push_data(data):
+    assert len(data) < 0x4c, 'Only direct pushes supported'
+    return bytes([len(data)]) + data
+
+def multisig_script(m, pubkeys):
+    '''m-of-n CHECKMULTISIG script, keys used in the order given'''
+    script = push_int(m)
+    for pubkey in pubkeys:
+        script += push_data(pubkey)
+    script += push_int(len(pubkeys)) + bytes([OP_CHECKMULTISIG])
+    return script
+
+def read_int(script, i):
+    '''(number, position after it) of a push_int() at script[i], or (None, i) if there isn't one'''
+    if i < len(script) and 0x51 <= script[i] <= 0x60:
+        return script[i] - 0x50, i + 1
+    # 17 and up are pushed as one byte of data
+    if i + 1 < len(script) and script[i] == 1 and script[i + 1] > 16:
+        return script[i + 1], i + 2
+    return None, i
+
+def multisig_pubkeys(script):
+    '''(m, pubkeys) of a CHECKMULTISIG script, or None if it isn't one'''
+    if len(script) < 3 or script[-1] != OP_CHECKMULTISIG:
+        return None
+    m, i = read_int(script, 0)
+    if m is None:
+        return None
+    pubkeys = []
+    while i < len(script) - 1 and script[i] in (33, 65):
+        pubkeys.append(script[i + 1:i + 1 + script[i]])
+        i += 1 + script[i]
+    n, i = read_int(script, i)
+    if n != len(pubkeys) or i != len(script) - 1:
+        return None
+    return m, pubkeys
+
+def p2wsh_script(witness_script):
+    return bytes([OP_0]) + push_data(sha256(witness_script).digest())
+
+def p2wpkh_script(pubkey):
+    return bytes([OP_0]) + push_data(h160(pubkey))
+
+def p2sh_script(redeem_script):
+    return bytes([OP_HASH160]) + push_data(h160(redeem_script)) + bytes([OP_EQUAL])
+
+def witness_program(m, pubkeys):
+    '''P2WSH multisig or P2WPKH output script for SEC pubkeys (bytes)'''
+    if len(pubkeys) > 1:
+        return p2wsh_script(multisig_script(m, pubkeys))
+    return p2wpkh_script(pubkeys[0])
+
+def script_pubkey(script_type, m, pubkeys):
+    '''Output script of a wallet script built from hex SEC pubkeys, as scantxoutset reports it'''
+    program = witness_program(m, [bytes.fromhex(pubkey) for pubkey in pubkeys])
+    if script_type == ScriptTypes.NATIVE:
+        return program
+    elif script_type == ScriptTypes.WRAPPED:
+        return p2sh_script(program)
+    else:
+        raise ValueError(f'Unknown script type "{script_type}"')
+
+def address(script_type, m, pubkeys, network):
+    '''Address of a wallet script built from hex SEC pubkeys (already BIP67-sorted for multisig)'''
+    program = witness_program(m, [bytes.fromhex(pubkey) for pubkey in pubkeys])
+    if script_type == ScriptTypes.NATIVE:
+        return segwit_address(program[2:], network)
+    elif script_type == ScriptTypes.WRAPPED:
+        return p2sh_address(program, network)
+    else:
+        raise ValueError(f'Unknown script type "{script_type}"')
@@ -1,6 +1,8 @@
 import json
+import tempfile
 from shutil import copyfile
 from os import listdir
+import os
 import os.path
 
 DATADIR = os.path.join(os.path.expanduser("~"), ".junction/")
@@ -9,10 +11,40 @@ def full_path(relative_path):
     return os.path.join(DATADIR, relative_path)
 
 def write_json_file(data, relative_path):
+    '''Replace the file atomically: readers and crashes see the old contents or the new, never a mix'''
     path = full_path(relative_path)
+    directory = os.path.dirname(path)
     serialized = json.dumps(data, indent=4, sort_keys=True)
-    with open(path, 'w') as f:
-        f.write(serialized)
+
+    # Temp file in the same directory, so the rename can't cross filesystems
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(serialized)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+
+def fsync_directory(directory):
+    '''Make a rename within directory durable'''
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # e.g. Windows, which can't open directories
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def file_signature(relative_path):
+    '''Changes whenever the file is rewritten'''
+    stat = os.stat(full_path(relative_path))
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 def read_json_file(relative_path):
     path = full_path(relative_path)
@@ -29,22 +61,17 @@ def ensure_datadir():
         # make wallets directory inside datadir
         os.mkdir(wallet_dir)
 
+def json_file_names(relative_dir):
+    '''Names (without ".json") of the JSON files in a datadir directory'''
+    names = []
+    for file_name in os.listdir(full_path(relative_dir)):
+        # skip temp files left by an interrupted write_json_file
+        if file_name.startswith('.'):
+            continue
+        names.append(file_name.split('.')[0])
+    return names
+
 def get_wallet_names():
-    wallet_names = []
-    wallets_dir = os.path.join(DATADIR, 'wallets')
-    wallet_files = os.listdir(wallets_dir)
-    for wallet_file in wallet_files:
-        wallet_name = wallet_file.split('.')[0]
-        wallet_names.append(wallet_name)
-    return wallet_names
-
-def get_wallets():
-    from junction import Wallet  # FIXME: circular imports
-    wallets = []
-    wallet_names = get_wallet_names()
-    for wallet_name in wallet_names:
-        wallet = Wallet.open(wallet_name, ensure_watchonly=False)
-        wallets.append(wallet)
-    return wallets
+    return json_file_names('wallets')
 
 
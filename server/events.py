@@ -0,0 +1,192 @@
+'''
+Push wallet changes to clients as server-sent events (GET /wallets/events)
+
+A client gets a "snapshot" event with each wallet's balances, coins, history and
+PSBTs, then a "diff" event whenever one of those changes: new or changed records
+under "updated", keys of the ones that went away under "removed". Wallets are
+recomputed when their node sees a new block or transaction, or when a request
+changes their PSBTs, and only while someone is listening. Applying an event
+twice is harmless, so a client never has to worry about one it already has.
+'''
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson
+
+from history import entry_key
+from registry import registry
+from snapshots import snapshots
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments on an idle stream
+HEARTBEAT_INTERVAL = 15
+
+# Events a client can fall behind by before its stream is closed (it then reconnects)
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Sent on idle streams so proxies don't time them out
+KEEPALIVE = ': keepalive\n\n'
+
+# Per field: key identifying a record, so lists can be diffed record by record
+RECORD_KEYS = {
+    'coins': lambda coin: [coin['txid'], coin['vout']],
+    'history': lambda entry: list(entry_key(entry)),
+    'psbts': lambda psbt: psbt['tx']['txid'],
+}
+
+def sse(event, data):
+    '''One server-sent event'''
+    return f'event: {event}\ndata: {simplejson.dumps(data)}\n\n'
+
+def wallet_state(snapshot):
+    '''The fields we push, from a Wallet.to_dict(True) snapshot'''
+    return {field: snapshot[field] for field in ['balances', *RECORD_KEYS]}
+
+def diff_records(old, new, key):
+    '''{"updated", "removed"} turning the old list of records into the new one'''
+    old = {simplejson.dumps(key(record)): record for record in old}
+    new = {simplejson.dumps(key(record)): record for record in new}
+    return {
+        'updated': [record for k, record in new.items() if old.get(k) != record],
+        'removed': [key(record) for k, record in old.items() if k not in new],
+    }
+
+def diff_states(old, new):
+    '''Fields of new that differ from old, lists as diff_records'''
+    diff = {}
+    if old['balances'] != new['balances']:
+        diff['balances'] = new['balances']
+    for field, key in RECORD_KEYS.items():
+        records = diff_records(old[field], new[field], key)
+        if records['updated'] or records['removed']:
+            diff[field] = records
+    return diff
+
+class Subscriber:
+    '''Events waiting to be sent to one client'''
+
+    def __init__(self, wakeup=None):
+        self.events = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        # called from whichever thread queued an event, e.g. to wake an event loop
+        self.wakeup = wakeup
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            # its next connection starts from a fresh snapshot
+            self.closed = True
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def get(self, timeout):
+        '''Next event, or KEEPALIVE if none arrived in time'''
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return KEEPALIVE
+
+    def drain(self):
+        '''Every event queued so far'''
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+class WalletEvents:
+
+    def __init__(self):
+        # wallet name -> state last sent to subscribers
+        self.states = {}
+        self.subscribers = set()
+        # recomputes wallets changed by API requests, off the request path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='wallet-events')
+        self.lock = threading.Lock()
+
+    def subscribe(self, wakeup=None):
+        subscriber = Subscriber(wakeup)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                # nobody to diff against, so don't keep states going stale
+                self.states.clear()
+
+    def snapshot_events(self):
+        '''A "snapshot" event for every wallet, as diffs sent from now on will assume'''
+        events = []
+        for wallet in registry.all():
+            with self.lock:
+                state = self.states.get(wallet.name)
+            if state is None:
+                state = self.compute(wallet)
+                if state is None:
+                    continue
+                with self.lock:
+                    state = self.states.setdefault(wallet.name, state)
+            events.append(sse('snapshot', dict(state, wallet_name=wallet.name)))
+        return events
+
+    def compute(self, wallet):
+        '''Wallet's current state, or None if its node can't tell us'''
+        snapshot = snapshots.get(wallet)
+        if snapshot['node']['rpc_error']:
+            return None
+        return wallet_state(snapshot)
+
+    def publish(self, wallet):
+        '''Send subscribers what changed in wallet since they last heard'''
+        with self.lock:
+            if not self.subscribers:
+                return
+        state = self.compute(wallet)
+        if state is None:
+            return
+        # diffs go out in the order their states were stored
+        with self.lock:
+            old = self.states.get(wallet.name)
+            self.states[wallet.name] = state
+            if old is None:
+                event = sse('snapshot', dict(state, wallet_name=wallet.name))
+            else:
+                diff = diff_states(old, state)
+                if not diff:
+                    return
+                event = sse('diff', dict(diff, wallet_name=wallet.name))
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+
+    def publish_later(self, wallet_name):
+        '''publish() a wallet a request just changed, on a background thread'''
+        with self.lock:
+            if not self.subscribers:
+                return
+        self.executor.submit(self.publish_by_name, wallet_name)
+
+    def publish_by_name(self, wallet_name):
+        try:
+            self.publish(registry.get(wallet_name, ensure_watchonly=False))
+        except Exception as e:
+            logger.info(f'Could not publish "{wallet_name}" changes: {e}')
+
+    def stream(self):
+        '''Server-sent event text for one client, until it disconnects or falls behind'''
+        subscriber = self.subscribe()
+        try:
+            yield from self.snapshot_events()
+            while not subscriber.closed:
+                yield subscriber.get(HEARTBEAT_INTERVAL)
+        finally:
+            self.unsubscribe(subscriber)
+
+wallet_events = WalletEvents()
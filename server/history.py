@@ -0,0 +1,86 @@
+'''
+Local index of each wallet's transactions, kept current with listsinceblock
+
+The first update fetches the whole history. After that, only transactions in
+blocks since the last one seen (plus the mempool) cross the RPC connection, so
+loading a page of a busy wallet's history doesn't get slower as it grows.
+'''
+from indexes import SinceBlockIndex, WalletIndexes
+
+# Transactions per page unless the client asks for another size
+HISTORY_PAGE_SIZE = 100
+
+# Largest page a client can ask for
+HISTORY_MAX_PAGE_SIZE = 1000
+
+def entry_key(entry):
+    '''listtransactions-style entries are per transaction output and direction'''
+    return (entry['txid'], entry.get('vout'), entry['category'])
+
+def newest_first(entry):
+    # unconfirmed first, then by block, then by time within a block
+    return (-entry.get('blockheight', float('inf')), -entry.get('time', 0), entry['txid'])
+
+def same_entry(previous, entry):
+    '''Whether entry tells us nothing new'''
+    if previous is None:
+        return False
+    # confirmed entries' confirmation counts are recomputed when served
+    if 'blockheight' in entry:
+        return dict(previous, confirmations=None) == dict(entry, confirmations=None)
+    return previous == entry
+
+class HistoryIndex(SinceBlockIndex):
+
+    def __init__(self):
+        super().__init__()
+        # entry_key -> entry, confirmed ones carrying "blockheight"
+        self.entries = {}
+        # entries, newest first, rebuilt only when something changed
+        self.ordered = []
+
+    def load(self, wallet):
+        # the first listsinceblock, from genesis, fetches the whole history
+        self.entries, self.ordered = {}, []
+        self.lastblock, self.height = '', 0
+
+    def apply(self, rpc, entries, height):
+        # Mempool transactions are always reported again, so start from confirmed ones
+        kept = {key: entry for key, entry in self.entries.items() if 'blockheight' in entry}
+        changed = len(kept) != len(self.entries)
+        for entry in entries:
+            key = entry_key(entry)
+            if not same_entry(self.entries.get(key), entry):
+                changed = True
+            kept[key] = entry
+
+        self.entries = kept
+        if changed:
+            self.ordered = sorted(kept.values(), key=newest_first)
+
+    def with_confirmations(self, entry):
+        '''Entry with its confirmation count as of the last update'''
+        if 'blockheight' not in entry:
+            return entry
+        return dict(entry, confirmations=self.height - entry['blockheight'] + 1)
+
+    def page(self, skip=0, count=HISTORY_PAGE_SIZE):
+        '''count entries, newest first, after skipping skip of them'''
+        with self.lock:
+            return [self.with_confirmations(entry) for entry in self.ordered[skip:skip + count]]
+
+    def total(self):
+        with self.lock:
+            return len(self.ordered)
+
+    def changes(self, rpc, since):
+        '''(entries, removed txids, new cursor) since block hash "since", as listsinceblock reports them'''
+        with self.lock:
+            if since == self.lastblock:
+                # client is up to date: only the mempool can have changed
+                return [entry for entry in self.ordered if 'blockheight' not in entry], [], self.lastblock
+        result = rpc.listsinceblock(since, 1, True, True)
+        removed = sorted({entry['txid'] for entry in result.get('removed', [])})
+        return result['transactions'], removed, result['lastblock']
+
+history_indexes = WalletIndexes(HistoryIndex)
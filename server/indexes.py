@@ -0,0 +1,88 @@
+'''
+Per-wallet indexes kept current with listsinceblock
+
+An index remembers the tip it last synced to. Each update asks for the
+transactions since that tip (plus the mempool) and hands them to the index's
+apply(). If the tip is no longer on the main chain, the index starts over with
+load() instead, so reorged out transactions can't linger.
+'''
+import threading
+
+from utils import JSONRPCException, node_key
+
+class SinceBlockIndex:
+
+    def __init__(self):
+        # tip we last synced to (None before the first update, '' for "from genesis"), and its height
+        self.lastblock = None
+        self.height = 0
+        self.lock = threading.Lock()
+
+    def update(self, wallet):
+        '''Apply what changed since the last update, starting over after a reorg'''
+        with self.lock:
+            if self.lastblock is None or not self.apply_delta(wallet):
+                self.load(wallet)
+                self.apply_delta(wallet)
+
+    def apply_delta(self, wallet):
+        '''Apply listsinceblock since our last tip. False if that tip is no longer on the main chain.'''
+        rpc = wallet.node.wallet_rpc
+        batch = rpc.batch()
+        main_chain_block = batch.getblockhash(self.height) if self.lastblock else None
+        since = batch.listsinceblock(self.lastblock, 1, True)
+        height = batch.getblockcount()
+        batch.send()
+        if main_chain_block is not None:
+            try:
+                if main_chain_block.result() != self.lastblock:
+                    return False
+            except JSONRPCException:
+                # chain is now shorter than it was
+                return False
+        since, height = since.result(), height.result()
+
+        entries = []
+        for entry in since['transactions']:
+            entry = dict(entry)
+            if entry['confirmations'] > 0 and 'blockheight' not in entry:
+                entry['blockheight'] = height - entry['confirmations'] + 1
+            entries.append(entry)
+        self.apply(rpc, entries, height)
+        self.lastblock = since['lastblock']
+        self.height = height
+        return True
+
+    def load(self, wallet):
+        '''Start over: reset the index and set lastblock to the tip it's valid at'''
+        raise NotImplementedError
+
+    def apply(self, rpc, entries, height):
+        '''Apply listsinceblock entries, confirmed ones carrying "blockheight"
+
+        Called with every entry of an update at once, since e.g. a coin can be
+        spent by a transaction listed before the one creating it.
+        '''
+        raise NotImplementedError
+
+class WalletIndexes:
+    '''One index per wallet and node'''
+
+    def __init__(self, index_class):
+        self.index_class = index_class
+        # (wallet name, host, port) -> index
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, wallet):
+        '''Index of wallet, brought up to date'''
+        key = (wallet.name, *node_key(wallet.node))
+        with self.lock:
+            index = self.indexes.setdefault(key, self.index_class())
+        index.update(wallet)
+        return index
+
+    def forget(self, wallet_name):
+        '''Start the wallet's index over, e.g. after a rescan added transactions below its tip'''
+        with self.lock:
+            self.indexes = {key: index for key, index in self.indexes.items() if key[0] != wallet_name}
@@ -1,20 +1,61 @@
 import logging
-import time
-import hwilib
 import os.path
 
 from pprint import pprint
-from hwilib.serializations import PSBT
+from contextlib import contextmanager
 
-from utils import RPC, JSONRPCException, sat_to_btc, btc_to_sat, JunctionError, read_cookie, derive_child_sec_from_xpub
-from disk import write_json_file, read_json_file, full_path
+from utils import RPC, JSONRPCException, sat_to_btc, btc_to_sat, JunctionError, read_cookie, derive_child_sec_from_xpub, LRUCache, node_key
+from disk import write_json_file, read_json_file, full_path, file_signature
 from constants import Networks, ScriptTypes
+import descriptors
+from psbts import LazyPSBT, combine_psbts, analyze_psbt, finalize_psbt
+from psbt_store import psbt_stores
+from history import history_indexes, HISTORY_PAGE_SIZE
+from utxos import utxo_indexes
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 ADDRESS_CHUNK = 100
 
+# Addresses kept imported ahead of the next one handed out, per branch
+ADDRESS_POOL_DEPTH = 100
+
+# Discovery stops after this many unused addresses in a row
+GAP_LIMIT = 20
+
+# Addresses per branch derived and checked in each discovery round
+DISCOVERY_BATCH = 1000
+
+# Blocks per rescanblockchain call, so long rescans report progress and stay under the RPC timeout
+RESCAN_CHUNK = 2016
+
+# How discover() checks address usage
+class DiscoveryMethods:
+    # One UTXO set scan per round: fast, but only finds addresses that still hold coins
+    SCANTXOUTSET = 'scantxoutset'
+    # Import and rescan each round: slow, but finds every address that ever received
+    RESCAN = 'rescan'
+
+# Confirmations after which we assume a transaction won't be reorged out
+SAFE_CONFIRMATIONS = 6
+
+# gettransaction results of buried transactions by (wallet name, txid)
+TRANSACTION_CACHE_SIZE = 10_000
+transaction_cache = LRUCache(TRANSACTION_CACHE_SIZE)
+
+# What to_dict(True) shows when the node can't be reached
+UNAVAILABLE_EXTRAS = {
+    'balances': {
+        # FIXME: this is bad. Shouldn't present incorrect balances, ever.
+        'confirmed': 'unavailable',
+        'unconfirmed': 'unavailable',
+    },
+    'coins': [],
+    'history': [],
+    'synced': None,
+}
+
 class HardwareSigner:
 
     def __init__(self, *, name, xpub, fingerprint, type, derivation_path):
@@ -87,7 +128,8 @@ class Node:
 class Wallet:
 
     def __init__(self, *, name, m, n, signers, psbts, receiving_address_index, 
-                 change_address_index, node, network, script_type):
+                 change_address_index, node, network, script_type,
+                 receiving_imported_index=None, change_imported_index=None, birthday=None):
         # Name of the wallet
         self.name = name
         # Signers required for bitcoin tx
@@ -96,18 +138,34 @@ class Wallet:
         self.n = n
         # Dictionary
         self.signers = signers
-        # Hex string
-        self.psbts = psbts
+        # PSBTs, one file each, keyed by txid
+        self.psbt_store = psbt_stores.get(name)
+        # LazyPSBTs from a wallet file older than the PSBT store, moved there by open()
+        self.legacy_psbts = psbts
         # Depth in HD derivation
         self.receiving_address_index = receiving_address_index
         # Depth in HD derivation
         self.change_address_index = change_address_index
+        # Bitcoin Core watches every address below these indices (older wallet files predate the pool)
+        self.receiving_imported_index = max(receiving_imported_index or 0, receiving_address_index)
+        self.change_imported_index = max(change_imported_index or 0, change_address_index)
+        # {"height", "time"} of the chain tip when the wallet was created. Older wallet files don't have one.
+        self.birthday = birthday
+        # change -> {index: address} of imported addresses not handed out yet
+        self.address_pool = {True: {}, False: {}}
+        # bumped by reset_imports(), so imports started before it can be told apart
+        self.imports_generation = 0
         # bitcoin node this wallet is attached to
         self.node = node
         # "mainnet", "testnet" or "regtest"
         self.network = network
         # "wrapped" or "native"
         self.script_type = script_type
+        # Nesting depth of coalesced_saves() blocks, and whether one of them skipped a save
+        self.save_depth = 0
+        self.save_pending = False
+        # file_signature() of the wallet file as this instance last read or wrote it
+        self.signature = None
 
     ### Helper methods
 
@@ -139,19 +197,29 @@ class Wallet:
         # FIXME: make sure that no RPC wallet with this name exists
         # Perhaps we should be connecting to a node, first
 
-        # Wallet instance
-        wallet = cls(name=name, m=m, n=n, signers=[], psbts=[], receiving_address_index=0,
-                     change_address_index=0, node=node, network=network, script_type=script_type)
-
         # Never overwrite existing wallet files
         # FIXME: full_path probably shouldn't appear in this file?
         wallet_file_path = full_path(f'wallets/{name}.json')
         if os.path.exists(wallet_file_path):
             raise JunctionError(f'"{wallet_file_path}" wallet file already exists')
 
+        # PSBTs left by an earlier wallet of this name aren't ours
+        psbt_stores.discard(name)
+
+        # Wallet instance
+        wallet = cls(name=name, m=m, n=n, signers=[], psbts=[], receiving_address_index=0,
+                     change_address_index=0, node=node, network=network, script_type=script_type)
+
         # Create a watch-only Bitcoin Core wallet
         wallet.ensure_watchonly()
 
+        # Nothing can have been paid to the wallet before now, so imports and rescans start here
+        blockchain_info = node.default_rpc.getblockchaininfo()
+        wallet.birthday = {
+            'height': blockchain_info['blocks'],
+            'time': blockchain_info['mediantime'],
+        }
+
         # Save a copy of wallet to disk
         wallet.save()
 
@@ -162,36 +230,58 @@ class Wallet:
     def open(cls, wallet_name, ensure_watchonly=True):
         '''Initialize this class from an existing wallet file'''
         relative_path = f'wallets/{wallet_name}.json'
+        # taken before reading, so a concurrent write shows up as a changed signature
+        signature = file_signature(relative_path)
         wallet_dict = read_json_file(relative_path)
         wallet = cls.from_dict(wallet_dict)
+        wallet.signature = signature
+        if wallet.legacy_psbts:
+            wallet.migrate_psbts()
 
         # From here we can assume that either Bitcoin Core wallet is loaded or we can't connect to node
-        try:
-            wallet.ensure_watchonly()
-        except Exception as e:
-            logger.info('Could not load Bitcoin Core "{}" wallet: {}'.format(wallet.name, str(e)))
+        if ensure_watchonly:
+            try:
+                if wallet.ensure_watchonly():
+                    wallet.reset_imports()
+            except Exception as e:
+                logger.info('Could not load Bitcoin Core "{}" wallet: {}'.format(wallet.name, str(e)))
         
         logger.info(f"Opened wallet from {relative_path}")
         return wallet
 
     def save(self):
-        '''Save wallet file to disk'''
+        '''Save wallet file to disk, or when the enclosing coalesced_saves() block ends'''
+        if self.save_depth:
+            self.save_pending = True
+            return
         data = self.to_dict()  
+        # PSBTs have their own files
+        del data['psbts']
         relative_path = self.wallet_file_path()
         write_json_file(data, relative_path)
+        self.signature = file_signature(relative_path)
+        self.save_pending = False
         logger.info(f"Saved wallet to {relative_path}")
 
+    @contextmanager
+    def coalesced_saves(self):
+        '''Turn every save() inside the block into one write when it exits'''
+        self.save_depth += 1
+        try:
+            yield self
+        finally:
+            self.save_depth -= 1
+            # saved even if the block failed, so indices already handed out are never reused
+            if not self.save_depth and self.save_pending:
+                self.save()
+
     ### Serialization
 
     @classmethod
     def from_dict(cls, d):
         '''Create class instance from dictionary'''
-        psbts = []
-        for raw_psbt in d['psbts']:
-            psbt = hwilib.serializations.PSBT()
-            psbt.deserialize(raw_psbt)
-            psbts.append(psbt)
-        d['psbts'] = psbts
+        # parsed only if something needs their fields
+        d['psbts'] = [LazyPSBT(raw_psbt) for raw_psbt in d.get('psbts', [])]
         d['signers'] = [HardwareSigner.from_dict(signer) for signer in d['signers']]
         d['node'] = Node.from_dict(d['node'])
         return cls(**d)
@@ -199,11 +289,7 @@ class Wallet:
     def to_dict(self, extras=False):
         '''Represent instance as a dictionary'''
         # psbts are serialized if extras=False, otherwise dictionary ...
-        psbts = []
-        for psbt in self.psbts:
-            psbt.tx.rehash()
-            serialized = psbt.serialize()
-            psbts.append(serialized)
+        psbts = [psbt.serialize() for psbt in self.psbts]
         signers = [signer.to_dict() for signer in self.signers]
         base = {
             "name": self.name,
@@ -213,37 +299,35 @@ class Wallet:
             "psbts": psbts,
             "receiving_address_index": self.receiving_address_index,
             "change_address_index": self.change_address_index,
+            "receiving_imported_index": self.receiving_imported_index,
+            "change_imported_index": self.change_imported_index,
             "node": self.node.to_dict(extras),
             "network": self.network,
             "script_type": self.script_type,
+            "birthday": self.birthday,
         }
         # FIXME: this sucks, but we need a way to serialize for API
         if extras:
+            # decoded locally, so they're shown even if the node is down
+            base['psbts'] = self.decoded_psbts()
             # FIXME: hack so that rpc calls don't blow up when we don't have a node available ...
             base['ready'] = self.ready()
             if self.node.default_rpc.error():
-                base['balances'] = {
-                    # FIXME: this is bad. Shouldn't present incorrect balances, ever.
-                    'confirmed': 'unavailable',
-                    'unconfirmed': 'unavailable',
-                }
-                base['psbts'] = []
-                base['coins'] = []
-                base['history'] = []
-                base['synced'] = None        
+                base.update(UNAVAILABLE_EXTRAS)
             else:
-                unconfirmed, confirmed = self.balances()
-                base['balances'] = {
-                    'confirmed': confirmed,
-                    'unconfirmed': unconfirmed,
-                }
-                # FIXME: signing shouldn't require bitcoin rpc 
-                base['psbts'] = [self.decode_psbt(psbt) for psbt in self.psbts]
-                base['coins'] = self.coins()
-                base['history'] = self.history()
-                base['synced'] = self.synced()
+                for field, compute in self.extras().items():
+                    base[field] = compute()
         return base
 
+    def extras(self):
+        '''Fields the API adds on top of the wallet file, each computed with RPC calls'''
+        return {
+            'balances': self.balances_dict,
+            'coins': self.coins,
+            'history': self.history,
+            'synced': self.synced,
+        }
+
     ### Watch-only Bitcoin Core wallets
 
     def watchonly_name(self):
@@ -251,6 +335,7 @@ class Wallet:
         return f"{self.name}"
 
     def ensure_watchonly(self):
+        '''Load or create the watch-only Bitcoin Core wallet. True if it had to be created.'''
         # TODO: move to Node class
         # Create watch-only Bitcoin Core wallet
         watch_only_name = self.watchonly_name()
@@ -261,11 +346,35 @@ class Wallet:
                 logger.info(f"Loaded watch-only Bitcoin Core wallet \"{watch_only_name}\"")
             except JSONRPCException as e:
                 try:
-                    # FIXME: if wallet is "ready" here, we also need an export ...
                     self.node.default_rpc.createwallet(watch_only_name, True)
                     logger.info(f"Created watch-only Bitcoin Core wallet \"{watch_only_name}\"")
                 except JSONRPCException as e:
                     raise JunctionError("Couldn't establish watch-only Bitcoin Core wallet")
+                return True
+        return False
+
+    def set_node(self, node):
+        '''Switch to another node, re-importing addresses if that means another Bitcoin Core wallet'''
+        moved = node_key(node) != node_key(self.node)
+        self.node = node
+        self.save()
+        # the new node may not have the watch-only wallet loaded yet
+        if self.ensure_watchonly() or moved:
+            self.reset_imports()
+
+    def reset_imports(self):
+        '''Start the imported watermarks over for a Bitcoin Core wallet that hasn't seen our imports
+
+        Addresses handed out so far are imported again, and the pool refills from there.
+        '''
+        with self.coalesced_saves():
+            self.receiving_imported_index = self.receiving_address_index
+            self.change_imported_index = self.change_address_index
+            self.address_pool = {True: {}, False: {}}
+            self.imports_generation += 1
+            self.save()
+        if self.ready():
+            self.sync()
 
     ### Signers
 
@@ -311,36 +420,50 @@ class Wallet:
         else:
             raise Exception('No derivation paths for this wallet type')
 
-    def descriptor(self, change, index):
+    def signer_pubkeys(self, change, index):
+        '''(sec, signer) pairs at change / index, BIP67-sorted by SEC pubkey for multisig'''
+        path = f"./{int(change)}/{index}"
+        secs_and_signers = [(derive_child_sec_from_xpub(signer.xpub, path), signer)
+                            for signer in self.signers]
         # For multisig, order the xpubs lexigraphically by derived SEC pubkeys that will go in bitcoin script (BIP67)
         if self.is_multisig():
-            path = f"./{int(change)}/{index}"
-            secs_and_signers = [(derive_child_sec_from_xpub(signer.xpub, path), signer) 
-                                for signer in self.signers]
-            sorted_secs_and_signers = sorted(secs_and_signers, key=lambda item: item[0])
-            signers = [sec_and_signer[1] for sec_and_signer in sorted_secs_and_signers]
-        else:
-            signers = self.signers
+            secs_and_signers = sorted(secs_and_signers, key=lambda item: item[0])
+        return secs_and_signers
 
-        # Build the descriptor according to script type
+    def descriptor(self, change, index):
+        signers = [signer for _, signer in self.signer_pubkeys(change, index)]
         parts_list = [f'[{signer.fingerprint}{signer.derivation_path[1:]}]{signer.xpub}/{int(change)}/{index}' 
                 for signer in signers]
+        return self.script_descriptor(parts_list, "multi")
+
+    def ranged_descriptor(self, change):
+        '''Descriptor covering every index of the receiving or change branch'''
+        parts_list = [f'[{signer.fingerprint}{signer.derivation_path[1:]}]{signer.xpub}/{int(change)}/*'
+                for signer in self.signers]
+        # "sortedmulti" applies the same BIP67 ordering descriptor() does at each index
+        return self.script_descriptor(parts_list, "sortedmulti")
+
+    def script_descriptor(self, parts_list, multi):
+        '''Wrap key expressions according to script type and append checksum'''
         parts_str = ",".join(parts_list)
         if self.script_type == ScriptTypes.NATIVE and self.is_multisig():
-            descriptor = f"wsh(multi({self.m},{parts_str}))"
+            descriptor = f"wsh({multi}({self.m},{parts_str}))"
         elif self.script_type == ScriptTypes.NATIVE and self.is_singlesig():
             descriptor = f"wpkh({parts_str})"
         elif self.script_type == ScriptTypes.WRAPPED and self.is_multisig():
-            descriptor = f"sh(wsh(multi({self.m},{parts_str})))"
+            descriptor = f"sh(wsh({multi}({self.m},{parts_str})))"
         elif self.script_type == ScriptTypes.WRAPPED and self.is_singlesig():
             descriptor = f"sh(wpkh({parts_str}))"
         else:
             raise Exception('Cannot construct descriptor')
-        
-        # validates and appends checksum
-        # FIXME: do this here
-        r = self.node.wallet_rpc.getdescriptorinfo(descriptor)
-        return r['descriptor']
+
+        # appends checksum (same as getdescriptorinfo, without the round trip)
+        return descriptors.add_checksum(descriptor)
+
+    def address(self, change, index):
+        '''Address at change / index, derived locally'''
+        secs = [sec for sec, _ in self.signer_pubkeys(change, index)]
+        return descriptors.address(self.script_type, self.m, secs, self.network)
 
     def derive_receiving_address(self):
         '''Derive next change address, sync if we need to and save new address indices'''
@@ -370,39 +493,97 @@ class Wallet:
         self.save()
         return address
 
+    def derive_receiving_addresses(self, count):
+        '''Derive the next count receiving addresses, saving the wallet once'''
+        with self.coalesced_saves():
+            return [self.derive_receiving_address() for _ in range(count)]
+
     def derive_address(self, change, index):
         '''Helper for deriving address at specified change/index position'''
         # Can't derive addresses if we don't have enough signers
         if not self.ready():
             raise JunctionError(f'{self.n} signers required, {len(self.signers)} registered')
         
+        # Addresses from the pool are already imported
+        imported_index = self.imported_index(change)
+        if index < imported_index:
+            address = self.address_pool[change].pop(index, None)
+            return address or self.address(change, index)
+
         # Tell Bitcoin Core to watch this address
-        descriptor = self.watch_address(change, index)
+        self.watch_address(change, index)
+        if index == imported_index:
+            self.set_imported_index(change, index + 1)
 
-        # Get the address from Bitcoin Core
-        address = self.node.wallet_rpc.deriveaddresses(descriptor)[0]
+        # Pubkeys are BIP67-sorted locally, so no need to ask Bitcoin Core for the address
+        return self.address(change, index)
 
-        # Make sure we got a watch-only address
-        address_info = self.node.wallet_rpc.getaddressinfo(address)
-        assert address_info['iswatchonly'] is True, 'Bitcoin Core gave us non-watch-only address'
+    ### Address pool
 
-        # Make sure multisig pubkeys are sorted (FIXME: raise or recurse?)
-        if self.is_multisig():
-            if self.script_type == ScriptTypes.WRAPPED:
-                pubkeys = address_info['embedded']['pubkeys']
-            else:
-                pubkeys = address_info['pubkeys']
-            assert sorted('pubkeys'), 'Derived address with unsorted pubkeys'
-            
-        return address
+    def imported_index(self, change):
+        return self.change_imported_index if change else self.receiving_imported_index
 
-    def watch_address(self, change, index):
-        '''Tell Bitcoin Core to watch address at change / index'''
-        descriptor = self.descriptor(change, index)
-        response = self.node.wallet_rpc.importmulti([{
+    def set_imported_index(self, change, index):
+        if change:
+            self.change_imported_index = index
+        else:
+            self.receiving_imported_index = index
+
+    def imports_key(self):
+        '''Changes whenever earlier imports may not be in the Bitcoin Core wallet anymore'''
+        return (node_key(self.node), self.imports_generation)
+
+    def address_pool_shortfall(self, depth=ADDRESS_POOL_DEPTH):
+        '''(change, start, stop) ranges to import so each branch has depth addresses ready, once half are used'''
+        if not self.ready():
+            return []
+        ranges = []
+        for change, address_index in [(False, self.receiving_address_index), (True, self.change_address_index)]:
+            imported_index = self.imported_index(change)
+            if imported_index - address_index < depth // 2 + 1:
+                ranges.append((change, imported_index, address_index + depth))
+        return ranges
+
+    def import_ranges(self, ranges, timestamp='now'):
+        '''Watch every address in (change, start, stop) ranges with one importmulti'''
+        requests = []
+        for change, start, stop in ranges:
+            request = self.import_request(self.ranged_descriptor(change), change, timestamp)
+            request['range'] = [start, stop-1]
+            requests.append(request)
+        response = self.node.wallet_rpc.importmulti(requests)
+
+        # Bitcoin Core < 0.20 doesn't understand "sortedmulti"
+        if not all([item['success'] for item in response]):
+            requests = [self.import_request(self.descriptor(change, index), change, timestamp)
+                        for change, start, stop in ranges for index in range(start, stop)]
+            response = self.node.wallet_rpc.importmulti(requests)
+            assert all([item['success'] for item in response]), 'Address export failed'
+
+    def mark_imported(self, ranges):
+        '''Advance the imported indices past ranges import_ranges() finished, and pool their addresses'''
+        for change, start, stop in ranges:
+            # ignore ranges that no longer start at the watermark, e.g. two fills racing
+            if start <= self.imported_index(change) < stop:
+                # Addresses are derived locally, so this is cheap next to the import
+                for index in range(self.imported_index(change), stop):
+                    self.address_pool[change][index] = self.address(change, index)
+                self.set_imported_index(change, stop)
+        self.save()
+
+    def fill_address_pool(self, depth=ADDRESS_POOL_DEPTH):
+        '''Top up the pool of imported addresses (see address_pool.py for the background version)'''
+        ranges = self.address_pool_shortfall(depth)
+        if ranges:
+            self.import_ranges(ranges)
+            self.mark_imported(ranges)
+
+    def import_request(self, descriptor, change, timestamp='now'):
+        '''importmulti request watching the address(es) of a descriptor'''
+        return {
             "desc": descriptor,
             # rescan from thie timestamp ('now' means no rescan)
-            "timestamp": 'now',
+            "timestamp": timestamp,
             # Treat as a watch-only address
             "watchonly": True,
             # Don't import into keypool. Bitcoin Core can't yet import multisig addresses.
@@ -410,7 +591,12 @@ class Wallet:
             "keypool": False,
             # Is it change?
             "internal": change,
-        }])
+        }
+
+    def watch_address(self, change, index):
+        '''Tell Bitcoin Core to watch address at change / index'''
+        descriptor = self.descriptor(change, index)
+        response = self.node.wallet_rpc.importmulti([self.import_request(descriptor, change)])
         assert all([item['success'] for item in response]), 'Address export failed'
 
         # slightly janky, but helps in derive_address
@@ -418,43 +604,197 @@ class Wallet:
 
     def watching_address(self, change, index):
         '''Check if Bitcoin Core is already watching this address'''
-        # Grab descriptor, derive address, see if watch-only RPC tags it as "iswatchonly"
-        descriptor = self.descriptor(change, index)
-        address = self.node.default_rpc.deriveaddresses(descriptor)[0]
-        address_info = self.node.wallet_rpc.getaddressinfo(address)
-        return address_info.get('iswatchonly', False)
-    
+        return self.watching_addresses([(change, index)])[0][0]
+
+    def watching_addresses(self, positions):
+        '''(watching, descriptor) for each (change, index) position, in a single batched round trip'''
+        # See if watch-only RPC tags them as "iswatchonly"
+        batch = self.node.wallet_rpc.batch()
+        for change, index in positions:
+            batch.getaddressinfo(self.address(change, index))
+        watching = [info.get('iswatchonly', False) for info in batch.results()]
+
+        return [(is_watching, self.descriptor(change, index))
+                for is_watching, (change, index) in zip(watching, positions)]
+
     def synced(self):
         '''Ballpark guess whether we're synced with Bitcoin Core'''
-        checks = []
-        if self.change_address_index != 0:
-            checks.append(self.watching_address(True, 0))
-            checks.append(self.watching_address(True, self.change_address_index-1))
-        if self.receiving_address_index != 0:
-            checks.append(self.watching_address(False, 0))
-            checks.append(self.watching_address(False, self.receiving_address_index-1))
-        return all(checks)
-
-    def sync(self):
+        positions = []
+        if self.change_imported_index != 0:
+            positions.append((True, 0))
+            positions.append((True, self.change_imported_index-1))
+        if self.receiving_imported_index != 0:
+            positions.append((False, 0))
+            positions.append((False, self.receiving_imported_index-1))
+        if not positions:
+            return True
+        return all(watching for watching, _ in self.watching_addresses(positions))
+
+    def sync(self, ranged=True):
         '''Export every address that Bitcoin Core doesn't know about'''
-        # Sync change addresses
-        change = True
-        for index in range(0, self.change_address_index):
-            watching = self.watching_address(change, index)
+        if ranged and self.sync_ranged():
+            return
+        self.sync_each()
+
+    def sync_ranged(self):
+        '''Import each branch as one ranged descriptor in a single importmulti. False if Core refuses.'''
+        requests = []
+        for change, address_index in [(True, self.change_imported_index), (False, self.receiving_imported_index)]:
+            if address_index == 0:
+                continue
+            request = self.import_request(self.ranged_descriptor(change), change, self.import_timestamp())
+            request['range'] = [0, address_index-1]
+            requests.append(request)
+        if not requests:
+            return True
+
+        # Bitcoin Core < 0.20 doesn't understand "sortedmulti"
+        response = self.node.wallet_rpc.importmulti(requests)
+        if not all([item['success'] for item in response]):
+            errors = [item.get('error', {}).get('message') for item in response if not item['success']]
+            logger.info(f"Ranged import failed, syncing address by address: {errors}")
+            return False
+
+        logger.info(f"Synced {self.change_imported_index} change and {self.receiving_imported_index} receiving addresses with Bitcoin Core wallet \"{self.name}\"")
+        self.forget_indexes()
+        return True
+
+    def sync_each(self):
+        '''Import every address Bitcoin Core isn't watching, one descriptor per address'''
+        positions = [(True, index) for index in range(self.change_imported_index)]
+        positions += [(False, index) for index in range(self.receiving_imported_index)]
+        if not positions:
+            return
+
+        # Work out which addresses Bitcoin Core is missing
+        requests = []
+        statuses = self.watching_addresses(positions)
+        for (change, index), (watching, descriptor) in zip(positions, statuses):
             if not watching:
-                self.watch_address(change, index)
+                requests.append(self.import_request(descriptor, change, self.import_timestamp()))
+
+        # Import all of them with a single importmulti
+        if requests:
+            response = self.node.wallet_rpc.importmulti(requests)
+            assert all([item['success'] for item in response]), 'Address export failed'
+            logger.info(f"Synced {len(requests)} addresses with Bitcoin Core wallet \"{self.name}\"")
+            self.forget_indexes()
+
+    ### Rescans
+
+    def birthday_height(self):
+        '''First block that can involve this wallet'''
+        return self.birthday['height'] if self.birthday else 0
+
+    def import_timestamp(self):
+        '''importmulti timestamp for addresses that may have history'''
+        # Without a birthday, "now" as before: a full chain rescan should be asked for explicitly
+        return self.birthday['time'] if self.birthday else 'now'
+
+    def rescan(self, start=None, stop=None, chunk_size=RESCAN_CHUNK, progress=None):
+        '''rescanblockchain from start (default: birthday) to stop (default: tip) in chunks, calling progress(height) after each'''
+        if start is None:
+            start = self.birthday_height()
+        if stop is None:
+            stop = self.node.wallet_rpc.getblockcount()
+        for chunk_start in range(start, stop + 1, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size - 1, stop)
+            self.node.wallet_rpc.rescanblockchain(chunk_start, chunk_stop)
+            logger.info(f'Rescanned "{self.name}" blocks {chunk_start}-{chunk_stop} of {start}-{stop}')
+            if progress:
+                progress(chunk_stop)
+        self.forget_indexes()
+        return start, stop
+
+    def forget_indexes(self):
+        '''Rebuild the history and UTXO indexes next time, since transactions below their tips may have appeared'''
+        history_indexes.forget(self.name)
+        utxo_indexes.forget(self.name)
+
+    ### Discovery
+
+    def scripts(self, change, start, stop):
+        '''{scriptPubKey hex: index} for a range of one branch, derived locally'''
+        scripts = {}
+        for index in range(start, stop):
+            secs = [sec for sec, _ in self.signer_pubkeys(change, index)]
+            scripts[descriptors.script_pubkey(self.script_type, self.m, secs).hex()] = index
+        return scripts
+
+    def used_indices(self, ranges, method):
+        '''{change: set of used indices} within (change, start, stop) ranges'''
+        used = {True: set(), False: set()}
+        if method == DiscoveryMethods.SCANTXOUTSET:
+            scripts = {}
+            for change, start, stop in ranges:
+                for script, index in self.scripts(change, start, stop).items():
+                    scripts[script] = (change, index)
+            scan_objects = [{'desc': self.ranged_descriptor(change), 'range': [start, stop-1]}
+                            for change, start, stop in ranges]
+            result = self.node.default_rpc.scantxoutset('start', scan_objects)
+            for unspent in result['unspents']:
+                if unspent['scriptPubKey'] in scripts:
+                    change, index = scripts[unspent['scriptPubKey']]
+                    used[change].add(index)
+        elif method == DiscoveryMethods.RESCAN:
+            self.import_ranges(ranges)
+            # a restored wallet's birthday is when it was rebuilt, after its history
+            self.rescan(start=0)
+            positions = {}
+            for change, start, stop in ranges:
+                for index in range(start, stop):
+                    positions[self.address(change, index)] = (change, index)
+            for received in self.node.wallet_rpc.listreceivedbyaddress(0, True, True):
+                if received['address'] in positions and received['txids']:
+                    change, index = positions[received['address']]
+                    used[change].add(index)
+        else:
+            raise JunctionError(f'Unknown discovery method "{method}"')
+        return used
 
-        # Sync receiving addresses
-        change = False
-        for index in range(0, self.receiving_address_index):
-            watching = self.watching_address(change, index)
-            if not watching:
-                self.watch_address(change, index)
+    def discover(self, gap_limit=GAP_LIMIT, batch_size=DISCOVERY_BATCH, method=DiscoveryMethods.SCANTXOUTSET):
+        '''Advance address indices past used addresses beyond them, stopping after gap_limit unused in a row'''
+        if not self.ready():
+            raise JunctionError(f'{self.n} signers required, {len(self.signers)} registered')
+
+        # Every branch scans batches from its current index until it sees a long enough gap
+        next_index = {False: self.receiving_address_index, True: self.change_address_index}
+        last_used = {False: self.receiving_address_index - 1, True: self.change_address_index - 1}
+        while True:
+            ranges = [(change, next_index[change], next_index[change] + batch_size)
+                      for change in (False, True) if next_index[change] - last_used[change] - 1 < gap_limit]
+            if not ranges:
+                break
+            for change, indices in self.used_indices(ranges, method).items():
+                if indices:
+                    last_used[change] = max(last_used[change], max(indices))
+            for change, start, stop in ranges:
+                next_index[change] = stop
+            logger.info(f'Discovery of "{self.name}" scanned up to {next_index}, last used {last_used}')
+
+        # Make sure Bitcoin Core watches everything up to the new indices, and save them
+        with self.coalesced_saves():
+            self.receiving_address_index = max(self.receiving_address_index, last_used[False] + 1)
+            self.change_address_index = max(self.change_address_index, last_used[True] + 1)
+            ranges = [(change, self.imported_index(change), index) for change, index
+                      in [(False, self.receiving_address_index), (True, self.change_address_index)]
+                      if self.imported_index(change) < index]
+            if ranges:
+                # these addresses have been used, possibly before the wallet's birthday, so pick
+                # up all their history (a discovery rescan already has)
+                self.import_ranges(ranges, 'now' if method == DiscoveryMethods.RESCAN else 0)
+                self.mark_imported(ranges)
+            self.save()
+        self.forget_indexes()
+        return {
+            'receiving_address_index': self.receiving_address_index,
+            'change_address_index': self.change_address_index,
+        }
 
     ### Transactions
 
     def create_psbt(self, outputs, subtract_fees=None):
-        '''Create a new PSBT paying single recipient'''
+        '''Create a new PSBT paying single recipient, returning its txid'''
         change_address = self.derive_change_address()
         raw_psbt = self.node.wallet_rpc.walletcreatefundedpsbt(
             # let Bitcoin Core choose inputs
@@ -475,77 +815,138 @@ class Wallet:
             # Include BIP32 derivation paths in the PSBT
             True,
         )['psbt']
-        # Serialize and save
-        psbt = hwilib.serializations.PSBT()
-        psbt.deserialize(raw_psbt)
-        self.psbts.append(psbt)
+        return self.psbt_store.put(LazyPSBT(raw_psbt))
+
+    @property
+    def psbts(self):
+        '''Every PSBT, oldest first'''
+        return self.psbt_store.all()
+
+    def psbt_txid(self, txid=None, index=None):
+        '''txid of the PSBT a request names, by txid or by position in psbts'''
+        if txid is not None:
+            return txid
+        txids = self.psbt_store.txids()
+        if index is None or not 0 <= index < len(txids):
+            raise JunctionError(f'No PSBT at index {index}')
+        return txids[index]
+
+    def migrate_psbts(self):
+        '''Move PSBTs from the wallet file to the PSBT store'''
+        for psbt in self.legacy_psbts:
+            self.psbt_store.put(psbt)
+        self.legacy_psbts = []
         self.save()
 
-    def remove_psbt(self, index):
-        # TODO: unlock input utxos
-        del self.psbts[index]
-        self.save()
-
-    def update_psbt(self, psbt, index):
-        # FIXME: make sure this is the same psbt
-        # does HWI PSBT class expose any "update" functionality?
-        self.psbts[index] = psbt
-        self.save()
+    def remove_psbt(self, txid, unlock=True):
+        '''Forget a PSBT, unlocking the coins it reserved unless another PSBT spends them too'''
+        outpoints = [outpoint for outpoint in self.psbt_store.outpoints(txid)
+                     if self.psbt_store.spenders_of(outpoint) == {txid}]
+        if unlock and outpoints:
+            self.node.wallet_rpc.lockunspent(True, [{'txid': prev_txid, 'vout': vout}
+                                                    for prev_txid, vout in outpoints])
+        self.psbt_store.remove(txid)
+
+    def update_psbt(self, psbt, txid):
+        '''Merge psbt's signatures and other data into the stored PSBT, which must be the same transaction'''
+        # held across read and write, so concurrent signers can't drop each other's signatures
+        with self.psbt_store.lock:
+            self.psbt_store.put(combine_psbts([self.psbt_store.get(txid), psbt]))
+            return self.psbt_store.get(txid)
+
+    def combine_psbt(self, raw_psbts, txid):
+        '''Merge signatures from raw_psbts (base64) into the stored PSBT, writing it once'''
+        return self.update_psbt(combine_psbts([LazyPSBT(raw) for raw in raw_psbts]), txid)
 
     def decode_psbt(self, psbt):
-        '''Fetch Bitcoin Core psbt deserialization if it exists'''
-        return self.node.wallet_rpc.decodepsbt(psbt.serialize())
+        '''decodepsbt-style dict with signing progress, see psbts.analyze_psbt'''
+        return analyze_psbt(psbt, self.network)
+
+    def decoded_psbts(self):
+        return [self.decode_psbt(psbt) for psbt in self.psbts]
             
-    def broadcast(self, index):
+    def broadcast(self, txid):
         '''Finalize and broadcast psbt to network'''
-        psbt = self.psbts[index]
-        psbt_hex = psbt.serialize()
-        tx_hex = self.node.wallet_rpc.finalizepsbt(psbt_hex)["hex"]
-        txid = self.node.wallet_rpc.sendrawtransaction(tx_hex)
+        psbt = self.psbt_store.get(txid)
+        tx_hex = finalize_psbt(psbt)
+        # differs from the PSBT's txid when inputs have a scriptSig (P2SH-wrapped)
+        broadcast_txid = self.node.wallet_rpc.sendrawtransaction(tx_hex)
         # FIXME: can we be sure that tx broadcast succeeded here, that we won't need psbt anymore?
-        self.remove_psbt(index)
-        return txid
+        # its coins are spent now, so there's nothing to unlock
+        self.remove_psbt(txid, unlock=False)
+        return broadcast_txid
     
     ### Wallet history
 
+    def balances_dict(self):
+        unconfirmed, confirmed = self.balances()
+        return {
+            'confirmed': confirmed,
+            'unconfirmed': unconfirmed,
+        }
+
     def balances(self):
         '''(unconfirmed, confirmed) balances tuple'''
-        # try to use new getbalances rpc (available in bitcoin core master branch)
-        try:
-            balances = self.node.wallet_rpc.getbalances()
-            if 'watchonly' in balances:
-                watchonly = balances['watchonly']
-                return watchonly['untrusted_pending'], watchonly['trusted']
-            else:
-                return 0, 0
-        # fall back to counting ourselves
-        except:
-            unconfirmed_balance = 0
-            confirmed_balance = 0
-            unspent = self.coins()
-            for u in unspent:
-                if u['confirmations'] > 0:
-                    confirmed_balance += u['amount']
-                else:
-                    unconfirmed_balance += u['amount']
-            return unconfirmed_balance, confirmed_balance
-    
+        return utxo_indexes.get(self).balances()
+
     def coins(self):
-        unlocked_unspents = self.node.wallet_rpc.listunspent(0, 9999999, [], True)
-        locked_outpoints = self.node.wallet_rpc.listlockunspent()
+        '''Unspent coins, from the incrementally updated UTXO index'''
+        return utxo_indexes.get(self).coins()
+
+    def unspent(self):
+        '''Every unspent coin, locked ones included, fetched in full'''
+        batch = self.node.wallet_rpc.batch()
+        unlocked_unspents = batch.listunspent(0, 9999999, [], True)
+        locked_outpoints = batch.listlockunspent()
+        height = batch.getblockcount()
+        batch.send()
+
+        # One gettransaction per distinct txid, not per outpoint
+        locked_outpoints = locked_outpoints.result()
+        txids = {outpoint['txid'] for outpoint in locked_outpoints}
+        transactions = self.transactions(txids, height.result())
+
         locked_unspents = []
         for outpoint in locked_outpoints:
-            _unspent = self.node.wallet_rpc.gettransaction(outpoint['txid'], True)
+            _unspent = transactions[outpoint['txid']]
             for details in _unspent['details']:
+                # Only the locked output, and only as received
+                if details['vout'] != outpoint['vout'] or details['category'] == 'send':
+                    continue
                 unspent = {}
                 unspent['txid'] = _unspent['txid']
                 unspent['confirmations'] = _unspent['confirmations']
-                unspent['address'] = details['address']
+                unspent['address'] = details.get('address')
                 unspent['vout'] = details['vout']
                 unspent['amount'] = details['amount']
                 locked_unspents.append(unspent)
-        return unlocked_unspents + locked_unspents
+                break
+        return unlocked_unspents.result() + locked_unspents
+
+    def transactions(self, txids, height):
+        '''gettransaction for each txid in one batch, serving buried transactions from cache'''
+        transactions = {}
+        batch = self.node.wallet_rpc.batch()
+        calls = {}
+        for txid in txids:
+            cached = transaction_cache.get((self.name, txid))
+            if cached is None:
+                calls[txid] = batch.gettransaction(txid, True)
+                continue
+            # Only the confirmation count of a buried transaction changes
+            transaction, cached_height = cached
+            confirmations = transaction['confirmations'] + height - cached_height
+            transactions[txid] = dict(transaction, confirmations=confirmations)
+        batch.send()
+
+        for txid, call in calls.items():
+            transaction = call.result()
+            if transaction['confirmations'] >= SAFE_CONFIRMATIONS:
+                transaction_cache.set((self.name, txid), (transaction, height))
+            transactions[txid] = transaction
+        return transactions
 
     def history(self):
-        # TODO: paginate
-        return self.node.wallet_rpc.listtransactions("*", 100, 0, True)
\ No newline at end of file
+        '''Most recent transactions, oldest first like listtransactions (see /transactions for the rest)'''
+        index = history_indexes.get(self)
+        return list(reversed(index.page(0, HISTORY_PAGE_SIZE)))
\ No newline at end of file
@@ -0,0 +1,198 @@
+'''
+Watch each node for new blocks and mempool transactions
+
+When the chain tip or mempool changes, the node's wallets' snapshots are dropped
+and their history / UTXO indexes brought up to date in the background, so the
+next GET /wallets finds the work already done.
+
+If pyzmq is installed and the node publishes zmqpubhashblock / zmqpubrawtx, a
+notification wakes the watcher right away. Otherwise (and as a safety net, since
+ZMQ can drop messages) the watcher polls getbestblockhash / getmempoolinfo.
+'''
+import logging
+import threading
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+from history import history_indexes
+from utxos import utxo_indexes
+from registry import registry
+from snapshots import snapshots
+from utils import node_key
+
+logger = logging.getLogger(__name__)
+
+# Seconds between node state checks without ZMQ
+POLL_INTERVAL = 2
+
+# Seconds between node state checks when ZMQ wakes us up
+ZMQ_POLL_INTERVAL = 30
+
+# Seconds between checks for wallets on nodes we aren't watching yet
+WATCH_INTERVAL = 10
+
+# ZMQ topics worth waking up for
+ZMQ_TOPICS = ('pubhashblock', 'pubrawtx')
+
+def zmq_addresses(node):
+    '''Addresses node publishes ZMQ_TOPICS on, reachable from here'''
+    addresses = set()
+    for notification in node.default_rpc.getzmqnotifications():
+        if notification['type'] not in ZMQ_TOPICS:
+            continue
+        # bitcoind may bind every interface, but we have to connect to the one we use for RPC
+        address = notification['address']
+        for wildcard in ['0.0.0.0', '*']:
+            address = address.replace(f'//{wildcard}:', f'//{node.host}:')
+        addresses.add(address)
+    return sorted(addresses)
+
+class ChainWatcher:
+    '''Calls on_change(node) whenever node's chain tip or mempool changes'''
+
+    def __init__(self, node, on_change, use_zmq=True, poll_interval=POLL_INTERVAL):
+        self.node = node
+        self.on_change = on_change
+        self.use_zmq = use_zmq and zmq is not None
+        self.poll_interval = poll_interval
+        self.state = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'chain-watcher-{node.host}:{node.port}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        socket = self.subscribe() if self.use_zmq else None
+        try:
+            while not self.stopped.is_set():
+                self.check()
+                if socket is not None:
+                    self.wait_for_notification(socket)
+                else:
+                    self.stopped.wait(self.poll_interval)
+        finally:
+            if socket is not None:
+                socket.close(linger=0)
+
+    def subscribe(self):
+        '''SUB socket connected to the node's notifications, or None to poll instead'''
+        try:
+            addresses = zmq_addresses(self.node)
+        except Exception as e:
+            logger.info(f'No ZMQ notifications from {self.node.host}:{self.node.port}: {e}')
+            return None
+        if not addresses:
+            return None
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        for address in addresses:
+            socket.connect(address)
+        for topic in ['hashblock', 'rawtx']:
+            socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        logger.info(f'Listening for {self.node.host}:{self.node.port} notifications on {addresses}')
+        return socket
+
+    def wait_for_notification(self, socket):
+        '''Block until a notification arrives (or ZMQ_POLL_INTERVAL passes), then drain the queue'''
+        if not socket.poll(ZMQ_POLL_INTERVAL * 1000):
+            return
+        # a burst of transactions only needs one check
+        while socket.poll(0):
+            socket.recv_multipart()
+
+    def check(self):
+        '''Compare the node's tip and mempool with what we saw last, and report a change'''
+        try:
+            batch = self.node.default_rpc.batch()
+            best_block_hash = batch.getbestblockhash()
+            mempool_info = batch.getmempoolinfo()
+            batch.send()
+            state = snapshots.remember_node_state(self.node, best_block_hash.result(), mempool_info.result())
+        except Exception as e:
+            logger.info(f'Could not check {self.node.host}:{self.node.port}: {e}')
+            return
+        previous, self.state = self.state, state
+        if previous is not None and previous != state:
+            try:
+                self.on_change(self.node)
+            except Exception as e:
+                logger.exception(e)
+
+class ChainNotifications:
+    '''A ChainWatcher for every node some wallet uses'''
+
+    def __init__(self, use_zmq=True, poll_interval=POLL_INTERVAL):
+        self.use_zmq = use_zmq
+        self.poll_interval = poll_interval
+        # (host, port) -> ChainWatcher
+        self.watchers = {}
+        # called with each wallet whose node changed, after its indexes are updated
+        self.listeners = []
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        '''Watch every wallet's node, and keep looking for new ones'''
+        thread = threading.Thread(target=self.run, name='chain-notifications', daemon=True)
+        thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            for watcher in self.watchers.values():
+                watcher.stop()
+            self.watchers.clear()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                for wallet in registry.all():
+                    self.watch(wallet.node)
+            except Exception as e:
+                logger.info(f'Could not list wallets to watch: {e}')
+            self.stopped.wait(WATCH_INTERVAL)
+
+    def watch(self, node):
+        '''Start watching node, unless we already are'''
+        with self.lock:
+            watcher = self.watchers.get(node_key(node))
+            if watcher is None:
+                watcher = ChainWatcher(node, self.changed, self.use_zmq, self.poll_interval)
+                self.watchers[node_key(node)] = watcher.start()
+            # credentials may have been updated
+            watcher.node = node
+            return watcher
+
+    def subscribe(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.remove(listener)
+
+    def changed(self, node):
+        '''Drop node's wallets' snapshots and bring their indexes up to date'''
+        with self.lock:
+            listeners = list(self.listeners)
+        for wallet in registry.all():
+            if node_key(wallet.node) != node_key(node):
+                continue
+            snapshots.invalidate(wallet.name)
+            try:
+                history_indexes.get(wallet)
+                utxo_indexes.get(wallet)
+            except Exception as e:
+                logger.info(f'Could not update "{wallet.name}" indexes: {e}')
+                continue
+            for listener in listeners:
+                listener(wallet)
+
+notifications = ChainNotifications()
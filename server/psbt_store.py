@@ -0,0 +1,148 @@
+'''
+Each wallet's PSBTs, one file per PSBT under psbts/<wallet name>/<txid>.json
+
+PSBTs are keyed by the txid of their unsigned transaction, so changing one
+rewrites only its own file, and requests name the PSBT they mean instead of a
+list position another client may have just shifted. Records carry their signing
+status and the outpoints they spend, so the in-memory indexes by status and by
+outpoint are rebuilt without parsing any PSBT.
+'''
+import os
+import shutil
+import threading
+import time
+
+from disk import write_json_file, read_json_file, full_path, json_file_names
+from psbts import LazyPSBT, psbt_txid, psbt_outpoints, psbt_status
+from constants import PSBTStatuses
+from utils import JunctionError
+
+class PSBTStore:
+
+    def __init__(self, directory):
+        # relative to the datadir
+        self.directory = directory
+        # txid -> {"psbt": LazyPSBT, "created", "status", "outpoints"}
+        self.records = {}
+        # status -> txids
+        self.statuses = {status: set() for status in
+                         [PSBTStatuses.UNSIGNED, PSBTStatuses.PARTIALLY_SIGNED, PSBTStatuses.READY]}
+        # (txid, vout) -> txids of PSBTs spending it
+        self.spenders = {}
+        # bumped on every change, so caches keyed on it notice PSBT edits
+        self.version = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not os.path.isdir(full_path(self.directory)):
+            return
+        for txid in json_file_names(self.directory):
+            record = read_json_file(self.record_path(txid))
+            self.index(txid, {
+                'psbt': LazyPSBT(record['psbt']),
+                'created': record['created'],
+                'status': record['status'],
+                'outpoints': [tuple(outpoint) for outpoint in record['outpoints']],
+            })
+
+    def record_path(self, txid):
+        return f'{self.directory}/{txid}.json'
+
+    def index(self, txid, record):
+        self.unindex(txid)
+        self.records[txid] = record
+        self.statuses[record['status']].add(txid)
+        for outpoint in record['outpoints']:
+            self.spenders.setdefault(outpoint, set()).add(txid)
+
+    def unindex(self, txid):
+        record = self.records.pop(txid, None)
+        if record is None:
+            return
+        self.statuses[record['status']].discard(txid)
+        for outpoint in record['outpoints']:
+            self.spenders[outpoint].discard(txid)
+            if not self.spenders[outpoint]:
+                del self.spenders[outpoint]
+
+    def put(self, psbt):
+        '''Add or replace a PSBT, writing only its own file. Returns its txid.'''
+        txid = psbt_txid(psbt)
+        with self.lock:
+            existing = self.records.get(txid)
+            record = {
+                # stored unparsed, like PSBTs read from disk
+                'psbt': LazyPSBT(psbt.serialize()),
+                'created': existing['created'] if existing else time.time(),
+                'status': psbt_status(psbt),
+                'outpoints': psbt_outpoints(psbt),
+            }
+            os.makedirs(full_path(self.directory), exist_ok=True)
+            write_json_file(dict(record, psbt=record['psbt'].serialize()), self.record_path(txid))
+            self.index(txid, record)
+            self.version += 1
+        return txid
+
+    def get(self, txid):
+        with self.lock:
+            record = self.records.get(txid)
+        if record is None:
+            raise JunctionError(f'No PSBT with txid {txid}')
+        return record['psbt']
+
+    def remove(self, txid):
+        '''Delete a PSBT and return it'''
+        with self.lock:
+            psbt = self.get(txid)
+            os.remove(full_path(self.record_path(txid)))
+            self.unindex(txid)
+            self.version += 1
+        return psbt
+
+    def txids(self, status=None):
+        '''txids of every PSBT (or those with a PSBTStatuses status), oldest first'''
+        if status is not None and status not in self.statuses:
+            raise JunctionError(f'Unknown PSBT status "{status}"')
+        with self.lock:
+            txids = self.statuses[status] if status is not None else self.records
+            return sorted(txids, key=lambda txid: (self.records[txid]['created'], txid))
+
+    def all(self):
+        '''Every PSBT, oldest first'''
+        with self.lock:
+            return [self.records[txid]['psbt'] for txid in self.txids()]
+
+    def outpoints(self, txid):
+        with self.lock:
+            self.get(txid)
+            return list(self.records[txid]['outpoints'])
+
+    def spenders_of(self, outpoint):
+        '''txids of PSBTs spending outpoint'''
+        with self.lock:
+            return set(self.spenders.get(outpoint, ()))
+
+class PSBTStores:
+
+    def __init__(self):
+        # full directory path -> PSBTStore, so a changed datadir gets new stores
+        self.stores = {}
+        self.lock = threading.Lock()
+
+    def get(self, wallet_name):
+        directory = f'psbts/{wallet_name}'
+        with self.lock:
+            key = full_path(directory)
+            if key not in self.stores:
+                self.stores[key] = PSBTStore(directory)
+            return self.stores[key]
+
+    def discard(self, wallet_name):
+        '''Delete a wallet's PSBTs, so a new wallet with its name starts without them'''
+        directory = f'psbts/{wallet_name}'
+        with self.lock:
+            self.stores.pop(full_path(directory), None)
+            shutil.rmtree(full_path(directory), ignore_errors=True)
+
+psbt_stores = PSBTStores()
@@ -0,0 +1,241 @@
+'''
+PSBTs as stored on a wallet
+
+Wallet files can carry many large PSBTs, so they're kept as the base64 we
+were given and only deserialized when something reads their fields.
+
+Combining, decoding and finalizing them happens here too, without Bitcoin
+Core, so PSBT status is available even when the node isn't.
+'''
+import struct
+
+from hwilib.serializations import PSBT, CTransaction, CTxInWitness
+
+from utils import JunctionError, sat_to_btc
+from constants import PSBTStatuses
+import descriptors
+
+class LazyPSBT:
+    '''Base64 PSBT with a hwilib PSBT view built on first attribute access'''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.parsed = None
+
+    def parse(self):
+        '''hwilib PSBT view, deserialized once'''
+        if self.parsed is None:
+            psbt = PSBT()
+            psbt.deserialize(self.raw)
+            self.parsed = psbt
+        return self.parsed
+
+    def __getattr__(self, name):
+        # tx, inputs, outputs, ... of the parsed PSBT
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        return getattr(self.parse(), name)
+
+    def serialize(self):
+        '''Base64, reserialized only if the parsed view was handed out (and so may have changed)'''
+        if self.parsed is None:
+            return self.raw
+        self.parsed.tx.rehash()
+        return self.parsed.serialize()
+
+### Combining
+
+def copy_psbt(psbt):
+    '''Independent hwilib PSBT with the same contents as a LazyPSBT'''
+    copy = PSBT()
+    copy.deserialize(psbt.serialize())
+    return copy
+
+def merge_fields(merged, other, fields):
+    '''Fill merged's empty fields from other'''
+    for field in fields:
+        if not getattr(merged, field) and getattr(other, field):
+            setattr(merged, field, getattr(other, field))
+
+def merge_maps(merged, other, fields):
+    '''Add other's entries to merged's dict fields, keeping the ones merged has'''
+    for field in fields:
+        for key, value in getattr(other, field).items():
+            getattr(merged, field).setdefault(key, value)
+
+def combine_psbts(psbts):
+    '''Merge LazyPSBTs of one unsigned transaction into a new LazyPSBT (BIP174's Combiner)
+
+    Signatures, BIP32 derivations, UTXOs and scripts are merged input by input
+    and output by output, like Bitcoin Core's combinepsbt. Combining a PSBT
+    with itself, or with one it already includes, changes nothing.
+    '''
+    merged = copy_psbt(psbts[0])
+    unsigned_tx = merged.tx.serialize_without_witness()
+    for psbt in psbts[1:]:
+        other = copy_psbt(psbt)
+        if other.tx.serialize_without_witness() != unsigned_tx:
+            raise JunctionError('Cannot combine PSBTs of different transactions')
+        for merged_input, other_input in zip(merged.inputs, other.inputs):
+            merge_fields(merged_input, other_input, ['non_witness_utxo', 'witness_utxo', 'sighash',
+                                                     'redeem_script', 'witness_script', 'final_script_sig'])
+            if merged_input.final_script_witness.is_null():
+                merged_input.final_script_witness = other_input.final_script_witness
+            merge_maps(merged_input, other_input, ['partial_sigs', 'hd_keypaths', 'unknown'])
+        for merged_output, other_output in zip(merged.outputs, other.outputs):
+            merge_fields(merged_output, other_output, ['redeem_script', 'witness_script'])
+            merge_maps(merged_output, other_output, ['hd_keypaths', 'unknown'])
+        merge_maps(merged, other, ['unknown'])
+    return LazyPSBT(merged.serialize())
+
+### Analysis
+
+def fingerprint_and_path(keypath):
+    '''hwilib hd_keypaths value -> (fingerprint hex, "m/48'/1'/..." path)'''
+    fingerprint = struct.pack('<I', keypath[0]).hex()
+    steps = [f"{index & 0x7fffffff}'" if index & 0x80000000 else str(index) for index in keypath[1:]]
+    return fingerprint, '/'.join(['m', *steps])
+
+def bip32_derivs(hd_keypaths):
+    derivs = []
+    for pubkey, keypath in sorted(hd_keypaths.items()):
+        fingerprint, path = fingerprint_and_path(keypath)
+        derivs.append({'pubkey': pubkey.hex(), 'master_fingerprint': fingerprint, 'path': path})
+    return derivs
+
+def decode_script_pubkey(script, network):
+    script_type, address = descriptors.script_address(script, network)
+    decoded = {'hex': script.hex(), 'type': script_type}
+    if address is not None:
+        decoded['addresses'] = [address]
+    return decoded
+
+def spent_output(psbt_input, txin):
+    '''CTxOut an input spends, if the PSBT carries it'''
+    if psbt_input.witness_utxo is not None:
+        return psbt_input.witness_utxo
+    if psbt_input.non_witness_utxo is not None:
+        return psbt_input.non_witness_utxo.vout[txin.prevout.n]
+
+def is_final(psbt_input):
+    return bool(psbt_input.final_script_sig) or not psbt_input.final_script_witness.is_null()
+
+def required_signatures(psbt_input):
+    '''Signatures the input's script needs: m for multisig, otherwise 1'''
+    multisig = descriptors.multisig_pubkeys(psbt_input.witness_script)
+    return multisig[0] if multisig else 1
+
+def analyze_input(psbt_input, txin, network):
+    spent = spent_output(psbt_input, txin)
+    signers = {pubkey: fingerprint_and_path(keypath)[0] for pubkey, keypath in psbt_input.hd_keypaths.items()}
+    decoded = {
+        'bip32_derivs': bip32_derivs(psbt_input.hd_keypaths),
+        'signed_by': sorted(signers[pubkey] for pubkey in psbt_input.partial_sigs if pubkey in signers),
+        'missing_signatures': 0 if is_final(psbt_input) else
+            max(required_signatures(psbt_input) - len(psbt_input.partial_sigs), 0),
+    }
+    if spent is not None:
+        decoded['witness_utxo'] = {
+            'amount': sat_to_btc(spent.nValue),
+            'scriptPubKey': decode_script_pubkey(spent.scriptPubKey, network),
+        }
+    if psbt_input.partial_sigs:
+        decoded['partial_signatures'] = {pubkey.hex(): sig.hex() for pubkey, sig in psbt_input.partial_sigs.items()}
+    if psbt_input.redeem_script:
+        decoded['redeem_script'] = {'hex': psbt_input.redeem_script.hex()}
+    if psbt_input.witness_script:
+        decoded['witness_script'] = {'hex': psbt_input.witness_script.hex()}
+    return decoded
+
+def analyze_psbt(psbt, network):
+    '''decodepsbt-style dict of a LazyPSBT, computed without Bitcoin Core
+
+    Covers the fields the frontend reads (tx inputs and outputs, partial
+    signatures, BIP32 derivations, fee), plus which fingerprints signed each
+    input ("signed_by") and how many more signatures it needs
+    ("missing_signatures"). Across all inputs, "signed_by" lists the fingerprints
+    that signed every input, and "missing_signatures" is the largest shortfall.
+    '''
+    tx = psbt.tx
+    tx.rehash()
+    inputs = [analyze_input(psbt_input, txin, network) for psbt_input, txin in zip(psbt.inputs, tx.vin)]
+    spent = [spent_output(psbt_input, txin) for psbt_input, txin in zip(psbt.inputs, tx.vin)]
+
+    decoded = {
+        'tx': {
+            'txid': tx.hash,
+            'version': tx.nVersion,
+            'locktime': tx.nLockTime,
+            'vin': [{'txid': f'{txin.prevout.hash:064x}', 'vout': txin.prevout.n, 'sequence': txin.nSequence}
+                    for txin in tx.vin],
+            'vout': [{'value': sat_to_btc(txout.nValue), 'n': n,
+                      'scriptPubKey': decode_script_pubkey(txout.scriptPubKey, network)}
+                     for n, txout in enumerate(tx.vout)],
+        },
+        'inputs': inputs,
+        'outputs': [{'bip32_derivs': bip32_derivs(output.hd_keypaths)} for output in psbt.outputs],
+        'signed_by': sorted(set.intersection(*[set(i['signed_by']) for i in inputs])) if inputs else [],
+        'missing_signatures': max([i['missing_signatures'] for i in inputs], default=0),
+    }
+    if all(output is not None for output in spent):
+        decoded['fee'] = sat_to_btc(sum(output.nValue for output in spent) - sum(txout.nValue for txout in tx.vout))
+    return decoded
+
+def psbt_txid(psbt):
+    '''txid of the unsigned transaction, which signing doesn't change'''
+    psbt.tx.rehash()
+    return psbt.tx.hash
+
+def psbt_outpoints(psbt):
+    '''(txid, vout) of every coin the PSBT spends'''
+    return [(f'{txin.prevout.hash:064x}', txin.prevout.n) for txin in psbt.tx.vin]
+
+def psbt_status(psbt):
+    '''PSBTStatuses value: ready once every input has the signatures it needs'''
+    if all(is_final(psbt_input) or len(psbt_input.partial_sigs) >= required_signatures(psbt_input)
+           for psbt_input in psbt.inputs):
+        return PSBTStatuses.READY
+    if any(psbt_input.partial_sigs for psbt_input in psbt.inputs):
+        return PSBTStatuses.PARTIALLY_SIGNED
+    return PSBTStatuses.UNSIGNED
+
+### Finalizing
+
+def finalize_input(psbt_input):
+    '''(scriptSig, witness stack) spending a P2WSH or P2SH-P2WSH multisig (or P2WPKH) input'''
+    if psbt_input.witness_script:
+        multisig = descriptors.multisig_pubkeys(psbt_input.witness_script)
+        if multisig is None:
+            raise JunctionError('Can only finalize multisig witness scripts')
+        m, pubkeys = multisig
+        # CHECKMULTISIG wants signatures in the order of their pubkeys, after a dummy element
+        signatures = [psbt_input.partial_sigs[pubkey] for pubkey in pubkeys if pubkey in psbt_input.partial_sigs]
+        if len(signatures) < m:
+            raise JunctionError(f'Input has {len(signatures)} of {m} signatures')
+        stack = [b'', *signatures[:m], psbt_input.witness_script]
+    elif len(psbt_input.partial_sigs) == 1:
+        [(pubkey, signature)] = psbt_input.partial_sigs.items()
+        stack = [signature, pubkey]
+    else:
+        raise JunctionError('Cannot finalize input without a witness script or a single signature')
+
+    # P2SH-wrapped inputs push their witness program
+    script_sig = descriptors.push_data(psbt_input.redeem_script) if psbt_input.redeem_script else b''
+    return script_sig, stack
+
+def finalize_psbt(psbt):
+    '''Hex of the signed transaction, raising JunctionError if any input lacks signatures
+
+    Signatures aren't verified here; the node does that when it's broadcast.
+    '''
+    tx = CTransaction(psbt.tx)
+    tx.wit.vtxinwit = []
+    for psbt_input, txin in zip(psbt.inputs, tx.vin):
+        witness = CTxInWitness()
+        if is_final(psbt_input):
+            txin.scriptSig = psbt_input.final_script_sig
+            witness.scriptWitness.stack = list(psbt_input.final_script_witness.scriptWitness.stack)
+        else:
+            txin.scriptSig, witness.scriptWitness.stack = finalize_input(psbt_input)
+        tx.wit.vtxinwit.append(witness)
+    return tx.serialize_with_witness().hex()
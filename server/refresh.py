@@ -0,0 +1,142 @@
+'''
+Refresh every wallet's GET /wallets entry in parallel
+
+Each wallet's RPC-backed fields (balances, coins, history, ...) run as separate
+jobs on a bounded thread pool. Whatever hasn't finished by the deadline is filled
+in from the wallet's last snapshot and the wallet is marked "stale", so one slow
+wallet can't hold up the rest.
+
+A job still running from an earlier refresh is reused rather than submitted
+again, so a hanging node ties up at most one worker per job, not one per poll.
+'''
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from junction import UNAVAILABLE_EXTRAS
+from snapshots import snapshots
+from utils import node_key
+
+logger = logging.getLogger(__name__)
+
+# Most RPC-backed jobs running at once
+REFRESH_WORKERS = 8
+
+# Seconds a refresh waits before returning stale results
+REFRESH_DEADLINE = 10
+
+class Missing:
+    '''Marks a field whose job didn't finish in time'''
+
+class WalletRefresher:
+
+    def __init__(self, workers=REFRESH_WORKERS, deadline=REFRESH_DEADLINE):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='refresh')
+        self.deadline = deadline
+        # job key -> future for it, until it finishes
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job_key, fn):
+        '''Run fn on the pool, unless the job for job_key hasn't finished yet'''
+        with self.lock:
+            future = self.jobs.get(job_key)
+            if future is not None:
+                return future
+            future = self.executor.submit(fn)
+            self.jobs[job_key] = future
+        future.add_done_callback(lambda future: self.finished(job_key, future))
+        return future
+
+    def finished(self, job_key, future):
+        with self.lock:
+            if self.jobs.get(job_key) is future:
+                del self.jobs[job_key]
+
+    def refresh(self, wallets):
+        '''to_dict(True) for every wallet, plus "stale" telling whether it missed the deadline'''
+        deadline = time.time() + self.deadline
+
+        # One tip / mempool check per node
+        node_states = {}
+        for wallet in wallets:
+            key = node_key(wallet.node)
+            if key not in node_states:
+                node_states[key] = self.submit(('node_state', key), lambda node=wallet.node: snapshots.node_state(node))
+        wait(node_states.values(), timeout=self.remaining(deadline))
+
+        # Fan out the work of every wallet whose snapshot is out of date
+        results = []
+        for wallet in wallets:
+            node_state = node_states[node_key(wallet.node)]
+            key = None
+            if node_state.done() and not node_state.exception():
+                key = snapshots.cache_key(wallet, node_state.result())
+                snapshot = snapshots.lookup(wallet.name, key)
+                if snapshot is not None:
+                    results.append((wallet, key, dict(snapshot, stale=False), {}))
+                    continue
+            # one per node, however many wallets use it
+            jobs = {'rpc_error': self.submit(('rpc_error', node_key(wallet.node)), wallet.node.default_rpc.error)}
+            # no point asking a node we couldn't reach for anything else
+            if key is not None:
+                for field, compute in wallet.extras().items():
+                    # keyed on the snapshot key too, so a result from before a new block isn't reused
+                    jobs[field] = self.submit((wallet.name, field, key), compute)
+            results.append((wallet, key, None, jobs))
+
+        futures = [job for _, _, _, jobs in results for job in jobs.values()]
+        wait(futures, timeout=self.remaining(deadline))
+
+        return [snapshot if snapshot is not None else self.assemble(wallet, key, jobs)
+                for wallet, key, snapshot, jobs in results]
+
+    def assemble(self, wallet, key, jobs):
+        '''Build a wallet's entry from its jobs, falling back to its last snapshot for missing fields'''
+        base = wallet.to_dict()
+        base['psbts'] = wallet.decoded_psbts()
+        base['ready'] = wallet.ready()
+        latest = snapshots.latest(wallet.name) or {}
+        stale = False
+
+        rpc_error = self.job_result(wallet, 'rpc_error', jobs)
+        if rpc_error is Missing:
+            stale = True
+            rpc_error = latest.get('node', {}).get('rpc_error')
+        base['node']['rpc_error'] = rpc_error
+
+        for field, unavailable in UNAVAILABLE_EXTRAS.items():
+            # same as to_dict(True) when the node reports a problem
+            if rpc_error:
+                base[field] = unavailable
+                continue
+            value = self.job_result(wallet, field, jobs)
+            if value is Missing:
+                stale = True
+                value = latest.get(field, unavailable)
+            base[field] = value
+
+        # Only complete, up to date results are worth caching
+        base['stale'] = stale
+        if key is not None and not stale and not rpc_error:
+            snapshots.store(wallet.name, key, base)
+        return base
+
+    def job_result(self, wallet, field, jobs):
+        '''Result of a field's job, or Missing if it wasn't run, didn't finish or failed'''
+        job = jobs.get(field)
+        if job is None:
+            return Missing
+        if not job.done() or job.cancelled():
+            logger.info(f'"{wallet.name}" {field} missed the refresh deadline')
+            return Missing
+        if job.exception():
+            logger.info(f'"{wallet.name}" {field} failed: {job.exception()}')
+            return Missing
+        return job.result()
+
+    def remaining(self, deadline):
+        return max(deadline - time.time(), 0)
+
+refresher = WalletRefresher()
@@ -0,0 +1,96 @@
+'''
+Live Wallet objects shared by every API request
+
+A wallet is read from disk once and reused until its file's signature (inode,
+mtime, size) changes, e.g. because another process rewrote it. Watch-only
+Bitcoin Core wallet setup runs once per wallet and node per process.
+'''
+import logging
+import threading
+from contextlib import contextmanager
+
+from junction import Wallet
+from disk import file_signature, get_wallet_names
+from utils import node_key
+
+logger = logging.getLogger(__name__)
+
+class WalletRegistry:
+
+    def __init__(self):
+        # wallet name -> Wallet
+        self.wallets = {}
+        # (wallet name, host, port) whose watch-only wallet is known to be loaded
+        self.watchonly = set()
+        # wallet name -> lock held while a request changes the wallet
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, wallet_name, ensure_watchonly=True):
+        '''Wallet, reloaded only if its file changed since we last read or wrote it'''
+        signature = file_signature(f'wallets/{wallet_name}.json')
+        with self.lock:
+            wallet = self.wallets.get(wallet_name)
+        if wallet is None or wallet.signature != signature:
+            wallet = Wallet.open(wallet_name, ensure_watchonly=False)
+            with self.lock:
+                self.wallets[wallet_name] = wallet
+        if ensure_watchonly:
+            self.ensure_watchonly(wallet)
+        return wallet
+
+    def all(self):
+        '''Every wallet in the datadir, without touching the node'''
+        return [self.get(wallet_name, ensure_watchonly=False) for wallet_name in get_wallet_names()]
+
+    def add(self, wallet):
+        '''Register a wallet that was just created (and so has its watch-only wallet)'''
+        with self.lock:
+            self.wallets[wallet.name] = wallet
+            self.watchonly.add(self.watchonly_key(wallet))
+
+    def ensure_watchonly(self, wallet):
+        key = self.watchonly_key(wallet)
+        with self.lock:
+            if key in self.watchonly:
+                return
+        try:
+            if wallet.ensure_watchonly():
+                # a new Bitcoin Core wallet, e.g. the node's was deleted, watches none of our pool
+                wallet.reset_imports()
+        except Exception as e:
+            # try again next request
+            logger.info(f'Could not load Bitcoin Core "{wallet.name}" wallet: {e}')
+            return
+        with self.lock:
+            self.watchonly.add(key)
+
+    def watchonly_key(self, wallet):
+        return (wallet.name, *node_key(wallet.node))
+
+    def wallet_lock(self, wallet_name):
+        with self.lock:
+            return self.locks.setdefault(wallet_name, threading.RLock())
+
+    @contextmanager
+    def editing(self, wallet_name):
+        '''Wallet, locked against other requests changing it'''
+        with self.wallet_lock(wallet_name):
+            wallet = self.get(wallet_name)
+            try:
+                yield wallet
+            except:
+                # changes may not have been saved, so reread the file next time
+                self.forget(wallet_name)
+                raise
+
+    def forget(self, wallet_name=None):
+        '''Drop one cached wallet, or every wallet and watch-only check'''
+        with self.lock:
+            if wallet_name is None:
+                self.wallets.clear()
+                self.watchonly.clear()
+            else:
+                self.wallets.pop(wallet_name, None)
+
+registry = WalletRegistry()
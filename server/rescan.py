@@ -0,0 +1,79 @@
+'''
+Background rescans for POST /rescan, with progress for GET /rescan
+
+Rescans run in RESCAN_CHUNK sized rescanblockchain calls over the blocks since
+the wallet's birthday, so they report progress and never rescan the whole chain
+unless asked to.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import JunctionError
+from registry import registry
+from snapshots import snapshots
+
+logger = logging.getLogger(__name__)
+
+# Wallets rescanning at once
+RESCAN_WORKERS = 2
+
+class Rescans:
+
+    def __init__(self, workers=RESCAN_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rescan')
+        # wallet name -> progress of its latest rescan
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def start(self, wallet_name, start=None, stop=None):
+        '''Start rescanning blocks start..stop (default: birthday to tip) and return its progress'''
+        wallet = registry.get(wallet_name)
+        if start is None:
+            start = wallet.birthday_height()
+        if stop is None:
+            stop = wallet.node.wallet_rpc.getblockcount()
+        if start > stop:
+            raise JunctionError(f'Rescan start ({start}) is after stop ({stop})')
+
+        with self.lock:
+            if self.running(wallet_name):
+                raise JunctionError(f'"{wallet_name}" is already rescanning')
+            self.progress[wallet_name] = {
+                'start': start,
+                'stop': stop,
+                # last block rescanned
+                'height': None,
+                'done': False,
+                'error': None,
+            }
+        self.executor.submit(self.run, wallet, start, stop)
+        return self.status(wallet_name)
+
+    def run(self, wallet, start, stop):
+        def progress(height):
+            self.update(wallet.name, height=height)
+        try:
+            wallet.rescan(start, stop, progress=progress)
+            self.update(wallet.name, done=True)
+        except Exception as e:
+            logger.exception(e)
+            self.update(wallet.name, done=True, error=str(e))
+        finally:
+            # balances and history may have changed
+            snapshots.invalidate(wallet.name)
+
+    def update(self, wallet_name, **fields):
+        with self.lock:
+            self.progress[wallet_name] = dict(self.progress[wallet_name], **fields)
+
+    def running(self, wallet_name):
+        progress = self.progress.get(wallet_name)
+        return progress is not None and not progress['done']
+
+    def status(self, wallet_name):
+        '''Progress of the wallet's latest rescan, or None'''
+        with self.lock:
+            return self.progress.get(wallet_name)
+
+rescans = Rescans()
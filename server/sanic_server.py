@@ -1,21 +1,413 @@
+'''
+asyncio API server with the same routes as the Flask blueprint in api.py
+
+The GET /wallets poll checks each node's chain tip and mempool with the async
+JSON-RPC client and answers from the snapshot cache without touching a thread.
+Everything that blocks -- recomputing wallets, wallet file I/O, and HWI's USB
+calls -- runs on executors, so one process can serve many polling clients.
+'''
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson
+from jsonschema import Draft4Validator
 from sanic import Sanic
-from sanic.response import json
-from hwilib import commands
-from disk import get_wallets
+from sanic.response import json, stream
+
+from junction import Wallet, JunctionError, Node, GAP_LIMIT, DiscoveryMethods
+from disk import ensure_datadir
+from utils import BadRequest, get_nodes, device_cache, node_key
+from async_rpc import AsyncRPC
+from snapshots import snapshots
+from refresh import refresher
+from registry import registry
+from address_pool import address_pool_filler
+from rescan import rescans
+from notifications import notifications
+from events import wallet_events, HEARTBEAT_INTERVAL, KEEPALIVE
+from api import (client_group, add_device_signer, sign_with_device, sign_with_devices,
+                 display_address_on_device, register_multisig_on_device, parse_outputs,
+                 transactions_page, utxos_dict, psbts_dict, required_arg)
+import schemas
+
+app = Sanic(__name__)
+logger = logging.getLogger(__name__)
+
+# Threads for wallet and bitcoind work that hasn't been made async
+RPC_WORKERS = 8
+rpc_executor = ThreadPoolExecutor(max_workers=RPC_WORKERS, thread_name_prefix='rpc')
+
+# Threads for HWI, which blocks on USB (and on users pressing buttons)
+HWI_WORKERS = 4
+hwi_executor = ThreadPoolExecutor(max_workers=HWI_WORKERS, thread_name_prefix='hwi')
+
+# AsyncRPC per node URI, so keep-alive connections are reused across requests
+async_rpcs = {}
+
+### Helpers
+
+class ValidationFailed(Exception):
+
+    def __init__(self, errors):
+        super().__init__('Error validating against schema')
+        self.errors = errors
+
+def validate(request, schema):
+    '''Request body, checked against one of the schemas the Flask server uses'''
+    body = request.json or {}
+    errors = list(Draft4Validator(schema).iter_errors(body))
+    if errors:
+        raise ValidationFailed(errors)
+    return body
+
+def respond(body, status=200):
+    # simplejson serializes the Decimals bitcoind gives us
+    return json(body, status=status, dumps=simplejson.dumps)
+
+async def run_blocking(executor, fn, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+def async_rpc(rpc):
+    if rpc.uri not in async_rpcs:
+        async_rpcs[rpc.uri] = AsyncRPC(rpc.uri, timeout=rpc.timeout)
+    return async_rpcs[rpc.uri]
+
+def open_wallet(wallet_name):
+    return run_blocking(rpc_executor, registry.get, wallet_name)
 
-app = Sanic()
+def edit_wallet(wallet_name, fn, *args, **kwargs):
+    '''fn(wallet, ...) while holding the registry's lock on the wallet (blocks, so run it on an executor)'''
+    with registry.editing(wallet_name) as wallet:
+        return fn(wallet, *args, **kwargs)
 
-@app.route('/devices')
+### Errors
+
+@app.exception(ValidationFailed)
+async def handle_validation_error(request, e):
+    return respond({
+        'error': str(e),
+        'errors': [validation_error.message for validation_error in e.errors],
+    }, 400)
+
+@app.exception(BadRequest)
+async def handle_bad_request(request, error):
+    return respond({'error': str(error)}, 400)
+
+@app.exception(Exception)
+async def handle_unexpected_error(request, error):
+    logger.exception(error)
+    return respond({'error': str(error)}, 500)
+
+@app.listener('before_server_start')
+async def watch_nodes(app, loop):
+    # Keep wallet caches current as blocks and transactions arrive, and tell event streams
+    notifications.subscribe(wallet_events.publish)
+    notifications.start()
+
+@app.listener('after_server_stop')
+async def stop_watching_nodes(app, loop):
+    notifications.stop()
+    notifications.unsubscribe(wallet_events.publish)
+
+@app.middleware('request')
+async def before_request(request):
+    ensure_datadir()
+
+@app.middleware('response')
+async def allow_cors(request, response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+### Devices
+
+@app.route('/devices', methods=['GET'])
 async def list_devices(request):
-    return json(commands.enumerate())
+    return respond(await run_blocking(hwi_executor, device_cache.enumerate))
+
+@app.route('/prompt', methods=['POST'])
+async def prompt_device(request):
+    body = validate(request, schemas.PROMPT_DEVICE)
+    wallet = await open_wallet(body['wallet_name'])
+    await run_blocking(hwi_executor, client_group.close)
+    await run_blocking(hwi_executor, client_group.prompt_pin, wallet.network)
+    return respond({})
+
+@app.route('/prompt', methods=['DELETE'])
+async def destroy_client(request):
+    '''Kill the persistent CLIENT required for Trezor PIN entry'''
+    await run_blocking(hwi_executor, client_group.close)
+    return respond({})
+
+@app.route('/unlock', methods=['POST'])
+async def unlock_device(request):
+    '''Prompt every device that's plugged in'''
+    body = validate(request, schemas.UNLOCK_DEVICE)
+    pin = body.get('pin')
+    if not pin:
+        raise Exception("'pin' or 'password' must be present")
+    success = await run_blocking(hwi_executor, client_group.send_pin, pin)
+    if not success:
+        raise Exception('Failed to unlock device')
+    await run_blocking(hwi_executor, client_group.close)
+    return respond({})
 
-@app.route('/wallets')
+### Wallets
+
+async def node_state(node):
+    '''Chain tip and mempool state of node, fetched without blocking'''
+    rpc = async_rpc(node.default_rpc)
+    best_block_hash, mempool_info = await rpc.batch([('getbestblockhash', []), ('getmempoolinfo', [])])
+    return snapshots.remember_node_state(node, best_block_hash, mempool_info)
+
+@app.route('/wallets', methods=['GET'])
 async def list_wallets(request):
-    # TODO: does this include addresses?
-    wallets = get_wallets()
-    # FIXME: probably shouldn't include xpubs in this response?
-    wallet_dicts = [wallet.to_dict(True) for wallet in wallets]
-    return json(wallet_dicts)
+    wallets = await run_blocking(rpc_executor, registry.all)
+
+    # One tip / mempool check per node, all at once
+    nodes = {}
+    for wallet in wallets:
+        nodes.setdefault(node_key(wallet.node), wallet.node)
+    states = await asyncio.gather(*[node_state(node) for node in nodes.values()], return_exceptions=True)
+    states = dict(zip(nodes.keys(), states))
+
+    # Serve unchanged wallets straight from cache
+    wallet_dicts = [None] * len(wallets)
+    outdated = []
+    for i, wallet in enumerate(wallets):
+        state = states[node_key(wallet.node)]
+        snapshot = None
+        if not isinstance(state, Exception):
+            snapshot = snapshots.lookup(wallet.name, snapshots.cache_key(wallet, state))
+        if snapshot is not None:
+            wallet_dicts[i] = dict(snapshot, stale=False)
+        else:
+            outdated.append(i)
+
+    # Recompute the rest on worker threads
+    if outdated:
+        refreshed = await run_blocking(rpc_executor, refresher.refresh, [wallets[i] for i in outdated])
+        for i, wallet_dict in zip(outdated, refreshed):
+            wallet_dicts[i] = wallet_dict
+    return respond(wallet_dicts)
+
+@app.route('/wallets/events', methods=['GET'])
+async def stream_wallet_events(request):
+    '''Server-sent events with each wallet's changes, replacing GET /wallets polling'''
+    loop = asyncio.get_event_loop()
+    queued = asyncio.Event()
+    subscriber = wallet_events.subscribe(wakeup=lambda: loop.call_soon_threadsafe(queued.set))
+
+    async def write_events(response):
+        try:
+            for event in await run_blocking(rpc_executor, wallet_events.snapshot_events):
+                await response.write(event)
+            while not subscriber.closed:
+                try:
+                    await asyncio.wait_for(queued.wait(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(KEEPALIVE)
+                    continue
+                queued.clear()
+                for event in subscriber.drain():
+                    await response.write(event)
+        finally:
+            wallet_events.unsubscribe(subscriber)
+
+    return stream(write_events, content_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+    })
+
+@app.route('/wallets', methods=['POST'])
+async def create_wallet(request):
+    body = validate(request, schemas.CREATE_WALLET)
+    node_args = body.pop('node')
+    node = Node(**node_args, wallet_name=body['name'], network=body['network'])
+    # check that node is reachable
+    await async_rpc(node.default_rpc).test()
+    wallet = await run_blocking(rpc_executor, Wallet.create, **body, node=node)
+    registry.add(wallet)
+    return respond(await run_blocking(rpc_executor, wallet.to_dict, True))
+
+@app.route('/signers', methods=['POST'])
+async def add_signer(request):
+    body = validate(request, schemas.ADD_SIGNER)
+    wallet_dict = await run_blocking(hwi_executor, edit_wallet, body['wallet_name'], add_signer_to_dict,
+                                     body['signer_name'], body['device_id'])
+    address_pool_filler.request(body['wallet_name'])
+    return respond(wallet_dict)
+
+def add_signer_to_dict(wallet, signer_name, device_id):
+    add_device_signer(wallet, signer_name, device_id)
+    return wallet.to_dict()
+
+@app.route('/address', methods=['POST'])
+async def address(request):
+    body = validate(request, schemas.ADDRESS)
+    addresses = await run_blocking(rpc_executor, edit_wallet, body['wallet_name'],
+                                   Wallet.derive_receiving_addresses, body.get('count', 1))
+    address_pool_filler.request(body['wallet_name'])
+    return respond({
+        'address': addresses[0],
+        'addresses': addresses,
+    })
+
+@app.route('/sync', methods=['POST'])
+async def sync(request):
+    body = validate(request, schemas.SYNC)
+    wallet = await open_wallet(body['wallet_name'])
+    await run_blocking(rpc_executor, wallet.sync, ranged=body.get('ranged', True))
+    # imports don't touch the wallet file, but change what "synced" reports
+    snapshots.invalidate(wallet.name)
+    return respond({})
+
+@app.route('/discover', methods=['POST'])
+async def discover(request):
+    '''Find addresses used beyond the wallet's indices, e.g. after a restore'''
+    body = validate(request, schemas.DISCOVER)
+    indices = await run_blocking(rpc_executor, edit_wallet, body['wallet_name'], Wallet.discover,
+                                 gap_limit=body.get('gap_limit', GAP_LIMIT),
+                                 method=body.get('method', DiscoveryMethods.SCANTXOUTSET))
+    return respond(indices)
+
+@app.route('/rescan', methods=['POST'])
+async def start_rescan(request):
+    '''Rescan blocks in the background, by default those since the wallet was created'''
+    body = validate(request, schemas.RESCAN)
+    status = await run_blocking(rpc_executor, rescans.start, body['wallet_name'], body.get('start'), body.get('stop'))
+    return respond(status)
+
+@app.route('/rescan', methods=['GET'])
+async def rescan_status(request):
+    return respond(rescans.status(required_arg(request.args, 'wallet_name')))
+
+### PSBTs
+
+@app.route('/psbt', methods=['POST'])
+async def create_psbt(request):
+    body = validate(request, schemas.CREATE_PSBT)
+    outputs, subtract_fees = parse_outputs(body['outputs'])
+    txid, psbt = await run_blocking(rpc_executor, edit_wallet, body['wallet_name'], create_psbt_for,
+                                    outputs, subtract_fees)
+    address_pool_filler.request(body['wallet_name'])
+    wallet_events.publish_later(body['wallet_name'])
+    return respond({
+        'psbt': psbt.serialize(),
+        'txid': txid,
+    })
+
+def create_psbt_for(wallet, outputs, subtract_fees):
+    txid = wallet.create_psbt(outputs, subtract_fees=subtract_fees)
+    return txid, wallet.psbt_store.get(txid)
+
+@app.route('/psbt', methods=['DELETE'])
+async def abandon_psbt(request):
+    body = validate(request, schemas.ABANDON_PSBT)
+    await run_blocking(rpc_executor, edit_wallet, body['wallet_name'], remove_psbt_for, body)
+    wallet_events.publish_later(body['wallet_name'])
+    return respond({})
+
+def remove_psbt_for(wallet, body):
+    wallet.remove_psbt(wallet.psbt_txid(body.get('txid'), body.get('index')))
+
+@app.route('/psbts', methods=['GET'])
+async def list_psbts(request):
+    '''A wallet's decoded PSBTs, optionally only those with ?status= (unsigned, partially_signed, ready)'''
+    wallet = await open_wallet(required_arg(request.args, 'wallet_name'))
+    return respond(await run_blocking(rpc_executor, psbts_dict, wallet, request.args.get('status')))
+
+@app.route('/sign', methods=['POST'])
+async def sign_psbt(request):
+    body = validate(request, schemas.SIGN_PSBT)
+    wallet = await open_wallet(body['wallet_name'])
+    txid = wallet.psbt_txid(body.get('txid'), body.get('index'))
+    new_psbt = await run_blocking(hwi_executor, sign_with_device, body['wallet_name'], body['device_id'], txid)
+    wallet_events.publish_later(body['wallet_name'])
+    return respond({
+        'psbt': new_psbt.serialize(),
+    })
+
+@app.route('/sign-batch', methods=['POST'])
+async def sign_psbt_batch(request):
+    body = validate(request, schemas.SIGN_PSBT_BATCH)
+    wallet = await open_wallet(body['wallet_name'])
+    txid = wallet.psbt_txid(body.get('txid'), body.get('index'))
+    new_psbt, errors = await run_blocking(hwi_executor, sign_with_devices, body['wallet_name'],
+                                          body['device_ids'], txid)
+    wallet_events.publish_later(body['wallet_name'])
+    return respond({
+        'psbt': new_psbt.serialize(),
+        'errors': errors,
+    })
+
+@app.route('/broadcast', methods=['POST'])
+async def broadcast(request):
+    body = validate(request, schemas.BROADCAST)
+    wallet = await open_wallet(body['wallet_name'])
+    txid = wallet.psbt_txid(body.get('txid'), body.get('index'))
+    txid = await run_blocking(rpc_executor, edit_wallet, body['wallet_name'], Wallet.broadcast, txid)
+    wallet_events.publish_later(body['wallet_name'])
+    return respond({
+        'txid': txid,
+    })
+
+@app.route('/utxos', methods=['GET'])
+async def list_utxos(request):
+    '''A wallet's unspent coins and balances, from its UTXO index'''
+    wallet = await open_wallet(required_arg(request.args, 'wallet_name'))
+    return respond(await run_blocking(rpc_executor, utxos_dict, wallet))
+
+@app.route('/transactions', methods=['GET'])
+async def list_transactions(request):
+    '''A page of a wallet's history, newest first, or what changed since a "cursor" block hash'''
+    wallet = await open_wallet(required_arg(request.args, 'wallet_name'))
+    page = await run_blocking(rpc_executor, transactions_page, wallet, request.args)
+    return respond(page)
+
+### Nodes
+
+@app.route('/nodes', methods=['GET'])
+async def list_nodes(request):
+    nodes = await run_blocking(rpc_executor, get_nodes)
+    errors = await asyncio.gather(*[async_rpc(node.default_rpc).error() for node in nodes])
+    node_dicts = []
+    for node, error in zip(nodes, errors):
+        node_dict = node.to_dict(False)
+        node_dict['rpc_error'] = error
+        node_dicts.append(node_dict)
+    return respond({
+        "bitcoin": node_dicts,
+        "lightning": [],
+    })
+
+@app.route('/nodes', methods=['PUT'])
+async def update_node(request):
+    body = validate(request, schemas.UPDATE_NODE)
+    wallet_name = body.pop('wallet_name')
+    wallet = await open_wallet(wallet_name)
+    node = Node(**body, wallet_name=wallet.name, network=wallet.network)
+    await async_rpc(node.default_rpc).test()
+    await run_blocking(rpc_executor, edit_wallet, wallet_name, Wallet.set_node, node)
+    return respond({})
+
+### Hardware wallet displays
+
+@app.route('/display-address', methods=['POST'])
+async def display_address(request):
+    body = validate(request, schemas.DISPLAY_ADDRESS)
+    wallet = await open_wallet(body['wallet_name'])
+    await run_blocking(hwi_executor, display_address_on_device, wallet, body['address'], body['device_id'])
+    return respond({
+        'ok': True
+    })
+
+@app.route('/register-device', methods=['POST'])
+async def register_device(request):
+    body = validate(request, schemas.REGISTER_DEVICE)
+    wallet = await open_wallet(body['wallet_name'])
+    await run_blocking(hwi_executor, register_multisig_on_device, wallet, body['device_id'])
+    return respond({'ok': True})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8001, debug=True)
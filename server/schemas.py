@@ -0,0 +1,177 @@
+'''
+JSON schemas for API request bodies, shared by the Flask and Sanic servers
+'''
+
+PROMPT_DEVICE = {
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+    },
+}
+
+UNLOCK_DEVICE = {
+    'properties': {
+        'pin': { 'type': 'string' },  # trezor
+        'password': { 'type': 'string' },  # bitbox
+    },
+}
+
+CREATE_WALLET = {
+    'required': ['name', 'm', 'n', 'network', 'node'],
+    'properties': {
+        'name': { 'type': 'string' },
+        'm': { 'type': 'integer' },
+        'n': { 'type': 'integer' },
+        'network': { 'type': 'string' },
+        'node': {
+            'required': ['user', 'password', 'host', 'port'],
+            'properties': {
+                'user': { 'type': 'string' },
+                'password': { 'type': 'string' },
+                'host': { 'type': 'string' },
+                'port': { 'type': 'string' },
+            }
+        }
+    },
+}
+
+ADD_SIGNER = {
+    'required': ['wallet_name', 'signer_name', 'device_id'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        'signer_name': { 'type': 'string' },
+        'device_id': { 'type': 'string' },
+    },
+}
+
+ADDRESS = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        # issue several addresses at once, with a single wallet file write
+        'count': { 'type': 'integer', 'minimum': 1, 'maximum': 1000 },
+    },
+}
+
+CREATE_PSBT = {
+    'required': ['outputs'],
+    'properties': {
+        'wallet_name': {'type': 'string'},
+        # todo: inputs, feerate, rbf, etc
+        'outputs': {
+            'type': 'array',
+            'items': {
+                'required': ['address', 'btc', 'subtract_fees'],
+                'properties': {
+                    'address': {'type': 'string'},   # FIXME: regex
+                    'btc': {'type': 'number'},      # FIXME: regex
+                    # 'satoshis': {'type': 'integer'},      # FIXME: regex
+                    'subtract_fees': { 'type': 'boolean' }
+                },
+            },
+        },
+    },
+}
+
+# The PSBT's unsigned txid, or (older clients) its position in the wallet's psbts
+PSBT_REF = {
+    'txid': { 'type': 'string' },
+    'index': { 'type': 'integer' },
+}
+PSBT_REF_REQUIRED = [{'required': ['txid']}, {'required': ['index']}]
+
+ABANDON_PSBT = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        **PSBT_REF,
+    },
+    'anyOf': PSBT_REF_REQUIRED,
+}
+
+SIGN_PSBT = {
+    'required': ['wallet_name', 'device_id'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        'device_id': { 'type': 'string' },  # FIXME: regex
+        **PSBT_REF,
+    },
+    'anyOf': PSBT_REF_REQUIRED,
+}
+
+SIGN_PSBT_BATCH = {
+    'required': ['wallet_name', 'device_ids'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        'device_ids': {
+            'type': 'array',
+            'items': { 'type': 'string' },
+            'minItems': 1,
+        },
+        **PSBT_REF,
+    },
+    'anyOf': PSBT_REF_REQUIRED,
+}
+
+UPDATE_NODE = {
+    'required': ['wallet_name', 'user', 'password', 'host', 'port'],
+    'properties': {
+        'wallet_name': {'type': 'string'},
+        'user': {'type': 'string'},
+        'password': {'type': 'string'},
+        'host': {'type': 'string'},
+        'port': {'type': 'string'},
+    },
+}
+
+SYNC = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': {'type': 'string'},
+        # import each branch as one ranged descriptor (default), or address by address
+        'ranged': {'type': 'boolean'},
+    },
+}
+RESCAN = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': {'type': 'string'},
+        # block heights, defaulting to the wallet's birthday and the chain tip
+        'start': {'type': 'integer', 'minimum': 0},
+        'stop': {'type': 'integer', 'minimum': 0},
+    },
+}
+DISCOVER = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': {'type': 'string'},
+        # unused addresses in a row after which discovery stops
+        'gap_limit': {'type': 'integer', 'minimum': 1},
+        'method': {'type': 'string', 'enum': ['scantxoutset', 'rescan']},
+    },
+}
+
+BROADCAST = {
+    'required': ['wallet_name'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        **PSBT_REF,
+    },
+    'anyOf': PSBT_REF_REQUIRED,
+}
+
+DISPLAY_ADDRESS = {
+    'required': ['wallet_name', 'address', 'device_id'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        'address': { 'type': 'string' },
+        'device_id': { 'type': 'string' },
+    },
+}
+
+REGISTER_DEVICE = {
+    'required': ['wallet_name', 'device_id'],
+    'properties': {
+        'wallet_name': { 'type': 'string' },
+        'device_id': { 'type': 'string' },
+    },
+}
@@ -3,6 +3,8 @@ from flask import Flask, send_from_directory, render_template
 from api import api, schema
 from flask_cors import CORS
 from disk import ensure_datadir
+from notifications import notifications
+from events import wallet_events
 
 server = Flask(__name__, static_folder="build/static", template_folder="build")
 CORS(server)
@@ -14,9 +16,20 @@ schema.init_app(server)
 def index():
     return render_template('index.html')
 
+def run(**kwargs):
+    '''server.run(), keeping wallet caches current as blocks and transactions arrive while it's up'''
+    # Blocks and transactions change balances, coins and history
+    notifications.subscribe(wallet_events.publish)
+    notifications.start()
+    try:
+        server.run(**kwargs)
+    finally:
+        notifications.stop()
+        notifications.unsubscribe(wallet_events.publish)
+
 def serve():
-    server.run(host='0.0.0.0', port=37128, threaded=True)
+    run(host='0.0.0.0', port=37128, threaded=True)
 
 if __name__ == '__main__':
-    # Run dev server
-    server.run(debug=True, host='0.0.0.0', port=37128, threaded=False)        
+    # Run dev server. Threaded, since an event stream holds on to its worker.
+    run(debug=True, host='0.0.0.0', port=37128, threaded=True)
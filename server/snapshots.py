@@ -0,0 +1,95 @@
+'''
+Cached Wallet.to_dict(True) results for the GET /wallets poll
+
+A snapshot stays valid until the node's chain tip or mempool changes, or the
+wallet file or its PSBTs are rewritten. Checking that costs one batched round trip per node.
+'''
+import logging
+import threading
+import time
+
+from disk import file_signature
+from utils import node_key
+
+logger = logging.getLogger(__name__)
+
+# Seconds a node's tip / mempool state is trusted before asking again
+NODE_STATE_TTL = 1
+
+class WalletSnapshots:
+
+    def __init__(self):
+        # wallet name -> (cache key, wallet dict)
+        self.snapshots = {}
+        # (host, port) -> (time fetched, node state)
+        self.node_states = {}
+        self.lock = threading.Lock()
+
+    def node_state(self, node):
+        '''(best block hash, mempool size, mempool bytes) of node'''
+        with self.lock:
+            fetched_at, state = self.node_states.get(node_key(node), (0, None))
+        if time.time() - fetched_at < NODE_STATE_TTL:
+            return state
+
+        batch = node.default_rpc.batch()
+        best_block_hash = batch.getbestblockhash()
+        mempool_info = batch.getmempoolinfo()
+        batch.send()
+        return self.remember_node_state(node, best_block_hash.result(), mempool_info.result())
+
+    def remember_node_state(self, node, best_block_hash, mempool_info):
+        '''Record getbestblockhash / getmempoolinfo results, however they were fetched'''
+        state = (best_block_hash, mempool_info['size'], mempool_info['bytes'])
+        with self.lock:
+            self.node_states[node_key(node)] = (time.time(), state)
+        return state
+
+    def cache_key(self, wallet, node_state=None):
+        '''Snapshot of wallet stays valid while this is unchanged'''
+        if node_state is None:
+            node_state = self.node_state(wallet.node)
+        return (node_state, file_signature(wallet.wallet_file_path()), wallet.psbt_store.version)
+
+    def lookup(self, wallet_name, key):
+        '''Cached snapshot if it was stored under key'''
+        with self.lock:
+            cached_key, snapshot = self.snapshots.get(wallet_name, (None, None))
+        if cached_key == key:
+            return snapshot
+
+    def latest(self, wallet_name):
+        '''Most recent snapshot, however old'''
+        with self.lock:
+            return self.snapshots.get(wallet_name, (None, None))[1]
+
+    def store(self, wallet_name, key, snapshot):
+        with self.lock:
+            self.snapshots[wallet_name] = (key, snapshot)
+
+    def get(self, wallet):
+        '''wallet.to_dict(True), recomputed only if something changed'''
+        try:
+            key = self.cache_key(wallet)
+        except Exception as e:
+            # Node unreachable: to_dict reports it, and nothing is worth caching
+            logger.info(f'Not caching "{wallet.name}" snapshot: {e}')
+            self.invalidate(wallet.name)
+            return wallet.to_dict(True)
+
+        snapshot = self.lookup(wallet.name, key)
+        if snapshot is None:
+            snapshot = wallet.to_dict(True)
+            self.store(wallet.name, key, snapshot)
+        return snapshot
+
+    def invalidate(self, wallet_name=None):
+        '''Forget one wallet's snapshot, or every snapshot and node state'''
+        with self.lock:
+            if wallet_name is None:
+                self.snapshots.clear()
+                self.node_states.clear()
+            else:
+                self.snapshots.pop(wallet_name, None)
+
+snapshots = WalletSnapshots()
@@ -1,14 +1,30 @@
 import unittest
+import threading
 import tempfile
 import os
 import logging
+import json
+from unittest import mock
+from contextlib import contextmanager
 from decimal import Decimal
-from junction import Wallet, JunctionError, Node
+from hwilib.serializations import PartiallySignedInput
+from junction import Wallet, JunctionError, Node, HardwareSigner, DiscoveryMethods
 
 from .utils import start_bitcoind
 
+import api
+import address_pool
 import disk
-from utils import JSONRPCException
+import descriptors
+import snapshots
+from refresh import WalletRefresher
+from registry import WalletRegistry
+from utils import JSONRPCException, xpub_cache, rpc_pool, DeviceCache, DeviceLocks
+from history import history_indexes
+from psbts import LazyPSBT, required_signatures, finalize_input
+from constants import PSBTStatuses
+from notifications import ChainNotifications
+from events import WalletEvents, KEEPALIVE
 
 # uncomment for logging output in tests
 # logging.basicConfig(level=logging.INFO)
@@ -49,7 +65,7 @@ def make_node(testcase):
         user=testcase.rpc_user,
         password=testcase.rpc_password,
         wallet_name=wallet_name,
-        network='testnet',
+        network='regtest',
     )
 
 def make_wallet_file(testcase):
@@ -62,7 +78,7 @@ def make_wallet_file(testcase):
         'psbts': [],
         'receiving_address_index': 0,
         'change_address_index': 0,
-        'network': 'testnet',
+        'network': 'regtest',
         'script_type': 'native',
         'node': {
             'host': '127.0.0.1',
@@ -70,7 +86,7 @@ def make_wallet_file(testcase):
             'user': testcase.rpc_user,
             'password': testcase.rpc_password,
             'wallet_name': wallet_name,
-            'network': 'testnet',
+            'network': 'regtest',
         },
     }
     disk.write_json_file(wallet_file, f'wallets/{wallet_name}.json')
@@ -226,6 +242,219 @@ class WalletTests(unittest.TestCase):
             final_contents = f.read()
         self.assertEqual(initial_contents, final_contents)
 
+    def test_atomic_write(self):
+        '''Wallet files are replaced, never rewritten in place'''
+        wallet = make_wallet(self)
+        wallet_file_path = os.path.join(self.wallet_dir, f'{wallet.name}.json')
+        inode = os.stat(wallet_file_path).st_ino
+        wallet.save()
+        self.assertNotEqual(os.stat(wallet_file_path).st_ino, inode)
+        # no temp files left behind
+        self.assertEqual(os.listdir(self.wallet_dir), [f'{wallet.name}.json'])
+
+    def test_coalesced_saves(self):
+        wallet = make_wallet(self)
+        signature = disk.file_signature(f'wallets/{wallet.name}.json')
+
+        # Nothing written until the block exits
+        with wallet.coalesced_saves():
+            addresses = [wallet.derive_receiving_address() for _ in range(3)]
+            self.assertEqual(disk.file_signature(f'wallets/{wallet.name}.json'), signature)
+        self.assertEqual(Wallet.open(wallet.name).receiving_address_index, 3)
+
+        # Same addresses as deriving them one by one
+        self.assertEqual(addresses, [wallet.address(False, i) for i in range(3)])
+        self.assertEqual(len(wallet.derive_receiving_addresses(2)), 2)
+        self.assertEqual(Wallet.open(wallet.name).receiving_address_index, 5)
+
+        # Indices handed out before a failure still reach disk
+        with self.assertRaises(ValueError):
+            with wallet.coalesced_saves():
+                wallet.derive_receiving_address()
+                raise ValueError()
+        self.assertEqual(Wallet.open(wallet.name).receiving_address_index, 6)
+
+    def test_address_pool(self):
+        wallet = make_wallet(self)
+        self.assertEqual(len(wallet.address_pool_shortfall(10)), 2)
+        wallet.fill_address_pool(10)
+        self.assertEqual(wallet.receiving_imported_index, 10)
+        self.assertEqual(wallet.change_imported_index, 10)
+        self.assertEqual(wallet.address_pool_shortfall(10), [])
+        self.assertEqual(Wallet.open(wallet.name).receiving_imported_index, 10)
+
+        # Pooled addresses are already watched, and match local derivation
+        addresses = wallet.derive_receiving_addresses(5)
+        self.assertEqual(addresses, [wallet.address(False, i) for i in range(5)])
+        for address in addresses:
+            self.assertTrue(wallet.node.wallet_rpc.getaddressinfo(address)['iswatchonly'])
+
+        # Half used, so the receiving branch gets topped up
+        wallet.derive_receiving_address()
+        self.assertEqual(wallet.address_pool_shortfall(10), [(False, 10, 16)])
+        wallet.fill_address_pool(10)
+        self.assertTrue(wallet.watching_address(False, 15))
+        self.assertTrue(wallet.synced())
+
+    def test_history_index(self):
+        wallet = make_wallet(self)
+        for _ in range(3):
+            self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        unconfirmed_txid = self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+
+        # Pages are newest first, and match listtransactions
+        index = history_indexes.get(wallet)
+        self.assertEqual(index.total(), 4)
+        self.assertEqual(index.page(0, 1)[0]['txid'], unconfirmed_txid)
+        self.assertEqual({entry['txid'] for entry in index.page(1, 10)},
+                         {entry['txid'] for entry in wallet.node.wallet_rpc.listtransactions('*', 3, 1, True)})
+        self.assertEqual(wallet.history()[-1]['txid'], unconfirmed_txid)
+
+        # Confirmation counts keep up without refetching old transactions
+        cursor = index.lastblock
+        self.rpc.generatetoaddress(2, self.rpc.getnewaddress())
+        index = history_indexes.get(wallet)
+        self.assertEqual([entry['confirmations'] for entry in index.page()], [2, 3, 3, 3])
+
+        # Up to date clients only get what changed
+        transactions, removed, new_cursor = index.changes(wallet.node.wallet_rpc, cursor)
+        self.assertEqual([entry['txid'] for entry in transactions], [unconfirmed_txid])
+        self.assertEqual(new_cursor, index.lastblock)
+        self.assertEqual(index.changes(wallet.node.wallet_rpc, new_cursor), ([], [], new_cursor))
+
+        # Reorged out transactions are dropped
+        self.rpc.invalidateblock(new_cursor)
+        self.rpc.invalidateblock(self.rpc.getbestblockhash())
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        index = history_indexes.get(wallet)
+        self.assertEqual(index.total(), 4)
+        self.assertEqual(index.page(0, 1)[0]['confirmations'], 1)
+
+    def test_rescan(self):
+        height = self.rpc.getblockcount()
+        wallet = make_wallet(self)
+        self.assertEqual(wallet.birthday['height'], height)
+        self.assertEqual(Wallet.open(wallet.name).birthday, wallet.birthday)
+
+        # Paid before Bitcoin Core was told to watch the address
+        self.rpc.sendtoaddress(wallet.address(False, 0), 1)
+        self.rpc.generatetoaddress(3, self.rpc.getnewaddress())
+        wallet.derive_receiving_address()
+        self.assertEqual(len(wallet.node.wallet_rpc.listtransactions('*', 1000, 0, True)), 0)
+
+        # Chunked rescan from the birthday finds it
+        heights = []
+        self.assertEqual(wallet.rescan(chunk_size=2, progress=heights.append), (height, height + 3))
+        self.assertEqual(heights, [height + 1, height + 3])
+        self.assertEqual(len(wallet.node.wallet_rpc.listtransactions('*', 1000, 0, True)), 1)
+
+    def test_discover(self):
+        for method in [DiscoveryMethods.SCANTXOUTSET, DiscoveryMethods.RESCAN]:
+            with self.subTest(method=method):
+                self.check_discover(method)
+
+    def check_discover(self, method):
+        # fresh wallet file per method, sharing the Bitcoin Core watch-only wallet
+        make_wallet_file(self)
+        wallet = Wallet.open(self._testMethodName)
+
+        # Pay addresses that were never handed out, as another coordinator might have
+        self.rpc.sendtoaddress(wallet.address(False, 30), 1)
+        self.rpc.sendtoaddress(wallet.address(True, 5), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+
+        # Found in the second batch, past a gap wider than the batch
+        indices = wallet.discover(gap_limit=40, batch_size=25, method=method)
+        self.assertEqual(indices, {'receiving_address_index': 31, 'change_address_index': 6})
+        self.assertEqual(Wallet.open(wallet.name).receiving_address_index, 31)
+        self.assertTrue(wallet.watching_address(False, 30))
+
+        # Gap limit too small to reach them
+        make_wallet_file(self)
+        wallet = Wallet.open(self._testMethodName)
+        indices = wallet.discover(gap_limit=3, batch_size=2, method=method)
+        self.assertEqual(indices, {'receiving_address_index': 0, 'change_address_index': 0})
+
+    def test_reset_imports(self):
+        wallet = make_wallet(self)
+        wallet.fill_address_pool()
+        wallet.derive_receiving_address()
+        self.assertGreater(wallet.receiving_imported_index, wallet.receiving_address_index)
+
+        # Another node (here the same one by another name) can't know about the pool
+        node = Node(host='localhost', port=18443, user=self.rpc_user, password=self.rpc_password,
+                    wallet_name=wallet.name, network='regtest')
+        wallet.set_node(node)
+        self.assertEqual(wallet.receiving_imported_index, wallet.receiving_address_index)
+        self.assertEqual(Wallet.open(wallet.name).receiving_imported_index, 1)
+
+        # so the next address handed out is imported as it goes
+        wallet.derive_receiving_address()
+        self.assertTrue(wallet.watching_address(False, 1))
+
+        # A background refill that was importing into the old Bitcoin Core wallet is dropped
+        wallet_registry = WalletRegistry()
+        wallet_registry.add(wallet)
+        import_ranges = wallet.import_ranges
+        def moved_meanwhile(ranges):
+            import_ranges(ranges)
+            wallet.set_node(make_node(self))
+        with mock.patch.object(address_pool, 'registry', wallet_registry), \
+                mock.patch.object(wallet, 'import_ranges', moved_meanwhile):
+            address_pool.AddressPoolFiller().fill(wallet.name)
+        self.assertEqual(wallet.receiving_imported_index, wallet.receiving_address_index)
+        self.assertEqual(wallet.address_pool, {True: {}, False: {}})
+
+    def test_discover_restored(self):
+        # Funded, then lost
+        original = make_wallet(self)
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        self.rpc.sendtoaddress(original.address(False, 2), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+
+        # Rebuilt from the same signers, so its birthday is after the payment
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        node = Node(host='127.0.0.1', port=18443, user=self.rpc_user, password=self.rpc_password,
+                    wallet_name='restored', network='regtest')
+        restored = Wallet.create(name='restored', m=2, n=3, node=node, network=node.network,
+                                 script_type='native')
+        for signer in signers:
+            restored.add_signer(**signer)
+        self.assertGreater(restored.birthday_height(), self.rpc.getblockcount() - 2)
+
+        indices = restored.discover(method=DiscoveryMethods.RESCAN)
+        self.assertEqual(indices['receiving_address_index'], 3)
+        self.assertEqual(restored.balances(), (0, 1))
+
+    def test_wallet_registry(self):
+        wallet_registry = WalletRegistry()
+        make_wallet_file(self)
+        wallet_name = self._testMethodName
+
+        # Same object until the file changes
+        wallet = wallet_registry.get(wallet_name)
+        self.assertIs(wallet_registry.get(wallet_name), wallet)
+        self.assertIn(wallet.watchonly_name(), self.rpc.listwallets())
+
+        # Our own saves don't cause a reload
+        wallet.derive_receiving_address()
+        self.assertIs(wallet_registry.get(wallet_name), wallet)
+
+        # Writes from elsewhere do
+        other = Wallet.open(wallet_name)
+        other.derive_receiving_address()
+        reloaded = wallet_registry.get(wallet_name)
+        self.assertIsNot(reloaded, wallet)
+        self.assertEqual(reloaded.receiving_address_index, 2)
+
+        # Failed edits are forgotten
+        with self.assertRaises(ValueError):
+            with wallet_registry.editing(wallet_name) as wallet:
+                wallet.receiving_address_index = 100
+                raise ValueError()
+        self.assertEqual(wallet_registry.get(wallet_name).receiving_address_index, 2)
+
     def test_address_derivation(self):
         wallet = make_wallet(self)
 
@@ -262,12 +491,47 @@ class WalletTests(unittest.TestCase):
         self.assertEqual(len(wallet.node.wallet_rpc.listtransactions('*', 1000)), 2)
     
     def test_descriptor(self):
-        raise NotImplementedError('cover every script type and wallet type')
+        '''Local checksums and addresses match Bitcoin Core for every script type and wallet type'''
+        for script_type in ['native', 'wrapped']:
+            for m, n in [(1, 1), (2, 3)]:
+                node = make_node(self)
+                wallet = Wallet(name=self._testMethodName, m=m, n=n, signers=[], psbts=[],
+                                receiving_address_index=0, change_address_index=0, node=node,
+                                network=node.network, script_type=script_type)
+                for signer in signers[:n]:
+                    wallet.signers.append(HardwareSigner(**signer))
+                for change in [False, True]:
+                    for index in [0, 1, 50]:
+                        # Bitcoin Core rejects descriptors with bad checksums
+                        descriptor = wallet.descriptor(change, index)
+                        info = self.rpc.getdescriptorinfo(descriptor)
+                        self.assertEqual(descriptor.split('#')[1], info['checksum'])
+                        address = self.rpc.deriveaddresses(descriptor)[0]
+                        self.assertEqual(address, wallet.address(change, index))
+
+    def test_xpub_cache(self):
         wallet = make_wallet(self)
-        want = "wsh(multi(2,[ecbc6bc1/44'/1'/0']tpubDDsVS9pwqzLB92RZ6uTiixhDLPcoL1JESsYUCGootaTYu4JVh1aCu5t9oY3RRC1ic2dAbt7AqsE8uXLeq1p2DC5SP27ntmx4dUUPnvWhNhW/0/*,[6bb3d403/44'/1'/0']tpubDCpR7Xjiho9KdidtHf3gJ1ZRbzu64HAiYTG9vR6JE5jJrPZbqJYBVXT33rFboKG8PBh4rJudjpBjFjD4ADwdwKUdMYZGJr2bBvLNBZLPMyF/0/*,[5b98d98d/44'/1'/0']tpubDDSFSPwTa8AnvogHXTsJ29745CDLrSmn9Jsi5LN9ks1T6szBk7xmkNAjZ1gXfQHdfuD1rae939z93rXE7he3QkLxNmaLh1XuvyzZoTAAWYm/0/*))#qhjc39jj"
-        self.assertEqual(want, wallet.descriptor(False))
+        xpub_cache.clear()
+
+        # First pass derives each /0 branch once, then one CKDpub step per signer per index
+        first = [wallet.descriptor(False, index) for index in range(10)]
+        info = xpub_cache.info()
+        self.assertEqual(info['hits'], 0)
+        self.assertEqual(info['steps'], len(signers) * (10 + 1))
+
+        # Second pass is served from cache
+        second = [wallet.descriptor(False, index) for index in range(10)]
+        self.assertEqual(first, second)
+        self.assertEqual(xpub_cache.info()['hits'], len(signers) * 10)
+        self.assertEqual(xpub_cache.info()['steps'], info['steps'])
 
     def test_sync(self):
+        self.check_sync(ranged=True)
+
+    def test_sync_each(self):
+        self.check_sync(ranged=False)
+
+    def check_sync(self, ranged):
         # Make wallet and bump address indices to 100
         wallet = make_wallet(self)
         wallet.change_address_index = wallet.receiving_address_index = 100
@@ -282,13 +546,46 @@ class WalletTests(unittest.TestCase):
             self.assertFalse(watching)
         
         # Sync addresses with Bitcoin Core 
-        wallet.sync()
+        wallet.sync(ranged=ranged)
 
         # Assert they aren't being watched
         for index, address in enumerate(change_addresses + receiving_addresses):
             watching = wallet.node.wallet_rpc.getaddressinfo(address).get('iswatchonly')
             self.assertTrue(watching) 
 
+    def test_rpc_batch(self):
+        wallet = make_wallet(self)
+        addresses = [self.rpc.getnewaddress() for _ in range(5)]
+
+        # Queue calls, including one that fails
+        batch = wallet.node.wallet_rpc.batch(size=2)
+        infos = [batch.getaddressinfo(address) for address in addresses]
+        bad = batch.getaddressinfo('not an address')
+        batch.send()
+
+        # Every call gets its own result or error
+        self.assertEqual([info.result()['address'] for info in infos], addresses)
+        with self.assertRaises(JSONRPCException):
+            bad.result()
+
+    def test_rpc_pool(self):
+        node = make_node(self)
+        rpc_pool.clear()
+
+        # Sequential calls, through either RPC object, reuse one keep-alive connection
+        for _ in range(5):
+            node.default_rpc.getblockcount()
+            node.default_rpc.test()
+        self.assertEqual(len(rpc_pool.idle[node.default_rpc.pool_key]), 1)
+
+        # Threads check out their own connections
+        threads = [threading.Thread(target=node.default_rpc.getblockchaininfo) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(len(rpc_pool.idle[node.default_rpc.pool_key]), 4)
+
     def test_create_psbt(self):
         # fixture: get some coins for coin selection
         # check that receiver and change addresses are correct
@@ -318,6 +615,336 @@ class WalletTests(unittest.TestCase):
         change_address = wallet.derive_address(True, wallet.change_address_index-1)
         self.assertIn(change_address, output_addresses)
 
+        # Reopened PSBTs stay unparsed until their fields are read
+        raw_psbt = wallet.psbts[0].serialize()
+        reopened = Wallet.open(wallet.name).psbts[0]
+        self.assertIsNone(reopened.parsed)
+        self.assertEqual(reopened.serialize(), raw_psbt)
+        self.assertEqual(len(reopened.tx.vout), 2)
+        self.assertEqual(reopened.serialize(), raw_psbt)
+
+    def test_decode_psbt(self):
+        wallet = make_wallet(self)
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}])
+
+        # Same as decodepsbt where the frontend looks
+        decoded = wallet.decode_psbt(wallet.psbts[0])
+        core = wallet.node.wallet_rpc.decodepsbt(wallet.psbts[0].serialize())
+        self.assertEqual(decoded['tx']['txid'], core['tx']['txid'])
+        self.assertEqual(decoded['fee'], core['fee'])
+        for vout, core_vout in zip(decoded['tx']['vout'], core['tx']['vout']):
+            self.assertEqual(vout['value'], core_vout['value'])
+            self.assertEqual(vout['scriptPubKey']['addresses'], core_vout['scriptPubKey']['addresses'])
+        for psbt_input, core_input in zip(decoded['inputs'], core['inputs']):
+            self.assertEqual(psbt_input['bip32_derivs'],
+                             sorted(core_input['bip32_derivs'], key=lambda deriv: deriv['pubkey']))
+
+        # Nobody has signed
+        self.assertEqual(decoded['signed_by'], [])
+        self.assertEqual(decoded['missing_signatures'], 2)
+        with self.assertRaises(JunctionError):
+            wallet.broadcast(decoded['tx']['txid'])
+
+    def test_multisig_script_17_keys(self):
+        '''More than 16 keys push n (and m, if it's that large) as data instead of OP_N'''
+        pubkeys = [bytes.fromhex(self.rpc.getaddressinfo(self.rpc.getnewaddress())['pubkey']) for _ in range(17)]
+        for m in [2, 17]:
+            script = descriptors.multisig_script(m, pubkeys)
+            core = self.rpc.createmultisig(m, [pubkey.hex() for pubkey in pubkeys], 'bech32')
+            self.assertEqual(script.hex(), core['redeemScript'])
+            self.assertEqual(descriptors.multisig_pubkeys(script), (m, pubkeys))
+
+            # so PSBTs of 17 key wallets can be analyzed and finalized
+            psbt_input = PartiallySignedInput()
+            psbt_input.witness_script = script
+            self.assertEqual(required_signatures(psbt_input), m)
+            psbt_input.partial_sigs = {pubkey: bytes([i]) * 71 for i, pubkey in enumerate(pubkeys[:m])}
+            script_sig, stack = finalize_input(psbt_input)
+            self.assertEqual(stack, [b'', *[bytes([i]) * 71 for i in range(m)], script])
+
+    def test_sign_with_devices(self):
+        wallet = make_wallet(self)
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        txid = wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}])
+        pubkeys = sorted(wallet.psbt_store.get(txid).inputs[0].hd_keypaths)
+
+        # One device signs with its key, the other isn't plugged in
+        @contextmanager
+        def fake_client_and_device(device_id, network):
+            if device_id == 'unplugged':
+                raise JunctionError('Device not found')
+            def sign_tx(psbt):
+                psbt.inputs[0].partial_sigs[pubkeys[0]] = b'\x30' * 71
+                return {'psbt': psbt.serialize()}
+            yield mock.Mock(sign_tx=sign_tx), {'type': 'trezor', 'path': device_id}
+
+        with mock.patch('api.get_client_and_device', fake_client_and_device):
+            psbt, errors = api.sign_with_devices(wallet.name, ['trezor', 'unplugged'], txid)
+
+        # The signature is merged and saved, the failure reported for its device
+        self.assertEqual(psbt.inputs[0].partial_sigs, {pubkeys[0]: b'\x30' * 71})
+        self.assertEqual(wallet.psbt_store.get(txid).serialize(), psbt.serialize())
+        self.assertEqual(errors, {'unplugged': 'Device not found'})
+
+        # Nobody signing is an error
+        with mock.patch('api.get_client_and_device', fake_client_and_device):
+            with self.assertRaises(JunctionError):
+                api.sign_with_devices(wallet.name, ['unplugged'], txid)
+
+    def test_combine_psbt(self):
+        wallet = make_wallet(self)
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        for _ in range(2):
+            self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        txids = [wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}]) for _ in range(2)]
+
+        # Signatures from two devices, as their PSBTs come back from sign_tx
+        raw_psbt = wallet.psbt_store.get(txids[0]).serialize()
+        signed = []
+        for signature in [b'\x30' * 71, b'\x31' * 71]:
+            psbt = LazyPSBT(raw_psbt).parse()
+            pubkey = sorted(psbt.inputs[0].hd_keypaths)[len(signed)]
+            psbt.inputs[0].partial_sigs[pubkey] = signature
+            signed.append(psbt.serialize())
+        combined = wallet.combine_psbt(signed, txids[0])
+        self.assertEqual(len(combined.inputs[0].partial_sigs), 2)
+
+        # Saved, and merging again changes nothing
+        self.assertEqual(Wallet.open(wallet.name).psbt_store.get(txids[0]).serialize(), combined.serialize())
+        self.assertEqual(wallet.combine_psbt(signed, txids[0]).serialize(), combined.serialize())
+
+        # Signatures for another transaction are refused
+        with self.assertRaises(JunctionError):
+            wallet.combine_psbt([wallet.psbt_store.get(txids[1]).serialize()], txids[0])
+
+        # Signatures saved one at a time, in any order, are all kept
+        wallet.psbt_store.put(LazyPSBT(raw_psbt))
+        for raw in reversed(signed):
+            wallet.update_psbt(LazyPSBT(raw), txids[0])
+        self.assertEqual(wallet.psbt_store.get(txids[0]).serialize(), combined.serialize())
+
+    def test_psbt_store(self):
+        wallet = make_wallet(self)
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        txid = wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}])
+
+        # One file per PSBT, none in the wallet file
+        self.assertTrue(os.path.exists(disk.full_path(f'psbts/{wallet.name}/{txid}.json')))
+        self.assertNotIn('psbts', disk.read_json_file(wallet.wallet_file_path()))
+
+        # Indexed by status and by the coins it spends
+        self.assertEqual(wallet.psbt_store.txids(PSBTStatuses.UNSIGNED), [txid])
+        self.assertEqual(wallet.psbt_store.txids(PSBTStatuses.READY), [])
+        [outpoint] = wallet.psbt_store.outpoints(txid)
+        self.assertEqual(wallet.psbt_store.spenders_of(outpoint), {txid})
+        self.assertEqual(wallet.psbt_txid(index=0), txid)
+
+        # Removing it unlocks its coins
+        self.assertEqual(len(wallet.node.wallet_rpc.listlockunspent()), 1)
+        wallet.remove_psbt(txid)
+        self.assertEqual(wallet.psbt_store.txids(), [])
+        self.assertEqual(wallet.psbt_store.spenders_of(outpoint), set())
+        self.assertEqual(wallet.node.wallet_rpc.listlockunspent(), [])
+
+        # PSBTs in older wallet files move to the store when opened
+        txid = wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}])
+        raw_psbt = wallet.psbt_store.remove(txid).serialize()
+        wallet_file = disk.read_json_file(wallet.wallet_file_path())
+        wallet_file['psbts'] = [raw_psbt]
+        disk.write_json_file(wallet_file, wallet.wallet_file_path())
+        reopened = Wallet.open(wallet.name)
+        self.assertEqual([psbt.serialize() for psbt in reopened.psbts], [raw_psbt])
+        self.assertNotIn('psbts', disk.read_json_file(wallet.wallet_file_path()))
+
+        # A new wallet of the same name doesn't inherit them
+        os.remove(disk.full_path(wallet.wallet_file_path()))
+        self.assertEqual(make_wallet(self).psbts, [])
+        self.assertFalse(os.path.exists(disk.full_path(f'psbts/{wallet.name}')))
+
+    def test_coins_locked(self):
+        wallet = make_wallet(self)
+
+        # fund our wallet with one coin
+        self.rpc.generatetoaddress(101, self.rpc.getnewaddress())
+        receiving_address = wallet.derive_receiving_address()
+        txid = self.rpc.sendtoaddress(receiving_address, 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        self.assertEqual(len(wallet.coins()), 1)
+
+        # psbt locks the coin, which still shows up exactly once
+        wallet.create_psbt([{self.rpc.getnewaddress(): Decimal('0.0001')}])
+        self.assertEqual(len(wallet.node.wallet_rpc.listlockunspent()), 1)
+        coins = wallet.coins()
+        self.assertEqual(len(coins), 1)
+        self.assertEqual(coins[0]['txid'], txid)
+        self.assertEqual(coins[0]['address'], receiving_address)
+        self.assertEqual(coins[0]['amount'], 1)
+
+    def test_utxo_index(self):
+        wallet = make_wallet(self)
+        for _ in range(2):
+            self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+
+        # Same coins as listunspent
+        unspent = wallet.node.wallet_rpc.listunspent(0, 9999999, [], True)
+        self.assertEqual({(coin['txid'], coin['vout']) for coin in wallet.coins()},
+                         {(coin['txid'], coin['vout']) for coin in unspent})
+        self.assertEqual(wallet.balances(), (0, 2))
+
+        # Deltas: a mempool coin, then a block
+        self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        self.assertEqual(wallet.balances(), (1, 2))
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        self.assertEqual(wallet.balances(), (0, 3))
+        self.assertEqual([coin['confirmations'] for coin in wallet.coins()], [2, 2, 1])
+
+        # Reorg sends everything back to the mempool
+        self.rpc.invalidateblock(self.rpc.getbestblockhash())
+        self.rpc.invalidateblock(self.rpc.getbestblockhash())
+        self.assertEqual(wallet.balances(), (3, 0))
+
+        # Coinbase outputs count once they mature, though listsinceblock never reports that
+        [block] = self.rpc.generatetoaddress(1, wallet.derive_receiving_address())
+        reward = self.rpc.getblock(block, 2)['tx'][0]['vout'][0]['value']
+        self.rpc.generatetoaddress(99, self.rpc.getnewaddress())
+        self.assertEqual(wallet.balances(), (0, 3))
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        self.assertEqual(wallet.balances(), (0, 3 + reward))
+
+    @mock.patch.object(snapshots, 'NODE_STATE_TTL', 0)
+    def test_wallet_snapshots(self):
+        wallet = make_wallet(self)
+
+        # Nothing changed, so the snapshot is reused
+        first = snapshots.snapshots.get(wallet)
+        self.assertIs(first, snapshots.snapshots.get(wallet))
+
+        # New block
+        self.rpc.generatetoaddress(1, self.rpc.getnewaddress())
+        second = snapshots.snapshots.get(wallet)
+        self.assertIsNot(first, second)
+
+        # Wallet file rewritten
+        wallet.derive_receiving_address()
+        third = snapshots.snapshots.get(wallet)
+        self.assertIsNot(second, third)
+        self.assertEqual(third['receiving_address_index'], 1)
+
+    def test_chain_notifications(self):
+        wallet = make_wallet(self)
+        snapshots.snapshots.get(wallet)
+
+        # Polling fallback, so this runs without pyzmq or -zmqpub* options
+        notifications = ChainNotifications(use_zmq=False, poll_interval=0.1)
+        changed = threading.Event()
+        notifications.subscribe(lambda changed_wallet: changed.set())
+        watcher = notifications.watch(wallet.node)
+        try:
+            while watcher.state is None:
+                watcher.stopped.wait(0.1)
+            self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+            self.assertTrue(changed.wait(10))
+            self.assertIsNone(snapshots.snapshots.latest(wallet.name))
+        finally:
+            notifications.stop()
+
+    @mock.patch.object(snapshots, 'NODE_STATE_TTL', 0)
+    def test_wallet_events(self):
+        wallet = make_wallet(self)
+        events = WalletEvents()
+        subscriber = events.subscribe()
+        [snapshot] = events.snapshot_events()
+        self.assertTrue(snapshot.startswith('event: snapshot\n'))
+
+        # Nothing changed, nothing sent
+        events.publish(wallet)
+        self.assertEqual(subscriber.get(0), KEEPALIVE)
+
+        # Only what changed is sent
+        self.rpc.sendtoaddress(wallet.derive_receiving_address(), 1)
+        events.publish(wallet)
+        event = subscriber.get(0)
+        self.assertTrue(event.startswith('event: diff\n'))
+        diff = json.loads(event.split('data: ')[1])
+        self.assertEqual(diff['balances']['unconfirmed'], 1)
+        self.assertEqual(len(diff['coins']['updated']), 1)
+        self.assertEqual(diff['coins']['removed'], [])
+        self.assertNotIn('psbts', diff)
+        events.unsubscribe(subscriber)
+
+    def test_refresh_wallets(self):
+        wallet = make_wallet(self)
+        wallet.derive_receiving_address()
+
+        # Same fields as to_dict(True), computed in parallel
+        refresher = WalletRefresher(workers=2, deadline=30)
+        fresh = refresher.refresh([wallet])[0]
+        self.assertFalse(fresh['stale'])
+        for field in ['balances', 'psbts', 'coins', 'history', 'synced']:
+            self.assertEqual(fresh[field], wallet.to_dict(True)[field])
+
+        # Nothing finishes before a zero deadline, so we get the last snapshot back
+        snapshots.snapshots.invalidate()
+        snapshots.snapshots.store(wallet.name, None, fresh)
+        stale = WalletRefresher(deadline=0).refresh([wallet])[0]
+        self.assertTrue(stale['stale'])
+        self.assertEqual(stale['synced'], fresh['synced'])
+
+        # A job still running, e.g. on a hanging node, is reused instead of piling up
+        release = threading.Event()
+        running = refresher.submit(('rpc_error', 'hanging'), release.wait)
+        self.assertIs(refresher.submit(('rpc_error', 'hanging'), release.wait), running)
+        release.set()
+        self.assertTrue(running.result())
+
+    def test_device_cache(self):
+        devices = [{'type': 'trezor', 'path': 'webusb:001:1', 'fingerprint': 'ecbc6bc1'}]
+        cache = DeviceCache(ttl=60)
+        with mock.patch('utils.commands.enumerate', return_value=devices) as enumerate:
+            # Enumerated once, then served from cache
+            self.assertEqual(cache.enumerate(), devices)
+            self.assertEqual(cache.enumerate(), devices)
+            self.assertEqual(enumerate.call_count, 1)
+
+            # Invalidated, e.g. by a hotplug event
+            cache.invalidate()
+            cache.enumerate()
+            self.assertEqual(enumerate.call_count, 2)
+
+            # Stale
+            cache.ttl = 0
+            cache.enumerate()
+            self.assertEqual(enumerate.call_count, 3)
+
+    def test_device_locks(self):
+        locks = DeviceLocks()
+        trezor = {'type': 'trezor', 'path': 'webusb:001:1'}
+        ledger = {'type': 'ledger', 'path': 'IOService:/ledger'}
+
+        def try_lock(device, results):
+            lock = locks.get(device['path'])
+            results.append(lock.acquire(blocking=False))
+            if results[-1]:
+                lock.release()
+
+        # Other devices stay free while one is in use, the same one doesn't
+        results = []
+        with locks.holding(trezor):
+            for device in [ledger, trezor]:
+                thread = threading.Thread(target=try_lock, args=(device, results))
+                thread.start()
+                thread.join()
+        self.assertEqual(results, [True, False])
+
     def test_signing_complete(self):
         # test with finished and unfinished psbts
         pass
@@ -2,18 +2,30 @@ import json
 import threading
 import sys
 import logging
+import itertools
+import time
+import base64
+import urllib.parse
 from os import listdir
 import os.path
-from contextlib import contextmanager
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
 from decimal import Decimal
 from flask import flash, current_app as app
-from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+from bitcoinrpc.authproxy import JSONRPCException, EncodeDecimal
 from hwilib import commands
 from hwilib.devices import coldcard, digitalbitbox, ledger, trezor
 from btclib import bip32, base58
 import http
+import http.client
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
 
 logger = logging.getLogger(__name__)
+# held while enumerating devices; using a device takes that device's lock (device_locks)
 hwi_lock = threading.Lock()
 
 ### Exceptions
@@ -21,6 +33,9 @@ hwi_lock = threading.Lock()
 class JunctionError(Exception):
     pass
 
+class BadRequest(JunctionError):
+    '''The request itself is wrong, e.g. a missing parameter. Answered with a 400.'''
+
 class JunctionWarning(Exception):
     pass
 
@@ -33,22 +48,73 @@ def handle_exception(exception):
 
 ### HWI
 
+# Seconds an enumeration is reused (hotplug events and failed opens end it sooner)
+DEVICE_CACHE_TTL = 5
+
+class DeviceCache:
+    '''commands.enumerate() results, shared by every request until they go stale
+
+    Enumerating probes every USB HID device and can take seconds, so it happens at
+    most once per DEVICE_CACHE_TTL. With pyudev installed, plugging a device in
+    or out ends the cached enumeration right away.
+    '''
+
+    def __init__(self, ttl=DEVICE_CACHE_TTL):
+        self.ttl = ttl
+        self.devices = None
+        self.fetched_at = 0
+        self.observer = None
+
+    def enumerate(self, refresh=False):
+        '''Connected devices, enumerated again only if refresh or the cached list is stale'''
+        self.watch_hotplug()
+        with hwi_lock:
+            if refresh or self.devices is None or time.time() - self.fetched_at >= self.ttl:
+                self.devices = commands.enumerate()
+                self.fetched_at = time.time()
+            # callers may modify what they get
+            return [dict(device) for device in self.devices]
+
+    def invalidate(self):
+        self.devices = None
+
+    def watch_hotplug(self):
+        '''Invalidate on udev USB events, if pyudev is available'''
+        if pyudev is None or self.observer is not None:
+            return
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by('usb')
+            self.observer = pyudev.MonitorObserver(monitor, callback=lambda device: self.invalidate())
+            self.observer.daemon = True
+            self.observer.start()
+        except Exception as e:
+            # e.g. no udev in this container: the TTL still applies
+            logger.info(f'Not watching for USB hotplug events: {e}')
+            self.observer = False
+
+device_cache = DeviceCache()
+
 def get_device_for_client(client):
-    with hwi_lock:
-        devices = commands.enumerate()
+    devices = device_cache.enumerate()
     for device in devices:
-        if client.path == device.path:
+        if client.path == device['path']:
             return client
 
-def get_device(device_id):
+def find_device(devices, device_id):
     matching_device = None
-    with hwi_lock:
-        devices = commands.enumerate()
     for device in devices:
         if device.get('path') == device_id:
             matching_device = device
         elif device.get('fingerprint') == device_id:
             matching_device = device
+    return matching_device
+
+def get_device(device_id, refresh=False):
+    matching_device = find_device(device_cache.enumerate(refresh), device_id)
+    if not matching_device and not refresh:
+        # it may have been plugged in (or unlocked) since we last looked
+        matching_device = find_device(device_cache.enumerate(refresh=True), device_id)
     if not matching_device:
         raise JunctionError('Device not found')
     return matching_device
@@ -66,15 +132,54 @@ def get_client(device, network):
     client.is_testnet = network != "mainnet"
     return client
 
+class DeviceLocks:
+    '''A lock per device (by USB path), so different devices can be used at the same time'''
+
+    def __init__(self):
+        # device path -> lock held while a request talks to that device
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            return self.locks.setdefault(path, threading.RLock())
+
+    @contextmanager
+    def holding(self, *devices):
+        '''Lock devices, always in the same order so two requests can't deadlock'''
+        with ExitStack() as stack:
+            for path in sorted({device['path'] for device in devices}):
+                stack.enter_context(self.get(path))
+            yield
+
+    def holding_coldcards(self, device):
+        '''ckcc opens whichever ColdCard it finds first, so lock all of them'''
+        coldcards = [other for other in device_cache.enumerate() if other['type'] == 'coldcard']
+        return self.holding(device, *coldcards)
+
+device_locks = DeviceLocks()
+
 @contextmanager
 def get_client_and_device(device_id, network):
-    '''automatically closes HWI client upon exit''' 
-    device = get_device(device_id)
-    client = get_client(device, network)
-    try:
-        yield client, device
-    finally:
-        client.close()
+    '''automatically closes HWI client upon exit, and holds the device's lock until then''' 
+    for refresh in [False, True]:
+        device = get_device(device_id, refresh)
+        with device_locks.holding(device):
+            try:
+                client = get_client(device, network)
+            except JunctionError:
+                raise
+            except Exception as e:
+                if refresh:
+                    raise
+                # the cached path may be gone, e.g. the device was replugged
+                logger.info(f'Could not open {device_id}, enumerating again: {e}')
+                continue
+            try:
+                yield client, device
+            finally:
+                client.close()
+            return
 
 class ClientGroup:
     '''single "source of truth" for devices and clients'''
@@ -87,10 +192,12 @@ class ClientGroup:
             success = client.send_pin(pin)['success']
         if success:
             self.close()
+            # unlocked devices enumerate with their fingerprints
+            device_cache.invalidate()
         return success
 
     def prompt_pin(self, network):
-        devices = commands.enumerate()
+        devices = device_cache.enumerate()
         for device in devices:
             if device.get('needs_pin_sent'):
                 client = get_client(device, network)
@@ -119,34 +226,237 @@ def sat_to_btc(sat):
 
 ### Bitcoin Nodes
 
+# Most calls a single JSON-RPC batch array may contain
+RPC_BATCH_SIZE = 500
+
+# JSON-RPC request ids, unique across every batch in this process
+rpc_ids = itertools.count()
+
+class RPCCall:
+    '''A call queued in an RPCBatch, resolved once the batch is sent'''
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = list(params)
+        self.sent = False
+        self.response = None
+        self.error = None
+
+    def resolve(self, response):
+        self.sent = True
+        self.response = response.get('result')
+        self.error = response.get('error')
+        if self.error is None and 'result' not in response:
+            self.error = {'code': -343, 'message': 'missing JSON-RPC result'}
+
+    def result(self):
+        '''Result of this call, raising its JSONRPCException if it failed'''
+        if not self.sent:
+            raise JunctionError(f'Batched "{self.method}" call has not been sent')
+        if self.error is not None:
+            raise JSONRPCException(self.error)
+        return self.response
+
+class RPCBatch:
+    '''Queues RPC calls and sends them as JSON-RPC batch arrays
+
+    batch = rpc.batch()
+    info = batch.getaddressinfo(address)
+    batch.send()
+    info.result()
+    '''
+
+    def __init__(self, rpc, size=RPC_BATCH_SIZE):
+        self.rpc = rpc
+        self.size = size
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        def queue(*params):
+            call = RPCCall(name, params)
+            self.calls.append(call)
+            return call
+        return queue
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def send(self):
+        '''Send unsent calls, one HTTP round trip per `size` calls'''
+        pending = [call for call in self.calls if not call.sent]
+        for start in range(0, len(pending), self.size):
+            chunk = pending[start:start+self.size]
+            responses = self.rpc.send_batch([(call.method, call.params) for call in chunk])
+            for call, response in zip(chunk, responses):
+                call.resolve(response)
+        return self.calls
+
+    def results(self):
+        '''Send and return every result in call order, raising the first error'''
+        self.send()
+        return [call.result() for call in self.calls]
+
+# Idle keep-alive connections kept per (host, port, credentials)
+RPC_POOL_SIZE = 8
+
+# bitcoind drops idle connections after -rpcservertimeout (30s by default)
+RPC_POOL_IDLE_TIMEOUT = 20
+
+# Errors meaning bitcoind closed a kept-alive connection before we reused it
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                           BrokenPipeError, ConnectionResetError)
+
+class ConnectionPool:
+    '''Process-wide HTTP/1.1 keep-alive connections to bitcoind, keyed by (host, port, credentials)
+
+    A connection is checked out by one thread at a time, so it's safe to share the
+    pool across Flask's threaded workers.
+    '''
+
+    def __init__(self, size=RPC_POOL_SIZE, idle_timeout=RPC_POOL_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # key -> [(connection, time released)]
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        '''(connection, reused) for key, preferring a healthy idle connection'''
+        host, port, _ = key
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, released_at = idle.pop()
+                # health check: bitcoind may have closed it already
+                if now - released_at < self.idle_timeout and conn.sock is not None:
+                    return conn, True
+                conn.close()
+        return http.client.HTTPConnection(host, port), False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size and conn.sock is not None:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def request(self, key, path, body, headers, timeout):
+        '''POST body on a pooled connection, returning (status, reason, content type, response body)'''
+        conn, reused = self.acquire(key)
+        try:
+            response = self.send(conn, path, body, headers, timeout)
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # bitcoind closed the idle connection under us, retry once on a fresh one
+            conn = http.client.HTTPConnection(key[0], key[1])
+            try:
+                response = self.send(conn, path, body, headers, timeout)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        self.release(key, conn)
+        return response
+
+    def send(self, conn, path, body, headers, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request('POST', path, body, headers)
+        response = conn.getresponse()
+        # must read the whole body before the connection can be reused
+        data = response.read()
+        return response.status, response.reason, response.getheader('Content-Type'), data
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+rpc_pool = ConnectionPool()
+
 class RPC:
 
     def __init__(self, uri, timeout=30):
         self.uri = uri
         self.timeout = timeout
-        self.rpc = AuthServiceProxy(self.uri, timeout=self.timeout)
-        self.retries = 3
+        url = urllib.parse.urlparse(uri)
+        self.path = url.path
+        authpair = f'{url.username}:{url.password}'.encode('utf8')
+        self.headers = {
+            'Host': url.hostname,
+            'Authorization': b'Basic ' + base64.b64encode(authpair),
+            'Content-type': 'application/json',
+        }
+        self.pool_key = (url.hostname, url.port or 80, self.headers['Authorization'])
 
     def __getattr__(self, name):
-        '''Retry failed RPC calls 3 times'''
-        try:
-            response = getattr(self.rpc, name)
-            self.retries = 3
-            return response
-        except:
-            if self.retries > 0:
-                self.rpc = AuthServiceProxy(self.uri, timeout=self.timeout)
-                self.retries -= 1
-                return getattr(self, name)
-            else:
-                raise
+        '''rpc.getblockchaininfo() style calls'''
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        def call(*params):
+            return self.call(name, *params)
+        return call
+
+    def call(self, method, *params):
+        request = {'version': '1.1', 'id': next(rpc_ids), 'method': method, 'params': list(params)}
+        response = self.post(request)
+        if response.get('error') is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+        return response['result']
+
+    def batch(self, size=RPC_BATCH_SIZE):
+        '''Start an RPCBatch against this connection'''
+        return RPCBatch(self, size)
+
+    def send_batch(self, calls):
+        '''Send (method, params) pairs as one JSON-RPC array, returning responses in call order'''
+        requests = [{'jsonrpc': '2.0', 'id': next(rpc_ids), 'method': method, 'params': params}
+                    for method, params in calls]
+        responses = self.post(requests)
+        if not isinstance(responses, list):
+            # bitcoind answers a malformed batch with a single error object
+            raise JSONRPCException(responses.get('error') or {'code': -342, 'message': 'invalid batch response'})
+        by_id = {response.get('id'): response for response in responses}
+        missing = {'error': {'code': -343, 'message': 'missing JSON-RPC response'}}
+        return [by_id.get(request['id'], missing) for request in requests]
+
+    def post(self, payload):
+        '''POST a JSON payload to bitcoind over a pooled connection and return the decoded response'''
+        body = json.dumps(payload, default=EncodeDecimal)
+        status, reason, content_type, data = rpc_pool.request(self.pool_key, self.path, body,
+                                                              self.headers, self.timeout)
+        if status == http.HTTPStatus.UNAUTHORIZED:
+            raise JSONRPCException({'code': -342, 'message': 'Unauthorized'})
+        if content_type != 'application/json':
+            raise JSONRPCException({'code': -342, 'message': f'non-JSON HTTP response with \'{status} {reason}\' from server'})
+        return json.loads(data.decode('utf8'), parse_float=Decimal)
 
     def test(self):
         '''raises JunctionErrors if RPC-connection doesn't work'''
         # Test RPC connection works
         try:
             # FIXME: want shorter timeout ...
-            rpc = AuthServiceProxy(self.uri, timeout=0.5)
+            rpc = RPC(self.uri, timeout=0.5)
             rpc.getblockchaininfo()
         except (ConnectionRefusedError, http.client.CannotSendRequest) as e:
             raise JunctionError("ConnectionRefusedError: check https://bitcoin.stackexchange.com/questions/74337/testnet-bitcoin-connection-refused-111")
@@ -175,6 +485,10 @@ class RPC:
         except JunctionError as e:
             return str(e)
 
+def node_key(node):
+    '''(host, port) identifying a node, e.g. to share work between wallets using it'''
+    return (node.host, str(node.port))
+
 def default_bitcoin_datadir():
     datadir = None
     if sys.platform == 'darwin':
@@ -289,12 +603,114 @@ def get_nodes():
             pass
     return nodes
 
+### Caches
+
+class LRUCache:
+    '''Bounded, thread-safe mapping that evicts the least recently used entry'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 ### Bitcoin scripts & addresses
 
+# Enough for every /0 and /1 node of a 20 signer wallet with a few thousand used indices
+XPUB_CACHE_SIZE = 50_000
+
+class XpubCache:
+    '''Memoized BIP32 public derivation keyed by (xpub, path)
+
+    Intermediate nodes are cached too, so once an xpub's /0 and /1 branch keys
+    are known every new index costs a single CKDpub step.
+    '''
+
+    def __init__(self, maxsize=XPUB_CACHE_SIZE):
+        # (xpub, indexes) -> (child xpub, child SEC pubkey hex)
+        self.nodes = LRUCache(maxsize)
+        self.lock = threading.Lock()
+        # derivations answered entirely from cache
+        self.hits = 0
+        # derivations that needed at least one CKDpub step
+        self.misses = 0
+        # CKDpub steps performed
+        self.steps = 0
+
+    def derive(self, xpub, path):
+        '''(child xpub, child SEC pubkey hex) at relative path like "./0/5"'''
+        indexes, absolute = bip32.indexes_from_path(path)
+        if absolute:
+            raise JunctionError(f'Expected relative derivation path, got "{path}"')
+        indexes = tuple(indexes)
+
+        # Find the deepest node we already know
+        depth = len(indexes)
+        node = None
+        while depth > 0:
+            node = self.nodes.get((xpub, indexes[:depth]))
+            if node is not None:
+                break
+            depth -= 1
+
+        with self.lock:
+            if depth == len(indexes):
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.steps += len(indexes) - depth
+
+        # Derive (and remember) the rest of the path
+        child_xpub = node[0] if node else xpub
+        for i in range(depth, len(indexes)):
+            child_xpub = bip32.ckd(child_xpub, indexes[i])
+            child_xpub_bytes = base58.decode_check(child_xpub)
+            # assertion about length?
+            node = (child_xpub, child_xpub_bytes[-33:].hex())
+            self.nodes.set((xpub, indexes[:i+1]), node)
+        return node
+
+    def info(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'steps': self.steps,
+                'size': len(self.nodes),
+                'maxsize': self.nodes.maxsize,
+            }
+
+    def clear(self):
+        self.nodes.clear()
+        with self.lock:
+            self.hits = self.misses = self.steps = 0
+
+xpub_cache = XpubCache()
+
 def derive_child_sec_from_xpub(xpub, path):
-    child_xpub = bip32.derive(xpub, path)
-    child_xpub_bytes = base58.decode_check(child_xpub)
-    # assertion about length?
-    child_sec_bytes = child_xpub_bytes[-33:]
-    child_sec_hex = child_sec_bytes.hex()
+    _, child_sec_hex = xpub_cache.derive(xpub, path)
     return child_sec_hex
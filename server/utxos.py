@@ -0,0 +1,169 @@
+'''
+Local copy of each wallet's UTXO set, kept current with listsinceblock
+
+The set is fetched in full once (listunspent). After that, each update applies
+only the transactions in blocks since the last tip we saw, plus the mempool,
+so polling a wallet with thousands of coins doesn't ship all of them every time.
+A reorg (our last tip is no longer on the main chain) triggers a full refetch,
+and so does a coinbase output maturing, since listsinceblock doesn't report it again.
+'''
+from indexes import SinceBlockIndex, WalletIndexes
+
+# listsinceblock categories that create coins we can spend
+RECEIVE_CATEGORIES = ('receive', 'generate')
+
+# Blocks on top of a coinbase's before it can be spent
+COINBASE_MATURITY = 100
+
+def outpoint(coin):
+    return (coin['txid'], coin['vout'])
+
+def oldest_first(coin):
+    # mempool coins last
+    return (coin['blockheight'] is None, coin['blockheight'] or 0, coin['txid'], coin['vout'])
+
+class UtxoIndex(SinceBlockIndex):
+
+    def __init__(self):
+        super().__init__()
+        # outpoint -> coin, for coins created in blocks (carrying "blockheight")
+        self.confirmed = {}
+        # the same, for coins created by mempool transactions; rebuilt every update
+        self.mempool = {}
+        # outpoints spent by mempool transactions; rebuilt every update
+        self.mempool_spends = set()
+        # txid -> outpoints spent by it, for mempool transactions we've already decoded
+        self.inputs = {}
+        # mempool transactions spending only our coins (e.g. our change), which count as confirmed
+        self.trusted = set()
+        # height at which our first immature coinbase output becomes spendable, or None
+        self.matures_at = None
+
+    def load(self, wallet):
+        '''Full refetch of the confirmed coins, and the tip they're valid at'''
+        batch = wallet.node.wallet_rpc.batch()
+        lastblock = batch.getbestblockhash()
+        height = batch.getblockcount()
+        batch.send()
+        self.lastblock, self.height = lastblock.result(), height.result()
+
+        # Coins confirmed in blocks after this tip are applied again by the next delta, which is harmless
+        self.confirmed = {}
+        for coin in wallet.unspent():
+            if coin['confirmations'] > 0:
+                self.confirmed[outpoint(coin)] = self.coin(coin, self.height - coin['confirmations'] + 1)
+        self.mempool, self.mempool_spends, self.inputs, self.trusted = {}, set(), {}, set()
+        self.matures_at = self.next_maturity(wallet.node.wallet_rpc)
+
+    def next_maturity(self, rpc):
+        '''Height at which the first immature coinbase output (listunspent leaves them out) matures'''
+        # anything older has matured already
+        since = rpc.listsinceblock(rpc.getblockhash(max(self.height - COINBASE_MATURITY, 0)), 1, True)
+        return min((self.height - entry['confirmations'] + 1 + COINBASE_MATURITY for entry in since['transactions']
+                    if entry['category'] == 'immature' and entry['confirmations'] > 0), default=None)
+
+    def apply_delta(self, wallet):
+        if not super().apply_delta(wallet):
+            return False
+        # a matured coinbase output won't be reported again, so refetch to pick it up
+        return self.matures_at is None or self.height < self.matures_at
+
+    def apply(self, rpc, entries, height):
+        entries = [entry for entry in entries if entry['confirmations'] >= 0]
+        inputs = self.spent_outpoints(rpc, {entry['txid'] for entry in entries})
+
+        # Confirmed transactions: add their coins, then remove what they spent
+        confirmed = [entry for entry in entries if entry['confirmations'] > 0]
+        for entry in confirmed:
+            if entry['category'] in RECEIVE_CATEGORIES:
+                self.confirmed[outpoint(entry)] = self.coin(entry, entry['blockheight'])
+            elif entry['category'] == 'immature':
+                matures_at = entry['blockheight'] + COINBASE_MATURITY
+                self.matures_at = min(self.matures_at or matures_at, matures_at)
+        for txid in {entry['txid'] for entry in confirmed}:
+            for spent in inputs[txid]:
+                self.confirmed.pop(spent, None)
+
+        # Mempool transactions are always reported again, so rebuild their effects from scratch
+        unconfirmed = [entry for entry in entries if entry['confirmations'] == 0]
+        self.mempool = {outpoint(entry): self.coin(entry, None)
+                        for entry in unconfirmed if entry['category'] in RECEIVE_CATEGORIES}
+        unconfirmed_txids = {entry['txid'] for entry in unconfirmed}
+        self.mempool_spends = {spent for txid in unconfirmed_txids for spent in inputs[txid]}
+        self.inputs = {txid: inputs[txid] for txid in unconfirmed_txids}
+        self.trusted = self.trusted_txids(unconfirmed_txids)
+
+    def trusted_txids(self, unconfirmed_txids):
+        '''Mempool transactions spending only our confirmed coins or trusted mempool ones, as getbalances' "trusted"'''
+        trusted = set()
+        changed = True
+        while changed:
+            changed = False
+            for txid in unconfirmed_txids - trusted:
+                spent = self.inputs[txid]
+                if spent and all(outpoint in self.confirmed or (outpoint in self.mempool and outpoint[0] in trusted)
+                                 for outpoint in spent):
+                    trusted.add(txid)
+                    changed = True
+        return trusted
+
+    def spent_outpoints(self, rpc, txids):
+        '''txid -> outpoints its inputs spend, decoding only transactions we haven't seen'''
+        inputs = {txid: self.inputs[txid] for txid in txids if txid in self.inputs}
+        missing = [txid for txid in txids if txid not in inputs]
+        if not missing:
+            return inputs
+
+        batch = rpc.batch()
+        transactions = [batch.gettransaction(txid, True) for txid in missing]
+        batch.send()
+        batch = rpc.batch()
+        decoded = [batch.decoderawtransaction(transaction.result()['hex']) for transaction in transactions]
+        batch.send()
+        for txid, tx in zip(missing, decoded):
+            inputs[txid] = [(vin['txid'], vin['vout']) for vin in tx.result()['vin'] if 'txid' in vin]
+        return inputs
+
+    def coin(self, entry, blockheight):
+        return {
+            'txid': entry['txid'],
+            'vout': entry['vout'],
+            # bare multisig and other non-standard outputs have none
+            'address': entry.get('address'),
+            'amount': entry['amount'],
+            'blockheight': blockheight,
+        }
+
+    def coins(self):
+        '''Unspent coins with their current confirmation counts'''
+        with self.lock:
+            coins = dict(self.confirmed)
+            coins.update(self.mempool)
+            for spent in self.mempool_spends:
+                coins.pop(spent, None)
+            height = self.height
+        return [{
+            'txid': coin['txid'],
+            'vout': coin['vout'],
+            'address': coin['address'],
+            'amount': coin['amount'],
+            'confirmations': height - coin['blockheight'] + 1 if coin['blockheight'] is not None else 0,
+        } for coin in sorted(coins.values(), key=oldest_first)]
+
+    def balances(self):
+        '''(unconfirmed, confirmed) totals of the unspent coins
+
+        Like getbalances' watch-only untrusted_pending / trusted, our own unconfirmed
+        change counts as confirmed.
+        '''
+        with self.lock:
+            trusted = set(self.trusted)
+        unconfirmed, confirmed = 0, 0
+        for coin in self.coins():
+            if coin['confirmations'] > 0 or coin['txid'] in trusted:
+                confirmed += coin['amount']
+            else:
+                unconfirmed += coin['amount']
+        return unconfirmed, confirmed
+
+utxo_indexes = WalletIndexes(UtxoIndex)
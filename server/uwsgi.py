@@ -1,4 +1,13 @@
-from server import server
+import atexit
+
+from server import server, run
+from notifications import notifications
+from events import wallet_events
 
 if __name__ == "__main__":
-    server.run()
\ No newline at end of file
+    run()
+else:
+    # uWSGI imports this module to serve the app
+    notifications.subscribe(wallet_events.publish)
+    notifications.start()
+    atexit.register(notifications.stop)